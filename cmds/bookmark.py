@@ -21,7 +21,7 @@
 #
 ################################################################################
 
-import os,time,codecs
+import os,time,codecs,threading
 
 from sibyl.lib.decorators import *
 import sibyl.lib.util as util
@@ -53,10 +53,13 @@ def init(bot):
       bm_store = {}
 
   bot.add_var('bm_store',bm_store)
+
+  # bookmark cmds from different users run at the same time
+  bot.add_var('bm_lock',threading.RLock())
   bot.add_var('last_resume',persist=True)
   # note the "last_played" var is created in xbmc.py so don't do it here
 
-@botcmd
+@botcmd(thread='xbmc')
 def bookmark(bot,mess,args):
   """manage bookmarks - bookmark [show|set|remove|update] [name]"""
 
@@ -68,8 +71,24 @@ def bookmark(bot,mess,args):
     if bot.last_played is None:
       return 'No active audios or videos playlist to bookmark'
 
-    # check if anything is actually playing
-    if bot.xbmc_active_player() is None:
+    down = bot.xbmc_down()
+    if down:
+      return down
+
+    # get info for bookmark and check if anything is actually playing
+    pid = bot.last_played[0]
+    path = bot.last_played[1]
+    state = bot.xbmc_state()
+    if state is None or (state['active'] and state['active'][0]!=pid):
+      results = bot.xbmc_batch([('Player.GetActivePlayers',None),
+          ('Player.GetProperties',{'playerid':pid,
+              'properties':['position','time']}),
+          ('Player.GetItem',{'playerid':pid,'properties':['file']})])
+      if util.xbmc_player(results[0]) is None:
+        return 'Nothing playing'
+      state = results[1]['result']
+      state['item'] = results[2]['result']['item']
+    elif not state['active']:
       return 'Nothing playing'
 
     # check if a name was passed
@@ -78,21 +97,14 @@ def bookmark(bot,mess,args):
     if len(args)>0:
       name = str(args[0])
 
-    # get info for bookmark
-    pid = bot.last_played[0]
-    path = bot.last_played[1]
-    params = {'playerid':pid,'properties':['position','time']}
-    result = bot.xbmc('Player.GetProperties',params)
-    pos = result['result']['position']
-    t = str(util.time2str(result['result']['time']))
+    pos = state['position']
+    t = str(util.time2str(state['time']))
     add = time.time()
-    result = bot.xbmc('Player.GetItem',{'playerid':pid,'properties':['file']})
-    fil = os.path.basename(str(result['result']['item']['file']))
+    fil = os.path.basename(str(state['item']['file']))
 
     # note that the position is stored 0-indexed
-    bot.bm_store[name] = {'path':path,'add':add,'time':t,
-                          'pid':pid,'pos':pos,'file':fil}
-    bm_update(bot,name,bot.bm_store[name])
+    bm_update(bot,name,{'path':path,'add':add,'time':t,
+                        'pid':pid,'pos':pos,'file':fil})
     return 'Bookmark added for "'+name+'" item '+str(pos+1)+' at '+t
 
   elif args[0]=='remove':
@@ -136,7 +148,8 @@ def bookmark(bot,mess,args):
     return 'Found 1 bookmark: '+str(entries[0])
   return 'Found '+str(len(entries))+' bookmarks: '+util.list2str(entries)
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def resume(bot,mess,args):
   """resume playing a playlist - resume [name] [next]"""
 
@@ -211,44 +224,48 @@ def bm_update(bot,name,props):
   """add or modify the entry for name with props in dict and file
   returns True if name was modified or False if name was added"""
 
-  result = bm_remove(bot,name)
-  bm_add(bot,name,props)
+  with bot.bm_lock:
+    result = bm_remove(bot,name)
+    bm_add(bot,name,props)
   return result
 
 def bm_add(bot,name,props):
   """add the entry for name with props to dict and file. Note
   that this function could add duplicates without proper checking"""
 
-  bot.bm_store[name] = props
+  with bot.bm_lock:
+    bot.bm_store[name] = props
 
-  # the bookmark file should always end in a newline
-  with codecs.open(bot.opt('bookmark.file'),'a',encoding='utf8') as f:
-    f.write(bm_format(name,props)+'\n')
+    # the bookmark file should always end in a newline
+    with codecs.open(bot.opt('bookmark.file'),'a',encoding='utf8') as f:
+      f.write(bm_format(name,props)+'\n')
 
 def bm_remove(bot,name):
   """remove the entry for name from dict and file if it exists
   returns False if name was not found or True if name was removed"""
 
-  # passing "*" removes all bookmarks
-  if name=='*':
-    bot.bm_store = {}
-    with codecs.open(bot.opt('bookmark.file'),'w',encoding='utf8') as f:
-      f.write('')
-    return True
+  with bot.bm_lock:
 
-  # return False if name does not exist
-  if name not in bot.bm_store.keys():
-    return False
+    # passing "*" removes all bookmarks
+    if name=='*':
+      bot.bm_store = {}
+      with codecs.open(bot.opt('bookmark.file'),'w',encoding='utf8') as f:
+        f.write('')
+      return True
 
-  del bot.bm_store[name]
+    # return False if name does not exist
+    if name not in bot.bm_store.keys():
+      return False
 
-  with codecs.open(bot.opt('bookmark.file'),'r',encoding='utf8') as f:
-    lines = f.readlines()
+    del bot.bm_store[name]
 
-  lines = [l for l in lines if l.split('\t')[0]!=name]
+    with codecs.open(bot.opt('bookmark.file'),'r',encoding='utf8') as f:
+      lines = f.readlines()
 
-  with codecs.open(bot.opt('bookmark.file'),'w',encoding='utf8') as f:
-    f.writelines(lines)
+    lines = [l for l in lines if l.split('\t')[0]!=name]
+
+    with codecs.open(bot.opt('bookmark.file'),'w',encoding='utf8') as f:
+      f.writelines(lines)
 
   # return True if name was removed
   return True
@@ -21,13 +21,13 @@
 #
 ################################################################################
 
-import sys,os,subprocess,json,socket,re,codecs,math,time
+import sys,os,json,socket,re,codecs,math,time
 from collections import OrderedDict
 
 import requests
 
 from sibyl.lib.decorators import *
-from sibyl.lib.util import getcell,is_int
+from sibyl.lib.util import getcell,is_int,CecClient,CecError
 from sibyl.lib.protocol import Message
 import sibyl.lib.util as util
 
@@ -45,9 +45,18 @@ def conf(bot):
     {'name':'alias_file','default':'data/aliases.txt','valid':bot.conf.valid_wfile},
     {'name':'alias_depth','default':10,'parse':bot.conf.parse_int},
     {'name':'calc_scientific','default':False,'parse':bot.conf.parse_bool},
-    {'name':'calc_degrees','default':True,'parse':bot.conf.parse_bool}
+    {'name':'calc_degrees','default':True,'parse':bot.conf.parse_bool},
+    {'name':'cec_client','default':['cec-client'],'parse':parse_cec}
   ]
 
+def parse_cec(conf,opt,val):
+  """split the cec-client cmd into args"""
+
+  args = val.split()
+  if not args:
+    raise ValueError('cec_client cannot be empty')
+  return args
+
 @botinit
 def init(bot):
   """initialise config change tracking variable"""
@@ -56,12 +65,19 @@ def init(bot):
   bot.add_var('aliases',{})
   bot.add_var('alias_stack',[])
   bot.add_var('alias_exceeded',False)
+  bot.add_var('cec',CecClient(bot.opt('general.cec_client'),log))
   try:
     bot.aliases = alias_read(bot)
   except Exception as e:
     log.error('Failed to parse alias_file')
     log.debug(e.message)
 
+@botdown
+def down(bot):
+  """stop cec-client if we started it"""
+
+  bot.cec.stop()
+
 @botcmd
 def alias(bot,mess,args):
   """add aliases for cmds - alias (info|list|add|remove|show) [name] [cmd]"""
@@ -437,21 +453,15 @@ def tv(bot,mess,args):
   # sanitize args
   args = ''.join([s for s in args[0] if s.isalpha()])
 
-  PIPE = subprocess.PIPE
-  p = subprocess.Popen(['cec-client','-s'],stdin=PIPE,stdout=PIPE,stderr=PIPE)
-  (out,err) = p.communicate(args+' 0')
-
-  # do some basic error checking
-  if err:
-    return err
-  if 'connection opened' not in out:
-    return 'Unknown error'
-
-  # if the user requested power state, return that
-  if args=='pow':
-    for line in out.split('\n'):
-      if 'power status:' in line:
-        return line
+  # cec-client takes seconds to open the adapter, so we keep it running and
+  # only wait for a response if the user requested power state
+  expect = ('power status:' if args=='pow' else None)
+  try:
+    return bot.cec.send(args+' 0',expect)
+  except CecError as e:
+    return str(e)
+  except OSError as e:
+    return 'Unable to run cec-client (%s)' % e.strerror
 
 @botcmd
 def ups(bot,mess,args):
@@ -21,9 +21,11 @@
 #
 ################################################################################
 
-import os,sys,pickle,time,traceback,threading,Queue,multiprocessing
+import os,sys,re,pickle,time,traceback,threading,Queue,multiprocessing
+import select,struct,ctypes,ctypes.util,collections,itertools,mmap,array
+from multiprocessing.pool import ThreadPool
 
-# we import smbc in init(), find(), and rsamba() if needed
+# we import smbc in init(), find_samba(), and smb_context() if needed
 
 from sibyl.lib.decorators import *
 import sibyl.lib.util as util
@@ -32,13 +34,34 @@ from sibyl.lib.password import Password
 import logging
 log = logging.getLogger(__name__)
 
+# the library lists we maintain (each is stored in bot.lib_*)
+LISTS = ['audio_dir','audio_file','video_dir','video_file']
+
+# number of entries samba sub-processes collect before sending them
+SAMBA_BATCH = 1000
+
+# seconds commands wait for the library to finish loading before giving up
+WAIT = 2
+
+# library file layout: MAGIC, HEADER, a pickled dict of the small library vars
+# and section offsets, then a Table for each list and the dirs in lib_times,
+# plus an array of Times stamps for each Table of dirs
+MAGIC = 'SIBYLLIB'
+HEADER = struct.Struct('<II')   # (version,length of pickled dict)
+VERSION = 1
+
+# the default library.file, and the default from before we had our own format
+# (which is converted to the new default the first time we load)
+FILE = 'data/library.dat'
+OLD_FILE = 'data/library.pickle'
+
 @botconf
 def conf(bot):
   """add config options"""
 
   return [
     { 'name'    : 'file',
-      'default' : 'data/library.pickle',
+      'default' : FILE,
       'valid'   : bot.conf.valid_wfile
     },
     { 'name'    : 'max_matches',
@@ -59,6 +82,25 @@ def conf(bot):
       'default' : {},
       'parse'   : parse_remote,
       'valid'   : valid_remote
+    },
+    { 'name'    : 'update_freq',
+      'default' : 0,
+      'parse'   : bot.conf.parse_int,
+      'valid'   : bot.conf.valid_nump
+    },
+    { 'name'    : 'workers',
+      'default' : 4,
+      'parse'   : bot.conf.parse_int,
+      'valid'   : bot.conf.valid_nump
+    },
+    { 'name'    : 'watch',
+      'default' : False,
+      'parse'   : bot.conf.parse_bool
+    },
+    { 'name'    : 'cache',
+      'default' : 64,
+      'parse'   : bot.conf.parse_int,
+      'valid'   : bot.conf.valid_nump
     }
   ]
 
@@ -145,18 +187,22 @@ def init(bot):
   bot.add_var('lib_audio_file')
   bot.add_var('lib_video_dir')
   bot.add_var('lib_video_file')
+  bot.add_var('lib_index',{})
+  bot.add_var('lib_trie',{})
+  bot.add_var('lib_cache',Cache(bot.opt('library.cache')))
+  bot.add_var('lib_times',{'audio':{},'video':{}})
+  bot.add_var('lib_last_updated',0)
+  bot.add_var('lib_timings',[])
+  bot.add_var('lib_watcher')
+
+  bot.add_var('lib_ready',threading.Event())
+  bot.add_var('lib_status','starting')
 
   bot.add_var('lib_lock',threading.Lock())
+  bot.add_var('lib_index_lock',threading.Lock())
   bot.add_var('lib_last_op')
   bot.add_var('lib_pending_send',Queue.Queue())
 
-  if os.path.isfile(bot.opt('library.file')):
-    Library(bot,None,['load']).run()
-    #bot.run_cmd('library',['load'])
-  else:
-    Library(bot,None,['rebuild']).run()
-    #bot.run_cmd('library',['rebuild'])
-
   if util.has_module('smbc'):
     import smbc
 
@@ -174,6 +220,12 @@ def init(bot):
   else:
     log.warning("Can't find module smbc; network shares will be disabled")
 
+  # samba traversal above needs the smbc enums so load/rebuild after; do it in
+  # the background so protocols can connect while we read or walk the library
+  t = threading.Thread(target=warm_up,args=(bot,),name='library.warm_up')
+  t.daemon = True
+  t.start()
+
   # check for filename unicode support
   enc = sys.getfilesystemencoding()
   if enc!='UTF-8':
@@ -183,6 +235,72 @@ def init(bot):
         '#unicode-considerations')
     bot.error('Unicode file names not supported','library')
 
+# @param bot (SibylBot) the bot
+def warm_up(bot):
+  """load or rebuild the library, then start watching"""
+
+  # indexes and tries are built on first use so a loaded library stays mapped
+  # instead of decoding every path onto the heap
+  try:
+    if library_file(bot):
+      bot.lib_status = 'loading'
+      Library(bot,None,['load']).run()
+    else:
+      bot.lib_status = 'rebuilding'
+      Library(bot,None,['rebuild']).run()
+
+  except Exception as ex:
+    log.error('Error loading library')
+    full = traceback.format_exc(ex)
+    log.error('  %s' % full.split('\n')[-2])
+    log.debug(full)
+
+  finally:
+    bot.lib_status = 'ready'
+    bot.lib_ready.set()
+
+  # keep the library up to date using inotify if requested
+  if bot.opt('library.watch'):
+    try:
+      bot.lib_watcher = Watcher(bot)
+      bot.lib_watcher.start()
+    except Exception as e:
+      log.warning('Unable to watch library: %s' % e)
+      bot.error('Unable to watch library (see log)','library')
+
+@botdown
+def down(bot):
+  """stop the library watcher"""
+
+  if bot.lib_watcher:
+    bot.lib_watcher.finished = True
+
+# @param bot (SibylBot) the bot
+# @return (str,None) the library file to load, or None if there isn't one
+def library_file(bot):
+  """return library.file, or the old default if it hasn't been converted"""
+
+  fname = bot.opt('library.file')
+  if os.path.isfile(fname):
+    return fname
+  if fname==FILE and os.path.isfile(OLD_FILE):
+    return OLD_FILE
+  return None
+
+# @param timeout (float) [WAIT] seconds to wait for the library to load
+# @return (str,None) a reply explaining why the library isn't ready, or None
+@botfunc
+def library_ready(bot,timeout=WAIT):
+  """wait for the library to finish loading"""
+
+  if bot.lib_ready.wait(timeout):
+    return None
+
+  status = bot.lib_status
+  if status=='rebuilding' and bot.lib_last_rebuilt:
+    status += ' for %s' % util.sec2str(time.time()-bot.lib_last_rebuilt)
+  return 'Library is warming up (%s); try again in a bit' % status
+
 # @param path (str) the path to translate
 # @return (str) the translated path
 @botfunc
@@ -195,9 +313,93 @@ def library_translate(bot,path):
 
   return path
 
+# @param lib (str) the library list to search (e.g. 'video_dir')
+# @param args (list) search terms to include or -exclude
+# @param sort (bool) [True] whether to sort the result
+# @return (list) the matching paths
+@botfunc
+def library_matches(bot,lib,args,sort=True):
+  """search one of the library lists using its index"""
+
+  key = (lib,sort)+Cache.normalize(args)
+  generation = bot.lib_cache.generation
+  matches = bot.lib_cache.get(key)
+  if matches is None:
+    matches = util.matches(getattr(bot,'lib_'+lib),args,sort,get_index(bot,lib))
+    bot.lib_cache.put(key,matches,generation)
+
+  # callers are free to modify the list they get
+  return list(matches)
+
+# @param lib (str) the library list to query (e.g. 'video_file')
+# @param path (str,unicode) a library dir (ending in a separator)
+# @return (generator) every path in the list under the given dir
+@botfunc
+def library_files(bot,lib,path):
+  """return the entries of a library list under a directory"""
+
+  return get_trie(bot,lib).under(path)
+
+# @param bot (SibylBot) the bot
+# @param lib (str) the library list (e.g. 'video_dir')
+# @return (Index) the index for the list
+def get_index(bot,lib):
+  """return the index for a library list, building it on first use"""
+
+  return lazy(bot,'lib_index',lib,Index)
+
+# @param bot (SibylBot) the bot
+# @param lib (str) the library list (e.g. 'video_file')
+# @return (PathTrie) the trie for the list
+def get_trie(bot,lib):
+  """return the trie for a library list, building it on first use"""
+
+  return lazy(bot,'lib_trie',lib,util.PathTrie)
+
+# @param bot (SibylBot) the bot
+# @param name (str) the bot var holding a dict of {lib:structure}
+# @param lib (str) the library list (e.g. 'video_dir')
+# @param cls (class) the class to build from the list if it doesn't exist
+# @return (object) the structure for the list
+def lazy(bot,name,lib,cls):
+  """helper function for get_index() and get_trie()"""
+
+  obj = getattr(bot,name).get(lib)
+  if obj is not None:
+    return obj
+
+  # "library load" doesn't build anything so it doesn't have to read the lists;
+  # lib_lock is held for whole rebuilds so only wait for other builds/patches
+  with bot.lib_index_lock:
+    obj = getattr(bot,name).get(lib)
+    if obj is None:
+      start = time.time()
+      obj = cls(getattr(bot,'lib_'+lib))
+      getattr(bot,name)[lib] = obj
+      log.debug('Built %s for "%s" in %f sec'
+          % (cls.__name__,lib,time.time()-start))
+    return obj
+
+@botidle(freq=60,thread=True)
+def update_idle(bot):
+  """update the library every library.update_freq seconds"""
+
+  freq = bot.opt('library.update_freq')
+  if not freq or time.time()<bot.lib_last_updated+freq:
+    return
+
+  # warm_up() will load or rebuild it anyway
+  if not bot.lib_ready.is_set():
+    return
+
+  # don't pile up threads waiting on a rebuild or a chat cmd
+  if bot.lib_lock.locked():
+    return
+  Library(bot,None,['update']).run()
+
 @botcmd(thread=True)
 def library(bot,mess,args):
-  """control media library - library (info|load|rebuild|save|reload)"""
+  """control media library - library (info|load|rebuild|update|save|reload)"""
 
   # before botcmd had the threading option, I implemented library as a subclass
   # of threading.Thread and ran it; now that I'm using botcmd(thread=True),
@@ -208,15 +410,17 @@ def library(bot,mess,args):
 def search(bot,mess,args):
   """search all paths for matches - search [include -exclude]"""
 
+  msg = bot.library_ready()
+  if msg:
+    return msg
+
   if not args:
     args = ['/']
   matches = []
 
   # search all library paths
-  dirs = [bot.lib_video_dir,bot.lib_video_file,
-      bot.lib_audio_dir,bot.lib_audio_file]
-  for d in dirs:
-    matches.extend(util.matches(d,args))
+  for lib in ('video_dir','video_file','audio_dir','audio_file'):
+    matches.extend(bot.library_matches(lib,args))
 
   if len(matches)==0:
     return 'Found 0 matches'
@@ -231,106 +435,256 @@ def search(bot,mess,args):
 
   return 'Found '+str(len(matches))+' match: '+str(matches[0])
 
-def find(bot,dirs):
+# @param bot (SibylBot) the bot
+# @param libs (dict) {lib:dirs} with dirs from library.audio_dirs/video_dirs
+# @return (tuple of (dict,list)) {lib:(dirs,files,times,errors)} in the same
+#   order a serial traversal would give, and [(root,seconds)] for every root
+def find(bot,libs):
   """helper function for library()"""
 
-  paths = []
-  smbpaths = []
+  # every local root is split into its top-level sub-dirs and each samba share
+  # gets a process; all of that is run on a thread pool shared by all libs
+  pool = ThreadPool(max(1,bot.opt('library.workers')))
+  jobs = {}
+  for (lib,dirs) in libs.items():
 
-  # sort paths into local and samba based on whether they're tuples
-  for path in dirs:
-    if isinstance(path,dict):
-      smbpaths.append(path)
-    else:
-      paths.append(path)
+    # local paths come before samba shares (same as a serial traversal)
+    paths = [x for x in dirs if not isinstance(x,dict)]
+    smbpaths = [x for x in dirs if isinstance(x,dict)]
 
-  dirs = []
-  files = []
-  errors = []
+    jobs[lib] = []
+    for path in paths:
+      path = unicode(path)
+      try:
+        (top,subdirs,files) = toplevel(path)
+        tasks = [pool.apply_async(timed,(rlocal,os.path.join(path,d)))
+            for d in subdirs]
+        jobs[lib].append((path,(top,subdirs,files),tasks))
+      except Exception as e:
+        msg = ('Unable to traverse "%s": %s' %
+            (path,traceback.format_exc(e).split('\n')[-2]))
+        jobs[lib].append((path,msg,[]))
+
+    for path in smbpaths:
+      share = 'smb://'+path['server']+'/'+path['share']
+      tasks = [pool.apply_async(timed,(find_samba,bot,path))]
+      jobs[lib].append((share,None,tasks))
 
-  # find all matching directories or files depending on fd parameter
-  for path in paths:
-    try:
-      (temp_dirs,temp_files) = util.rlistdir(unicode(path))
-      dirs.extend(temp_dirs)
-      files.extend(temp_files)
-    except Exception as e:
-      msg = ('Unable to traverse "%s": %s' %
-          (path,traceback.format_exc(e).split('\n')[-2]))
-      errors.append((path,msg))
+  pool.close()
 
-  if smbpaths:
-    import smbc
+  # merge the results in order as they complete
+  result = {}
+  timings = []
+  for (lib,roots) in jobs.items():
+    (dirs,files,times,errors) = ([],[],{},[])
+    for (root,top,tasks) in roots:
 
-  # same as above but for samba shares
-  for path in smbpaths:
-    temp_dirs = []
-    temp_files = []
+      if isinstance(top,basestring):
+        errors.append((root,top))
+        continue
 
+      if top:
+        (path,subdirs,top_files) = top
+        dirs.extend([os.path.join(path,d)+os.path.sep for d in subdirs])
+        files.extend([os.path.join(path,f) for f in top_files])
+        try:
+          times[os.path.join(path,'')] = LocalWalker().stat(path)
+        except OSError:
+          pass
+
+      (first,last) = (time.time(),0)
+      for task in tasks:
+        try:
+          (temp,start,stop) = task.get()
+          (first,last) = (min(first,start),max(last,stop))
+          dirs.extend(temp[0])
+          files.extend(temp[1])
+          times.update(temp[2])
+        except Exception as e:
+          msg = ('Unable to traverse "%s": %s' %
+              (root,traceback.format_exc(e).split('\n')[-2]))
+          errors.append((root,msg))
+          break
+      timings.append((root,max(0,last-first)))
+
+    result[lib] = (dirs,files,times,errors)
+
+  pool.join()
+  return (result,timings)
+
+# @param path (unicode) a local directory
+# @return (tuple of (unicode,list,list)) the (path,dir_names,file_names)
+def toplevel(path):
+  """list the top level of a local path the same way os.walk does"""
+
+  # rlistdir() silently returns nothing for invalid paths, so we do too
+  for step in os.walk(path,followlinks=True):
+    return step
+  return (path,[],[])
+
+# @param func (function) the function to call
+# @return (tuple of (object,float,float)) the (result,start,stop) of the call
+def timed(func,*args):
+  """call func(*args) and record when it started and stopped"""
+
+  start = time.time()
+  result = func(*args)
+  return (result,start,time.time())
+
+# @param path (unicode) a local directory
+# @return (tuple of (list,list,dict)) the (dirs,files,times) under path
+def rlocal(path):
+  """recursively list a local directory and stat its sub-dirs"""
+
+  (dirs,files) = util.rlistdir(path)
+
+  # remember directory times so "library update" can skip unchanged ones
+  times = {}
+  walker = LocalWalker()
+  for d in [os.path.join(path,'')]+dirs:
     try:
-      share = 'smb://'+path['server']+'/'+path['share']
-      smb = smbc.Context()
-      if path['username']:
-        pword = path['password'] and path['password'].get()
-        smb.functionAuthData = (lambda se,sh,w,u,p:
-            (w,path['username'],pword))
-
-      smb.opendir(share[:share.rfind('/')])
-      ignore = [smbc.PermissionError]
-
-      # even though we're just doing blocking I/O, threading isn't enough
-      # we need sub-processes via multiprocessing for samba shares
-      # because pysmbc doesn't release the GIL so it still blocks in threads
-      log.debug('Starting new process for "%s"' % share)
-      q = multiprocessing.Queue()
-      e = multiprocessing.Queue()
-      args = (bot.smbc_dir,bot.smbc_file,q,e,smb,share,ignore)
-      p = multiprocessing.Process(target=rsamba,args=args)
-      p.start()
+      times[d] = walker.stat(d)
+    except OSError:
+      pass
 
-      # we're using a Queue for message passing
-      while p.is_alive() or not q.empty():
-        while not q.empty():
-          (typ,name) = q.get()
-          if typ==bot.smbc_dir:
-            temp_dirs.append(unicode(name))
-          elif typ==bot.smbc_file:
-            temp_files.append(unicode(name))
-        time.sleep(0.1)
-
-      # the child process also reports errors using a Queue
-      log.debug('Process done with%s errors' % ('out' if e.empty() else ''))
-      if e.empty():
-        dirs.extend(temp_dirs)
-        files.extend(temp_files)
-      else:
-        raise e.get()
+  return (dirs,files,times)
+
+# @param bot (SibylBot) the bot
+# @param path (dict) a samba share from library.audio_dirs or video_dirs
+# @return (tuple of (list,list,dict)) the (dirs,files,times) on the share
+def find_samba(bot,path):
+  """recursively list a samba share using a pool of sub-processes"""
+
+  import smbc
+
+  (share,smb) = smb_context(path)
+  times = {share+'/':SambaWalker.stamp(smb.stat(share))}
+  ignore = [smbc.PermissionError]
+
+  # list the top level here and hand each sub-dir to the pool
+  top = []
+  subdirs = []
+  rsamba(bot.smbc_dir,bot.smbc_file,top.append,smb,share,recurse=False)
+  # rsamba() gives us unicode but expects to be called with utf8 paths
+  for (typ,name,stamp) in top:
+    if typ==bot.smbc_dir:
+      subdirs.append(name.rstrip('/').encode('utf8'))
+
+  # even though we're just doing blocking I/O, threading isn't enough
+  # we need sub-processes via multiprocessing for samba shares
+  # because pysmbc doesn't release the GIL so it still blocks in threads
+  tasks = multiprocessing.Queue()
+  results = multiprocessing.Queue()
+  for task in enumerate(subdirs):
+    tasks.put(task)
+  n = min(max(1,bot.opt('library.workers')),len(subdirs))
+  for i in range(n):
+    tasks.put(None)
+
+  log.debug('Starting %s processes for "%s"' % (n,share))
+  args = (bot.smbc_dir,bot.smbc_file,path,tasks,results,ignore)
+  procs = [multiprocessing.Process(target=samba_worker,args=args)
+      for i in range(n)]
+  for p in procs:
+    p.start()
+
+  # block on the queue; workers send batches and then (i,[],True,error)
+  parts = [[] for d in subdirs]
+  pending = len(subdirs)
+  try:
+    while pending:
+      try:
+        (i,entries,done,error) = results.get(timeout=1)
+      except Queue.Empty:
+        if not any([p.is_alive() for p in procs]):
+          raise RuntimeError('Samba process for "%s" died' % share)
+        continue
+      if error:
+        raise error
+      parts[i].extend(entries)
+      pending -= int(done)
+  finally:
+    for p in procs:
+      if pending:
+        p.terminate()
+      p.join()
+  log.debug('Processes for "%s" done' % share)
+
+  # merge in the order a serial traversal would have found things
+  (dirs,files) = ([],[])
+  subdirs = iter(parts)
+  for entry in top:
+    for (typ,name,stamp) in ([entry]+
+        (next(subdirs) if entry[0]==bot.smbc_dir else [])):
+      if typ==bot.smbc_dir:
+        dirs.append(unicode(name))
+        times[unicode(name)] = stamp
+      elif typ==bot.smbc_file:
+        files.append(unicode(name))
+
+  return (dirs,files,times)
 
+# @param smbc_dir (int) the smbc directory enum
+# @param smbc_file (int) the smbc file enum
+# @param path (dict) a samba share from library.audio_dirs or video_dirs
+# @param tasks (Queue) (i,dir) to list recursively, or None to stop
+# @param results (Queue) the queue to put (i,entries,done,error) on
+# @param ignore (list) exceptions to ignore (must derive from Exception)
+def samba_worker(smbc_dir,smbc_file,path,tasks,results,ignore):
+  """list directories from a queue in a sub-process with its own Context"""
+
+  try:
+    (share,ctx) = smb_context(path)
+  except Exception as ex:
+    results.put((None,[],True,ex))
+    return
+
+  for (i,d) in iter(tasks.get,None):
+    batch = []
+
+    # send entries in batches rather than paying for IPC on every one
+    def send(entry):
+      batch.append(entry)
+      if len(batch)>=SAMBA_BATCH:
+        results.put((i,list(batch),False,None))
+        del batch[:]
+
+    error = None
+    try:
+      rsamba(smbc_dir,smbc_file,send,ctx,d,ignore)
     except Exception as ex:
-      msg = ('Unable to traverse "%s": %s' %
-          (share,traceback.format_exc(ex).split('\n')[-2]))
-      errors.append((share,msg))
+      if not any([isinstance(ex,x) for x in ignore]):
+        error = ex
+    results.put((i,batch,True,error))
+
+# @param path (dict) a samba share from library.audio_dirs or video_dirs
+# @return (tuple of (str,Context)) the share URL and an authenticated Context
+def smb_context(path):
+  """create a Context for the given samba share"""
 
-  return (dirs,files,errors)
+  import smbc
+
+  share = 'smb://'+path['server']+'/'+path['share']
+  smb = smbc.Context()
+  if path['username']:
+    pword = path['password'] and path['password'].get()
+    smb.functionAuthData = (lambda se,sh,w,u,p:
+        (w,path['username'],pword))
+
+  smb.opendir(share[:share.rfind('/')])
+  return (share,smb)
 
 # @param smbc_dir (int) the smbc directory enum
 # @param smbc_file (int) the smbc file enum
-# @param q (Queue) the queue to add entries
-# @param e (Queue) the queue to add errors
+# @param out (function) called with (typ,name,stamp) for every entry
 # @param ctx (Context) the smbc Context (already authenticated if needed)
 # @param path (str) a samba directory
-# @param typ (long) the smbc type to return, or all types if None
-# @param ignore (list) exceptions to ignore (must derive from Exception)
-# @return tuple(list,list) all (dirs,files) in the given path (recursive)
-def rsamba(smbc_dir,smbc_file,q,e,ctx,path,ignore=None):
+# @param ignore (list) exceptions to ignore in sub-dirs (derived from Exception)
+# @param recurse (bool) [True] list sub-dirs too
+def rsamba(smbc_dir,smbc_file,out,ctx,path,ignore=None,recurse=True):
   """recursively list directories"""
 
-  import smbc
-
   ignore = (ignore or [])
-  allitems = []
-  if isinstance(path,unicode):
-    path.encode('utf8')
   d = ctx.opendir(path)
   contents = d.getdents()
 
@@ -339,25 +693,300 @@ def rsamba(smbc_dir,smbc_file,q,e,ctx,path,ignore=None):
 
     # handle files
     if c.smbc_type==smbc_file:
-      q.put((smbc_file,cur_path.decode('utf8')))
+      out((smbc_file,cur_path.decode('utf8'),None))
 
     # handle directories
     elif c.smbc_type==smbc_dir:
       if c.name in ('.','..'):
         continue
-      q.put((smbc_dir,(cur_path+'/').decode('utf8')))
       try:
-        if not rsamba(smbc_dir,smbc_file,q,e,ctx,cur_path,ignore):
-          return False
+        stamp = SambaWalker.stamp(ctx.stat(cur_path))
+      except Exception:
+        stamp = None
+      out((smbc_dir,(cur_path+'/').decode('utf8'),stamp))
+      if not recurse:
+        continue
+      try:
+        rsamba(smbc_dir,smbc_file,out,ctx,cur_path,ignore)
       except Exception as ex:
-        ignored = False
-        for i in ignore:
-          ignored = (ignored or isinstance(ex,i))
-        if not ignored:
-          e.put(ex)
-          return False
+        if not any([isinstance(ex,x) for x in ignore]):
+          raise
+
+# @param bot (SibylBot) the bot
+# @param dirs (list) paths and samba shares from library.audio_dirs/video_dirs
+# @param lib_dirs (list) directories currently in the library
+# @param lib_files (list) files currently in the library
+# @param times (dict) {dir:stamp} recorded the last time we listed each dir
+# @return (tuple of (tuple,list)) the changes (added_dirs,added_files,
+#   removed_dirs,removed_files,times) and a list of errors
+def find_changes(bot,dirs,lib_dirs,lib_files,times):
+  """helper function for Library.update()"""
+
+  # map every known directory to the dirs and files directly inside it
+  children = {}
+  for d in lib_dirs:
+    children.setdefault(parent(d),(set(),set()))[0].add(d)
+  for f in lib_files:
+    children.setdefault(parent(f),(set(),set()))[1].add(f)
+
+  # list each root on the thread pool, but merge the results in order
+  pool = ThreadPool(max(1,bot.opt('library.workers')))
+  results = pool.map(lambda x: root_changes(bot,x,children,times),dirs)
+  pool.close()
+  pool.join()
+
+  changes = ([],[],[],[],{})
+  errors = []
+  for (result,error) in results:
+    if error:
+      errors.append(error)
+    for (total,new) in zip(changes,result):
+      if isinstance(total,list):
+        total.extend(new)
+      else:
+        total.update(new)
 
-  return True
+  return (changes,errors)
+
+# @param bot (SibylBot) the bot
+# @param path (str,dict) a path or share from library.audio_dirs/video_dirs
+# @param children (dict) see rchanges()
+# @param times (dict) see rchanges()
+# @return (tuple of (tuple,tuple)) the result of rchanges() and (root,error)
+#   if there was an error, otherwise None
+def root_changes(bot,path,children,times):
+  """helper function for find_changes()"""
+
+  if isinstance(path,dict):
+    root = 'smb://'+path['server']+'/'+path['share']+'/'
+  else:
+    root = os.path.join(unicode(path),'')
+
+  try:
+    if isinstance(path,dict):
+      (share,smb) = smb_context(path)
+      walker = SambaWalker(smb,bot.smbc_dir,bot.smbc_file)
+
+      # pysmbc doesn't release the GIL so list shares in a sub-process
+      log.debug('Starting new process for "%s"' % share)
+      q = multiprocessing.Queue()
+      args = (q,walker,root,children,times)
+      p = multiprocessing.Process(target=rchanges_proc,args=args)
+      p.start()
+      (success,result) = q.get()
+      p.join()
+      if not success:
+        raise result
+      return (result,None)
+
+    return (rchanges(LocalWalker(),root,children,times),None)
+
+  except Exception as ex:
+    msg = ('Unable to traverse "%s": %s' %
+        (root,traceback.format_exc(ex).split('\n')[-2]))
+
+    # keep the old times so we can still skip unchanged dirs next time
+    old = {d:stamp for (d,stamp) in times.items() if d.startswith(root)}
+    return (([],[],[],[],old),(root,msg))
+
+# @param q (Queue) the queue to put (success,result) on
+# @param walker (SambaWalker) the walker to use
+# @param root (str) the share to update (ending in "/")
+# @param children (dict) see rchanges()
+# @param times (dict) see rchanges()
+def rchanges_proc(q,walker,root,children,times):
+  """run rchanges() in a sub-process and report the result"""
+
+  try:
+    q.put((True,rchanges(walker,root,children,times)))
+  except Exception as ex:
+    q.put((False,ex))
+
+# @param walker (LocalWalker,SambaWalker) used to stat and list directories
+# @param root (str,unicode) the directory to update (ending in a separator)
+# @param children (dict) {dir:(set of dirs,set of files)} directly in each dir
+# @param times (dict) {dir:stamp} recorded the last time we listed each dir
+# @return (tuple of (list,list,list,list,dict)) the (added_dirs,added_files,
+#   removed_dirs,removed_files,times) where times is for every dir under root
+def rchanges(walker,root,children,times):
+  """find changes under root, only listing directories whose stamp changed"""
+
+  (added_dirs,added_files,removed_dirs,removed_files) = ([],[],[],[])
+  new_times = {}
+
+  stack = [root]
+  while stack:
+    d = stack.pop()
+    try:
+      stamp = walker.stat(d)
+    except Exception:
+      if d==root:
+        raise
+      continue
+    new_times[d] = stamp
+
+    # the contents of an unchanged directory are what we already have
+    (old_dirs,old_files) = children.get(d,(set(),set()))
+    if times.get(d)==stamp:
+      stack.extend(old_dirs)
+      continue
+
+    (new_dirs,new_files) = walker.listdir(d)
+    added_files.extend(new_files-old_files)
+    removed_files.extend(old_files-new_files)
+    added_dirs.extend(new_dirs-old_dirs)
+
+    # everything under a deleted dir is gone
+    for x in old_dirs-new_dirs:
+      sub = [x]
+      while sub:
+        y = sub.pop()
+        removed_dirs.append(y)
+        (ds,fs) = children.get(y,((),()))
+        removed_files.extend(fs)
+        sub.extend(ds)
+
+    # new dirs have no children or times so they'll be listed completely
+    stack.extend(new_dirs)
+
+  return (added_dirs,added_files,removed_dirs,removed_files,new_times)
+
+# @param path (str,unicode) a library dir (ending in a separator) or file
+# @return (str,unicode) the directory containing path (ending in a separator)
+def parent(path):
+  """return the parent of a library path"""
+
+  sep = ('/' if path.startswith('smb://') else os.path.sep)
+  return path[:path.rstrip(sep).rfind(sep)+1]
+
+# @param fname (str) the library file to write
+# @param d (dict) the library vars to save (see Library.save())
+def write_library(fname,d):
+  """write the library to disk in our binary format"""
+
+  sections = []
+  for lib in LISTS:
+    sections.append((lib,Table.pack(sorted(
+        [Table.encode(x) for x in d['lib_'+lib]]))))
+
+  # directory times are stored as a table of dirs and an array of stamps
+  for (lib,times) in d['lib_times'].items():
+    items = sorted([(Table.encode(k),v) for (k,v) in times.items()])
+    sections.append((lib+'_times',Table.pack([k for (k,v) in items])))
+    sections.append((lib+'_stamps',''.join([Times.pack(v)
+        for (k,v) in items])))
+
+  offsets = {}
+  pos = 0
+  for (name,data) in sections:
+    offsets[name] = pos
+    pos += len(data)
+
+  header = {k:v for (k,v) in d.items()
+      if k not in ['lib_'+x for x in LISTS+['times']]}
+  header['sections'] = offsets
+  header = pickle.dumps(header,-1)
+
+  # write to a new file because the old one might still be mapped
+  tmp = fname+'.tmp'
+  with open(tmp,'wb') as f:
+    f.write(MAGIC+HEADER.pack(VERSION,len(header))+header)
+    for (name,data) in sections:
+      f.write(data)
+  try:
+    os.rename(tmp,fname)
+  except OSError:
+    os.remove(fname)
+    os.rename(tmp,fname)
+
+# @param fname (str) the library file to read
+# @return (dict,None) the library vars (see Library.save()) or None if fname
+#   isn't in our binary format
+def read_library(fname):
+  """map a library file written by write_library()"""
+
+  with open(fname,'rb') as f:
+    if f.read(len(MAGIC))!=MAGIC:
+      return None
+    buf = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+
+  (version,n) = HEADER.unpack_from(buf,len(MAGIC))
+  if version!=VERSION:
+    raise ValueError('Unsupported library version %s' % version)
+
+  start = len(MAGIC)+HEADER.size
+  d = pickle.loads(buf[start:start+n])
+  sections = {k:v+start+n for (k,v) in d.pop('sections').items()}
+
+  for lib in LISTS:
+    d['lib_'+lib] = Table(buf,sections[lib])
+  d['lib_times'] = {lib:Times(buf,sections[lib+'_times'],
+      sections[lib+'_stamps'])
+      for lib in ('audio','video') if lib+'_times' in sections}
+
+  return d
+
+################################################################################
+# Walker classes
+################################################################################
+
+class LocalWalker(object):
+  """stat and list local directories"""
+
+  # @param path (unicode) a directory
+  # @return (tuple) the directory's (mtime,ctime)
+  def stat(self,path):
+    st = os.stat(path)
+    return (st.st_mtime,st.st_ctime)
+
+  # @param path (unicode) a directory ending in a separator
+  # @return (tuple of (set,set)) the (dirs,files) directly inside path
+  def listdir(self,path):
+    (dirs,files) = (set(),set())
+    for name in os.listdir(path):
+      full = os.path.join(path,name)
+      if os.path.isdir(full):
+        dirs.add(os.path.join(full,''))
+      else:
+        files.add(full)
+    return (dirs,files)
+
+class SambaWalker(object):
+  """stat and list directories on a samba share"""
+
+  # @param ctx (Context) the smbc Context (already authenticated if needed)
+  # @param smbc_dir (int) the smbc directory enum
+  # @param smbc_file (int) the smbc file enum
+  def __init__(self,ctx,smbc_dir,smbc_file):
+    self.ctx = ctx
+    self.smbc_dir = smbc_dir
+    self.smbc_file = smbc_file
+
+  # @param st (tuple) the result of Context.stat()
+  # @return (tuple) the (mtime,ctime)
+  @staticmethod
+  def stamp(st):
+    return (st[8],st[9])
+
+  # @param path (unicode) a directory
+  # @return (tuple) the directory's (mtime,ctime)
+  def stat(self,path):
+    return self.stamp(self.ctx.stat(path.rstrip('/').encode('utf8')))
+
+  # @param path (unicode) a directory ending in "/"
+  # @return (tuple of (set,set)) the (dirs,files) directly inside path
+  def listdir(self,path):
+    (dirs,files) = (set(),set())
+    d = self.ctx.opendir(path.rstrip('/').encode('utf8'))
+    for c in d.getdents():
+      if c.name in ('.','..'):
+        continue
+      full = path+c.name
+      if c.smbc_type==self.smbc_dir:
+        dirs.add(full+'/')
+      elif c.smbc_type==self.smbc_file:
+        files.add(full)
+    return (dirs,files)
 
 ################################################################################
 # LibraryThread class
@@ -389,7 +1018,8 @@ class Library(object):
     try:
 
       if self.args:
-        if self.args[0] not in ('load','save','rebuild','info','reload'):
+        if self.args[0] not in ('load','save','rebuild','update','info',
+            'reload'):
           self.send('Unknown option "%s"' % self.args[0])
           return
       else:
@@ -420,34 +1050,53 @@ class Library(object):
       self.bot.send(text,self.mess.get_from())
 
   def load(self):
-    """read the library from a pickle and load it into sibyl"""
+    """map the library file and load it into sibyl"""
 
+    fname = (library_file(self.bot) or self.bot.opt('library.file'))
     start = time.time()
-    with open(self.bot.opt('library.file'),'rb') as f:
-      d = pickle.load(f)
+    d = read_library(fname)
+
+    # convert library files from before we had our own format
+    migrate = (d is None or fname!=self.bot.opt('library.file'))
+    if migrate:
+      with open(fname,'rb') as f:
+        d = pickle.load(f)
     stop = time.time()
 
-    names = ['lib_last_rebuilt','lib_last_elapsed',
-        'lib_video_dir','lib_video_file','lib_audio_dir','lib_audio_file']
-    for name in names:
-      setattr(self.bot,name,d[name])
+    # indexes are built on first use so we don't read every path right now
+    with self.bot.lib_index_lock:
+      names = ['lib_last_rebuilt','lib_last_elapsed',
+          'lib_video_dir','lib_video_file','lib_audio_dir','lib_audio_file']
+      for name in names:
+        setattr(self.bot,name,d[name])
+      self.bot.lib_index = {}
+      self.bot.lib_trie = {}
+      self.bot.lib_cache.bump()
+
+    # older library files didn't store directory times or timings
+    self.bot.lib_times = d.get('lib_times',{'audio':{},'video':{}})
+    self.bot.lib_timings = d.get('lib_timings',[])
 
     n = len(self.bot.lib_audio_file)+len(self.bot.lib_video_file)
     s = ('Library loaded from "%s" with %s files in %f sec' %
-        (self.bot.opt('library.file'),n,stop-start))
+        (fname,n,stop-start))
     log.info(s)
 
+    if migrate:
+      log.info('Converting library to version %s format in "%s"'
+          % (VERSION,self.bot.opt('library.file')))
+      self.save()
+
     return s
 
   def save(self):
-    """save sibyl's library to a pickle"""
+    """save sibyl's library to disk"""
 
-    names = ['lib_last_rebuilt','lib_last_elapsed',
+    names = ['lib_last_rebuilt','lib_last_elapsed','lib_times','lib_timings',
         'lib_video_dir','lib_video_file','lib_audio_dir','lib_audio_file']
     d = {name:getattr(self.bot,name) for name in names}
 
-    with open(self.bot.opt('library.file'),'wb') as f:
-      pickle.dump(d,f,-1)
+    write_library(self.bot.opt('library.file'),d)
 
     s = 'Library saved to "%s"' % self.bot.opt('library.file')
     log.info(s)
@@ -466,15 +1115,21 @@ class Library(object):
 
     # update library vars and log errors
     errors = []
+    libs = {lib:self.bot.opt('library.%s_dirs' % lib)
+        for lib in ('audio','video')}
+    (result,self.bot.lib_timings) = find(self.bot,libs)
+    lists = {}
     for lib in ('audio','video'):
-      (dirs,files,errs) = find(self.bot,self.bot.opt('library.%s_dirs' % lib))
-      setattr(self.bot,'lib_%s_dir' % lib,dirs)
-      setattr(self.bot,'lib_%s_file' % lib,files)
+      (dirs,files,times,errs) = result[lib]
+      lists[lib+'_dir'] = dirs
+      lists[lib+'_file'] = files
+      self.bot.lib_times[lib] = times
       for e in errs:
         if e not in errors:
           log.error(e[1])
           errors.append(e)
 
+    self.build_index(lists)
     self.bot.lib_last_elapsed = int(time.time()-start)
     result = self.save()
 
@@ -485,6 +1140,117 @@ class Library(object):
 
     return s
 
+  def update(self):
+    """update the library by only listing changed directories then save it"""
+
+    start = time.time()
+    self.bot.lib_last_updated = start
+
+    # patch the existing lists (and their indexes) in place
+    (added,removed) = (0,0)
+    errors = []
+    for lib in ('audio','video'):
+      ((new_dirs,new_files,old_dirs,old_files,times),errs) = find_changes(
+          self.bot,self.bot.opt('library.%s_dirs' % lib),
+          getattr(self.bot,'lib_%s_dir' % lib),
+          getattr(self.bot,'lib_%s_file' % lib),
+          self.bot.lib_times.get(lib,{}))
+
+      self.patch(lib+'_dir',new_dirs,old_dirs)
+      self.patch(lib+'_file',new_files,old_files)
+      self.bot.lib_times[lib] = times
+      added += len(new_files)
+      removed += len(old_files)
+
+      for e in errs:
+        if e not in errors:
+          log.error(e[1])
+          errors.append(e)
+
+    if added or removed:
+      self.save()
+
+    s = ('Library updated in %s with %s new and %s removed files'
+        % (util.sec2str(time.time()-start),added,removed))
+    log.info(s)
+    if errors:
+      s += ' with errors (see log): '+str([x[0] for x in errors])
+
+    return s
+
+  # @param lib (str) the library list to patch (e.g. 'video_dir')
+  # @param added (list) paths to add
+  # @param removed (list) paths to remove
+  def patch(self,lib,added,removed):
+    """add and remove entries from a library list, its index, and its trie"""
+
+    if not (added or removed):
+      return
+
+    # searches build indexes under lib_index_lock so they never see half a patch
+    with self.bot.lib_index_lock:
+      self.patch_locked(lib,added,removed)
+
+  # @param lib (str) the library list to patch (e.g. 'video_dir')
+  # @param added (list) paths to add
+  # @param removed (list) paths to remove
+  def patch_locked(self,lib,added,removed):
+    """helper function for patch() (hold lib_index_lock)"""
+
+    self.bot.lib_cache.bump()
+
+    # lists loaded from disk are read-only views, so copy them on first write
+    entries = getattr(self.bot,'lib_'+lib)
+    if not isinstance(entries,list):
+      entries = list(entries)
+      setattr(self.bot,'lib_'+lib,entries)
+
+    index = self.bot.lib_index.get(lib)
+    built = [x for x in (index,self.bot.lib_trie.get(lib)) if x is not None]
+
+    # a path that was deleted and then created again should stay, so there's
+    # no need to remove it and add it back
+    removed = set(removed)
+    both = removed.intersection(added)
+    removed -= both
+
+    if removed:
+      entries[:] = [x for x in entries if x not in removed]
+      for obj in built:
+        for x in removed:
+          obj.remove(x)
+
+    # only add what isn't already there (now that removals are done)
+    present = (index if index is not None else set(entries))
+    added = [x for x in collections.OrderedDict.fromkeys(added)
+        if x not in present]
+    entries.extend(added)
+    for obj in built:
+      for x in added:
+        obj.add(x)
+
+    # the watcher only re-reads the lists when they're replaced
+    if lib.endswith('_dir') and self.bot.lib_watcher and (added or removed):
+      self.bot.lib_watcher.changed(lib[:-4],added,list(removed))
+
+  # @param lists (dict) {lib:entries} the new library lists
+  def build_index(self,lists):
+    """index new library lists and then swap them in"""
+
+    # build outside lib_index_lock so searches keep using the old lists
+    start = time.time()
+    index = {lib:Index(lists[lib]) for lib in LISTS}
+    log.debug('Indexed library in %f sec' % (time.time()-start))
+
+    with self.bot.lib_index_lock:
+      for lib in LISTS:
+        setattr(self.bot,'lib_'+lib,lists[lib])
+      self.bot.lib_index = index
+      self.bot.lib_cache.bump()
+
+      # tries are only built (by get_trie()) if something asks for them
+      self.bot.lib_trie = {}
+
   def info(self):
     """give some info"""
 
@@ -493,8 +1259,21 @@ class Library(object):
     s += str(int(t-60*int(t/60))).zfill(2)
     n = len(self.bot.lib_audio_file)+len(self.bot.lib_video_file)
     t = time.asctime(time.localtime(self.bot.lib_last_rebuilt))
+    s = 'Rebuilt on %s in %s with %s files' % (t,s,n)
+
+    # roots are traversed in parallel so list how long each one took
+    if self.bot.lib_timings:
+      s += ' (%s)' % ', '.join(['%s %s' % (root,util.sec2str(secs))
+          for (root,secs) in self.bot.lib_timings])
+
+    cache = self.bot.lib_cache
+    if cache.size<1:
+      s += '; search cache disabled'
+    else:
+      s += ('; search cache %s/%s with %s hits and %s misses'
+          % (len(cache),cache.size,cache.hits,cache.misses))
 
-    return 'Rebuilt on %s in %s with %s files' % (t,s,n)
+    return s
 
   def reload(self):
     """reload search paths from the config file"""
@@ -506,4 +1285,816 @@ class Library(object):
       result = self.bot.run_cmd('config',['reload','library.%s_dirs' % opt])
       self.send(result)
 
-    return 'NOTE: run "library rebuild" to index new directories'
+    return ('NOTE: run "library update" to index new directories or '
+        '"library rebuild" to drop removed ones')
+
+################################################################################
+# Index class
+################################################################################
+
+class Index(object):
+  """token index over a library list to avoid checking every entry"""
+
+  # we index the alphanumeric "words" in each path, then index the trigrams
+  # in each word, so a search term is resolved to words and then to entries
+  TOKEN = re.compile(r'\w+',re.UNICODE)
+  GRAM = 3
+
+  # re-rank everything in xbmc order once this many entries are unranked
+  RERANK = 1000
+
+  # @param entries (list) [None] paths to add to the index (in order)
+  def __init__(self,entries=None):
+
+    self.entries = []     # id -> path (None for removed entries)
+    self.ids = {}         # path -> id
+    self.postings = {}    # word -> set of ids
+    self.grams = {}       # trigram -> set of words
+    self.rank = None      # id -> position in xbmc order (for ranked ids)
+
+    for entry in (entries or []):
+      self.add(entry)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __contains__(self,path):
+    return path in self.ids
+
+  # @param path (str,unicode) the path to index
+  def add(self,path):
+    """add a path to the index"""
+
+    if path in self.ids:
+      return
+
+    i = len(self.entries)
+    self.entries.append(path)
+    self.ids[path] = i
+
+    for word in self.words(path):
+      if word not in self.postings:
+        self.postings[word] = set()
+        for gram in self.trigrams(word):
+          self.grams.setdefault(gram,set()).add(word)
+      self.postings[word].add(i)
+
+  # @param path (str,unicode) the path to remove from the index
+  def remove(self,path):
+    """remove a path from the index"""
+
+    i = self.ids.pop(path,None)
+    if i is None:
+      return
+    self.entries[i] = None
+
+    for word in self.words(path):
+      ids = self.postings[word]
+      ids.discard(i)
+      if not ids:
+        del self.postings[word]
+        for gram in self.trigrams(word):
+          self.grams[gram].discard(word)
+          if not self.grams[gram]:
+            del self.grams[gram]
+
+  # @param args (list) search terms to include or -exclude
+  # @param sort (bool) [False] return xbmc order instead of the order added
+  # @return (list) matching paths
+  def search(self,args,sort=False):
+    """return entries matching util.checkall(args) without checking all"""
+
+    # util.checkall() raises on an empty term, so the old scan matched nothing
+    if '' in args:
+      return []
+
+    include = [x for x in args if x and x[0]!='-']
+    exclude = [x[1:] for x in args if len(x)>1 and x[0]=='-']
+    verify = []
+
+    # intersect the entries that could contain every include term
+    ids = None
+    for term in include:
+      (found,exact) = self.lookup(term)
+      ids = (set(found) if ids is None else ids & found)
+      if not exact:
+        verify.append(term)
+      if not ids:
+        return []
+    if ids is None:
+      ids = set(self.ids.values())
+
+    # subtract exclude terms only if we know exactly which entries contain them
+    for term in exclude:
+      (found,exact) = self.lookup(term)
+      if exact:
+        ids -= found
+      else:
+        verify.append('-'+term)
+
+    matches = [self.entries[i] for i in self.order(ids,sort)]
+    if not verify:
+      return matches
+
+    # terms spanning multiple words only narrowed the search, so check them
+    result = []
+    for entry in matches:
+      try:
+        if util.checkall(verify,entry):
+          result.append(entry)
+      except:
+        pass
+    return result
+
+  # @param ids (set) the ids to order
+  # @param sort (bool) whether to use xbmc order rather than id order
+  # @return (list) the ordered ids
+  def order(self,ids,sort):
+    """order ids using the pre-computed xbmc ranks if possible"""
+
+    if not sort:
+      return sorted(ids)
+
+    if self.rank is None or len(self.entries)-len(self.rank)>self.RERANK:
+      self.rerank()
+
+    # entries added since the last rerank have to be sorted the slow way
+    rank = self.rank
+    if any(i>=len(rank) for i in ids):
+      return sorted(ids,key=lambda i:util.xbmc_key(self.entries[i]))
+    return sorted(ids,key=rank.__getitem__)
+
+  def rerank(self):
+    """sort every entry in xbmc order and remember each position"""
+
+    start = time.time()
+    ids = [i for (i,x) in enumerate(self.entries) if x is not None]
+    ids.sort(key=lambda i:util.xbmc_key(self.entries[i]))
+
+    rank = array.array('l',[0])*len(self.entries)
+    for (pos,i) in enumerate(ids):
+      rank[i] = pos
+    self.rank = rank
+    log.debug('Ranked %s entries in %f sec' % (len(ids),time.time()-start))
+
+  # @param term (str,unicode) a single search term (without "-")
+  # @return (tuple of (set,bool)) ids that might contain the term, and whether
+  #   that set is exact (i.e. contains exactly the entries matching the term)
+  def lookup(self,term):
+    """return the ids of entries that could contain the given term"""
+
+    term = term.lower()
+    parts = self.TOKEN.findall(term)
+    if not parts:
+      return (set(self.ids.values()),False)
+
+    # a term that is a single word matches exactly the entries with a word
+    # containing it; every word in longer terms must be in one of the entries
+    ids = None
+    for part in parts:
+      found = set()
+      for word in self.find_words(part):
+        found.update(self.postings[word])
+      ids = (found if ids is None else ids & found)
+      if not ids:
+        break
+
+    return (ids,len(parts)==1 and parts[0]==term)
+
+  # @param part (str,unicode) a lowercase alphanumeric string
+  # @return (list) all indexed words containing part
+  def find_words(self,part):
+    """use trigrams to find words containing the given string"""
+
+    if len(part)<self.GRAM:
+      return [word for word in self.postings if part in word]
+
+    words = None
+    for gram in self.trigrams(part):
+      found = self.grams.get(gram)
+      if not found:
+        return []
+      words = (set(found) if words is None else words & found)
+    return [word for word in words if part in word]
+
+  # @param path (str,unicode) the path to split
+  # @return (set) the lowercase alphanumeric words in the path
+  def words(self,path):
+    """split a path into words"""
+
+    return set(self.TOKEN.findall(path.lower()))
+
+  # @param word (str,unicode) the word to split
+  # @return (set) every substring of length GRAM in the word
+  def trigrams(self,word):
+    """split a word into trigrams"""
+
+    n = self.GRAM
+    return set([word[i:i+n] for i in range(0,len(word)-n+1)])
+
+################################################################################
+# Cache class
+################################################################################
+
+class Cache(object):
+  """LRU cache of search results that's emptied when the library changes"""
+
+  # @param size (int) the max number of results to keep (0 disables the cache)
+  def __init__(self,size):
+
+    self.size = size
+    self.items = collections.OrderedDict()
+    self.generation = 0
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.items)
+
+  # @param key (tuple) the key from normalize()
+  # @return (list,None) the cached result or None
+  def get(self,key):
+    """return a cached result and mark it as recently used"""
+
+    if self.size<1:
+      return None
+
+    with self.lock:
+      result = self.items.pop((self.generation,)+key,None)
+      if result is None:
+        self.misses += 1
+        return None
+      self.items[(self.generation,)+key] = result
+      self.hits += 1
+      return result
+
+  # @param key (tuple) the key from normalize()
+  # @param result (list) the result to cache
+  # @param generation (int) the generation when the search started
+  def put(self,key,result,generation):
+    """cache a result, dropping the least recently used if we're full"""
+
+    if self.size<1:
+      return
+
+    # the library changed while we were searching
+    with self.lock:
+      if generation!=self.generation:
+        return
+      self.items[(self.generation,)+key] = result
+      while len(self.items)>self.size:
+        self.items.popitem(last=False)
+
+  def bump(self):
+    """start a new generation so nothing cached before is returned"""
+
+    with self.lock:
+      self.generation += 1
+      self.items.clear()
+
+  # @param args (list) search terms to include or -exclude
+  # @return (tuple of (tuple,tuple)) sorted unique (include,exclude) terms
+  @staticmethod
+  def normalize(args):
+    """return a key that's the same for every equivalent search"""
+
+    # util.checkall() ignores case and order, and a bare "-" matches anything
+    include = set([x.lower() for x in args if not x.startswith('-')])
+    exclude = set([x[1:].lower() for x in args if len(x)>1 and x[0]=='-'])
+    return (tuple(sorted(include)),tuple(sorted(exclude)))
+
+################################################################################
+# Table class
+################################################################################
+
+class Table(collections.Sequence):
+  """read-only list of paths stored as a sorted string table"""
+
+  # the table is the entry count and number of restarts, the offset of every
+  # restart, then the records; each record shares a prefix with the one before
+  # it except for every RESTART records, which we can seek to directly
+  HEAD = struct.Struct('<II')
+  OFFSET = struct.Struct('<I')
+  RECORD = struct.Struct('<HHB')    # (shared,suffix length,flags)
+  RESTART = 16
+  RAW = 1                           # the entry was a str rather than unicode
+
+  # @param buf (mmap,str) the buffer containing the table
+  # @param offset (int) the position of the table in buf
+  def __init__(self,buf,offset):
+
+    self.buf = buf
+    (self.count,self.restarts) = self.HEAD.unpack_from(buf,offset)
+    self.offsets = offset+self.HEAD.size
+    self.data = self.offsets+self.restarts*self.OFFSET.size
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self,i):
+
+    if isinstance(i,slice):
+      return [self[x] for x in xrange(*i.indices(self.count))]
+
+    if i<0:
+      i += self.count
+    if not 0<=i<self.count:
+      raise IndexError('table index out of range')
+
+    (r,skip) = divmod(i,self.RESTART)
+    (key,flags) = next(itertools.islice(self.scan(r),skip,None))
+    return self.decode(key,flags)
+
+  def __iter__(self):
+    return (self.decode(k,f) for (k,f) in self.scan(0))
+
+  def __contains__(self,value):
+    return self.find(value)>=0
+
+  # @param value (str,unicode) the entry to find
+  # @return (int) the position of the entry
+  def index(self,value):
+    """find an entry using binary search"""
+
+    i = self.find(value)
+    if i<0:
+      raise ValueError('%r is not in table' % value)
+    return i
+
+  # @param value (str,unicode) the entry to find
+  # @return (int) the position of the entry or -1
+  def find(self,value):
+    """helper function for index() and __contains__()"""
+
+    (key,flags) = self.encode(value)
+
+    # find the last restart not after key, then scan from there
+    (lo,hi) = (0,self.restarts)
+    while lo<hi:
+      mid = (lo+hi)//2
+      if next(self.scan(mid))[0]<=key:
+        lo = mid+1
+      else:
+        hi = mid
+    if lo==0:
+      return -1
+
+    r = lo-1
+    for (i,(cur,f)) in enumerate(itertools.islice(self.scan(r),self.RESTART)):
+      if cur==key:
+        return r*self.RESTART+i
+      if cur>key:
+        break
+    return -1
+
+  # @param r (int) the restart to start from
+  # @return (generator) (key,flags) for each entry starting at restart r
+  def scan(self,r):
+    """decode records in order starting at the given restart"""
+
+    buf = self.buf
+    pos = self.data+self.OFFSET.unpack_from(buf,
+        self.offsets+r*self.OFFSET.size)[0]
+    prev = ''
+    for i in xrange(r*self.RESTART,self.count):
+      (shared,n,flags) = self.RECORD.unpack_from(buf,pos)
+      pos += self.RECORD.size
+      prev = prev[:shared]+buf[pos:pos+n]
+      pos += n
+      yield (prev,flags)
+
+  # @param value (str,unicode) an entry
+  # @return (tuple of (str,int)) the (key,flags) to store
+  @staticmethod
+  def encode(value):
+    """encode an entry as bytes"""
+
+    if isinstance(value,unicode):
+      return (value.encode('utf8'),0)
+    return (value,Table.RAW)
+
+  # @param key (str) the stored bytes
+  # @param flags (int) the stored flags
+  # @return (str,unicode) the original entry
+  @staticmethod
+  def decode(key,flags):
+    """decode an entry"""
+
+    return (key if flags & Table.RAW else key.decode('utf8'))
+
+  # @param keys (list of tuple) sorted (key,flags) from encode()
+  # @return (str) the table
+  @staticmethod
+  def pack(keys):
+    """build a table from sorted entries"""
+
+    offsets = []
+    records = []
+    pos = 0
+    prev = ''
+    for (i,(key,flags)) in enumerate(keys):
+      shared = 0
+      if i%Table.RESTART:
+        shared = min(len(os.path.commonprefix([prev,key])),0xFFFF)
+      else:
+        offsets.append(Table.OFFSET.pack(pos))
+      record = Table.RECORD.pack(shared,len(key)-shared,flags)+key[shared:]
+      records.append(record)
+      pos += len(record)
+      prev = key
+
+    return (Table.HEAD.pack(len(keys),len(offsets))+''.join(offsets)
+        +''.join(records))
+
+################################################################################
+# Times class
+################################################################################
+
+class Times(collections.Mapping):
+  """read-only {dir:stamp} dict stored as a Table and an array of stamps"""
+
+  STAMP = struct.Struct('<dd')
+
+  # @param buf (mmap,str) the buffer containing the times
+  # @param keys (int) the position of the Table of dirs in buf
+  # @param stamps (int) the position of the stamps in buf
+  def __init__(self,buf,keys,stamps):
+
+    self.buf = buf
+    self.dirs = Table(buf,keys)
+    self.stamps = stamps
+
+  def __len__(self):
+    return len(self.dirs)
+
+  def __iter__(self):
+    return iter(self.dirs)
+
+  def __getitem__(self,key):
+
+    i = self.dirs.find(key)
+    if i<0:
+      raise KeyError(key)
+    stamp = self.STAMP.unpack_from(self.buf,self.stamps+i*self.STAMP.size)
+
+    # NaN means we couldn't stat the dir
+    return (None if stamp[0]!=stamp[0] else stamp)
+
+  # @param stamp (tuple,None) a stamp from LocalWalker or SambaWalker
+  # @return (str) the packed stamp
+  @staticmethod
+  def pack(stamp):
+    """pack a stamp into bytes"""
+
+    if stamp is None:
+      stamp = (float('nan'),float('nan'))
+    return Times.STAMP.pack(*stamp)
+
+################################################################################
+# Inotify class
+################################################################################
+
+class Inotify(object):
+  """minimal ctypes wrapper for the linux inotify API"""
+
+  IN_MOVED_FROM = 0x00000040
+  IN_MOVED_TO   = 0x00000080
+  IN_CREATE     = 0x00000100
+  IN_DELETE     = 0x00000200
+  IN_Q_OVERFLOW = 0x00004000
+  IN_IGNORED    = 0x00008000
+  IN_ONLYDIR    = 0x01000000
+  IN_ISDIR      = 0x40000000
+
+  # struct inotify_event {int wd; uint32 mask; uint32 cookie; uint32 len;}
+  EVENT = struct.Struct('iIII')
+
+  def __init__(self):
+
+    if not sys.platform.startswith('linux'):
+      raise OSError('inotify is only available on linux')
+
+    self.libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+    self.enc = sys.getfilesystemencoding()
+    self.fd = self.libc.inotify_init()
+    if self.fd<0:
+      self.error()
+
+  def error(self,path=None):
+    """raise an OSError for the last libc error"""
+
+    err = ctypes.get_errno()
+    raise OSError(err,os.strerror(err),path)
+
+  # @param path (str,unicode) the directory to watch
+  # @param mask (int) the events to watch for
+  # @return (int) the watch descriptor
+  def add_watch(self,path,mask):
+    """watch a directory"""
+
+    if isinstance(path,unicode):
+      path = path.encode(self.enc)
+    wd = self.libc.inotify_add_watch(self.fd,path,mask)
+    if wd<0:
+      self.error(path)
+    return wd
+
+  # @param wd (int) the watch descriptor to remove
+  def rm_watch(self,wd):
+    """stop watching a directory"""
+
+    self.libc.inotify_rm_watch(self.fd,wd)
+
+  # @return (list of tuple of (int,int,unicode)) (wd,mask,name) for each event
+  def read(self):
+    """read all pending events (blocks if there are none)"""
+
+    data = os.read(self.fd,65536)
+    events = []
+    i = 0
+    while i+self.EVENT.size<=len(data):
+      (wd,mask,cookie,n) = self.EVENT.unpack_from(data,i)
+      i += self.EVENT.size
+      name = data[i:i+n].rstrip('\0')
+      i += n
+      try:
+        name = name.decode(self.enc)
+      except UnicodeDecodeError:
+        pass
+      events.append((wd,mask,name))
+    return events
+
+  def close(self):
+    """release the inotify file descriptor"""
+
+    os.close(self.fd)
+
+################################################################################
+# Watcher class
+################################################################################
+
+class Watcher(threading.Thread):
+  """watch every local library directory and apply changes in batches"""
+
+  MASK = (Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM |
+      Inotify.IN_MOVED_TO | Inotify.IN_ONLYDIR)
+
+  BATCH = 5     # seconds to collect events before applying them
+  SAVE = 60     # minimum seconds between saving the library
+
+  def __init__(self,bot):
+
+    super(Watcher,self).__init__()
+    self.daemon = True
+    self.name = 'library.watch'
+
+    self.bot = bot
+    self.inotify = Inotify()
+    self.finished = False
+
+    self.wds = {}       # wd -> dir
+    self.dirs = {}      # dir -> (wd,set of libs)
+    self.index = None   # bot.lib_index when we last synced our watches
+    self.patched = Queue.Queue()  # (lib,added,removed) dirs from patch()
+
+    # pending changes as {path:set of libs}
+    self.added = collections.OrderedDict()
+    self.removed = {}
+    self.first = None
+    self.dirty = False
+    self.last_save = time.time()
+
+  def run(self):
+
+    while not self.finished:
+      try:
+
+        # rebuild and load replace the lists (and indexes) entirely
+        if self.bot.lib_index is not self.index:
+          self.sync()
+
+        # while "library update" and our own batches patch them in place
+        while not self.patched.empty():
+          self.repatch(*self.patched.get())
+
+        (r,w,x) = select.select([self.inotify.fd],[],[],1)
+        if r:
+          for (wd,mask,name) in self.inotify.read():
+            self.event(wd,mask,name)
+
+        if self.first and time.time()>=self.first+self.BATCH:
+          self.apply()
+        if self.dirty and time.time()>=self.last_save+self.SAVE:
+          self.save()
+
+      except Exception as ex:
+        log.error('Error in library watcher')
+        full = traceback.format_exc(ex)
+        log.error('  %s' % full.split('\n')[-2])
+        log.debug(full)
+        time.sleep(self.BATCH)
+
+    self.inotify.close()
+
+  def sync(self):
+    """watch every local directory in the library"""
+
+    self.index = self.bot.lib_index
+    want = {}
+    for lib in ('audio','video'):
+      roots = [os.path.join(unicode(x),'')
+          for x in self.bot.opt('library.%s_dirs' % lib)
+          if not isinstance(x,dict)]
+      for d in roots+getattr(self.bot,'lib_%s_dir' % lib):
+        if not d.startswith('smb://'):
+          want.setdefault(d,set()).add(lib)
+
+    # drop watches on dirs that aren't in the library anymore
+    for d in self.dirs.keys():
+      if d in want:
+        self.dirs[d][1].intersection_update(want[d])
+      else:
+        (wd,libs) = self.dirs.pop(d)
+        self.wds.pop(wd,None)
+        self.inotify.rm_watch(wd)
+
+    failed = 0
+    for (d,libs) in want.items():
+      for lib in libs:
+        try:
+          self.watch(d,lib)
+        except OSError:
+          failed += 1
+
+    log.info('Watching %s library dirs' % len(self.dirs))
+    if failed:
+      log.warning('Unable to watch %s dirs (check fs.inotify.max_user_watches)'
+          % failed)
+
+  # @param d (unicode) the directory to watch (ending in a separator)
+  # @param lib (str) the library the directory is in ('audio' or 'video')
+  def watch(self,d,lib):
+    """add a watch for the given dir"""
+
+    if d in self.dirs:
+      self.dirs[d][1].add(lib)
+      return
+
+    wd = self.inotify.add_watch(d,self.MASK)
+    self.wds[wd] = d
+    self.dirs[d] = (wd,set([lib]))
+
+  # @param lib (str) the library the dirs are in ('audio' or 'video')
+  # @param added (list) dirs added to the library
+  # @param removed (list) dirs removed from the library
+  def changed(self,lib,added,removed):
+    """queue changes to a library's dirs (called by Library.patch())"""
+
+    self.patched.put((lib,added,removed))
+
+  # @param lib (str) the library the dirs are in ('audio' or 'video')
+  # @param added (list) dirs added to the library
+  # @param removed (list) dirs removed from the library
+  def repatch(self,lib,added,removed):
+    """update our watches to match a patched library"""
+
+    for d in removed:
+      if d not in self.dirs:
+        continue
+      (wd,libs) = self.dirs[d]
+      libs.discard(lib)
+      if not libs:
+        del self.dirs[d]
+        self.wds.pop(wd,None)
+        self.inotify.rm_watch(wd)
+
+    for d in added:
+      if d.startswith('smb://'):
+        continue
+      try:
+        self.watch(d,lib)
+      except OSError as e:
+        log.warning('Unable to watch "%s": %s' % (d,e))
+
+  # @param d (unicode) the directory to stop watching (and all sub-dirs)
+  def unwatch(self,d):
+    """remove watches for the given dir and everything under it"""
+
+    for sub in [x for x in self.dirs if x.startswith(d)]:
+      (wd,libs) = self.dirs.pop(sub)
+      self.wds.pop(wd,None)
+      self.inotify.rm_watch(wd)
+
+  # @param wd (int) the watch descriptor
+  # @param mask (int) the event mask
+  # @param name (unicode) the name of the file or dir inside the watched dir
+  def event(self,wd,mask,name):
+    """queue the change described by an inotify event"""
+
+    if mask & Inotify.IN_Q_OVERFLOW:
+      log.warning('Library watcher missed events; run "library update"')
+      return
+
+    # the kernel removed the watch (e.g. the dir was deleted)
+    if mask & Inotify.IN_IGNORED:
+      d = self.wds.pop(wd,None)
+      if d in self.dirs and self.dirs[d][0]==wd:
+        del self.dirs[d]
+      return
+
+    d = self.wds.get(wd)
+    if d is None or d not in self.dirs:
+      return
+    libs = set(self.dirs[d][1])
+
+    path = os.path.join(d,name)
+    if mask & Inotify.IN_ISDIR:
+      path = os.path.join(path,'')
+
+    if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+      self.added[path] = libs
+    else:
+
+      # anything created under a dir that's now gone doesn't matter anymore
+      if path.endswith(os.path.sep):
+        for x in [x for x in self.added if x.startswith(path)]:
+          del self.added[x]
+      else:
+        self.added.pop(path,None)
+      self.removed[path] = libs
+
+    self.first = (self.first or time.time())
+
+  def apply(self):
+    """apply pending changes to the library lists and indexes"""
+
+    # try again later if someone else is using the library
+    if not self.bot.lib_lock.acquire(False):
+      return
+
+    try:
+      changes = {lib:([],[]) for lib in LISTS}
+
+      # removals first, so "delete then create" leaves the new entry
+      prefixes = {}
+      for (path,libs) in self.removed.items():
+        for lib in libs:
+          if path.endswith(os.path.sep):
+            prefixes.setdefault(lib,[]).append(path)
+          else:
+            changes[lib+'_file'][1].append(path)
+      for (lib,dirs) in prefixes.items():
+        dirs = tuple(dirs)
+        for typ in ('_dir','_file'):
+          changes[lib+typ][1].extend([x for x in
+              getattr(self.bot,'lib_'+lib+typ) if x.startswith(dirs)])
+        for d in dirs:
+          self.unwatch(d)
+
+      # new dirs might already have contents (e.g. if they were moved here)
+      for (path,libs) in self.added.items():
+        for lib in libs:
+          if not path.endswith(os.path.sep):
+            changes[lib+'_file'][0].append(path)
+            continue
+          if not os.path.isdir(path):
+            continue
+          (dirs,files) = util.rlistdir(path)
+          changes[lib+'_dir'][0].extend([path]+dirs)
+          changes[lib+'_file'][0].extend(files)
+          for d in [path]+dirs:
+            try:
+              self.watch(d,lib)
+            except OSError as e:
+              log.warning('Unable to watch "%s": %s' % (d,e))
+
+      library = Library(self.bot,None,[])
+      (added,removed) = (0,0)
+      for (lib,(new,old)) in changes.items():
+        library.patch(lib,new,old)
+        if lib.endswith('_file'):
+          (added,removed) = (added+len(new),removed+len(old))
+
+      log.debug('Watcher applied %s new and %s removed files'
+          % (added,removed))
+      self.added.clear()
+      self.removed.clear()
+      self.first = None
+      self.dirty = True
+
+    finally:
+      self.bot.lib_lock.release()
+
+  def save(self):
+    """save the library if nobody else is using it"""
+
+    if not self.bot.lib_lock.acquire(False):
+      return
+
+    try:
+      Library(self.bot,None,[]).save()
+      self.dirty = False
+      self.last_save = time.time()
+    finally:
+      self.bot.lib_lock.release()
@@ -73,6 +73,10 @@ def note(bot,mess,args):
     if not bot.has_plugin('xbmc'):
       return 'This feature not available because plugin "xbmc" not loaded'
 
+    down = bot.xbmc_down()
+    if down:
+      return down
+
     args[0] = 'add'
 
     active = bot.xbmc_active_player()
@@ -21,7 +21,8 @@
 #
 ################################################################################
 
-import random,requests,json,os
+import random,requests,json,os,threading,time,multiprocessing,collections
+from multiprocessing.pool import ThreadPool
 
 from sibyl.lib.decorators import *
 import sibyl.lib.util as util
@@ -31,6 +32,45 @@ log = logging.getLogger(__name__)
 
 __wants__ = ['library']
 
+# xbmc's player ids for audio and video
+PLAYERS = (0,1)
+
+# seconds between checks on an unreachable xbmc
+PROBE = 30
+
+# files to add to a playlist per request
+PLAYLIST_BATCH = 100
+
+# methods (or prefixes) after which the notification mirror can't be trusted
+# until it hears back from xbmc
+MUTATORS = ('Player.Open','Player.Seek','Player.PlayPause','Player.Stop',
+    'Player.GoTo','Player.SetShuffle','Playlist.')
+
+# extensions xbmc adds to the audio (0) and video (1) playlists from a dir by
+# default, less archives and playlists which it would expand itself
+MEDIA_EXTS = {
+  0 : set(('.nsv .m4a .flac .aac .rm .rma .mpa .wav .wma .ogg .mp3 .mp2 '
+      '.gdm .imf .m15 .sfx .uni .ac3 .dts .aif .aiff .ape .mac .mpc .mp+ .mpp '
+      '.shn .wv .dsp .xwav .waa .wvs .wam .gcm .idsp .mpdsp .mss .spt .rsd '
+      '.sap .cmc .cmr .dmc .mpt .mpd .rmt .tmc .tm8 .tm2 .oga .tta .wtv .mka '
+      '.tak .opus .dff .dsf .m4b .dtshd').split()),
+  1 : set(('.m4v .3g2 .3gp .nsv .tp .ts .ty .rm .rmvb .mpd .ifo .mov .qt '
+      '.divx .xvid .bivx .vob .nrg .img .iso .udf .pva .wmv .asf .ogm .m2v '
+      '.avi .bin .dat .mpg .mpeg .mp4 .mkv .mk3d .avc .vp3 .svq3 .nuv .viv '
+      '.dv .fli .flv .001 .vdr .dvr-ms .mts .m2t .m2ts .evo .ogv .sdp .avs '
+      '.rec .vc1 .h264 .rcv .mpls .mpl .webm .bdmv .bdm .wtv .trp .f4v').split())
+}
+
+# stream titles to remember, for how many seconds, and how much of a page to
+# read looking for one
+META_SIZE = 256
+META_TTL = 3600
+META_LIMIT = 512*1024
+META_LOCK = threading.Lock()
+
+AGENT = {'User-agent':'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:46.0) '
+    +'Gecko/20100101 Firefox/46.0'}
+
 @botconf
 def conf(bot):
   """add config options"""
@@ -47,16 +87,128 @@ def conf(bot):
           {'name' : 'timeout',
             'default' : 15,
             'parse' : bot.conf.parse_int,
-            'valid' : bot.conf.valid_nump}
+            'valid' : bot.conf.valid_nump},
+
+          {'name' : 'failures',
+            'default' : 3,
+            'parse' : bot.conf.parse_int,
+            'valid' : bot.conf.valid_nump},
+
+          {'name' : 'notify_port',
+            'default' : 9090,
+            'parse' : bot.conf.parse_int,
+            'valid' : bot.conf.valid_nump},
+
+          {'name' : 'hosts',
+            'default' : {},
+            'parse' : parse_hosts,
+            'valid' : valid_hosts},
+
+          {'name' : 'groups',
+            'default' : {},
+            'parse' : parse_groups}
   ]
 
+def parse_hosts(conf,opt,val):
+  """parse the host list into a dict of {name:ip}"""
+
+  val = val.replace('\n','')
+  hosts = {}
+  for entry in util.split_strip(val,';'):
+    if entry:
+      (name,ip) = util.split_strip(entry,',')
+      hosts[name.lower()] = ip
+
+  return hosts
+
+def valid_hosts(conf,hosts):
+  """return True if every host has a valid ip"""
+
+  for (name,ip) in hosts.items():
+    if not conf.valid_ip(conf,ip):
+      conf.log('warning','host "%s" has invalid ip "%s"' % (name,ip))
+      del hosts[name]
+
+  return True
+
+def parse_groups(conf,opt,val):
+  """parse the group list into a dict of {name:[host names]}"""
+
+  val = val.replace('\n','')
+  groups = {}
+  for entry in util.split_strip(val,';'):
+    if entry:
+      names = [x.lower() for x in util.split_strip(entry,',')]
+      groups[names[0]] = names[1:]
+
+  return groups
+
 @botinit
 def init(bot):
   """create empty vars"""
 
   bot.add_var('last_played',persist=True)
 
-@botcmd
+  # stop waiting on a host after it fails this many times in a row
+  hosts = get_hosts(bot,'all')
+  for (name,ip) in hosts:
+    get_client(bot,ip).threshold = bot.opt('xbmc.failures')
+
+  for (group,names) in bot.opt('xbmc.groups').items():
+    for name in names:
+      if not get_hosts(bot,name):
+        log.warning('Unknown host "%s" in group "%s"' % (name,group))
+
+  # commands sent to several hosts go out at the same time
+  bot.add_var('xbmc_pool',ThreadPool(max(len(hosts),util.XbmcClient.POOL)))
+
+  # mirror the player state from xbmc's notifications so most commands don't
+  # have to ask for it
+  bot.add_var('xbmc_mirror')
+
+  # set to cancel the thread filling the last playlist we started
+  bot.add_var('xbmc_fill',threading.Event())
+
+  # {(site,id):(expires,info)} for the stream cmd
+  bot.add_var('xbmc_meta',collections.OrderedDict())
+  port = bot.opt('xbmc.notify_port')
+  if port:
+    ip = bot.opt('xbmc.ip').split(':')[0]
+    bot.xbmc_mirror = util.XbmcMirror(ip,port,log)
+    bot.xbmc_mirror.start()
+
+@botdown
+def down(bot):
+  """close the connections to xbmc"""
+
+  if bot.xbmc_mirror:
+    bot.xbmc_mirror.stop()
+
+  bot.xbmc_pool.terminate()
+
+  for (name,ip) in get_hosts(bot,'all'):
+    client = get_client(bot,ip)
+    (n,connections) = client.stats()
+    log.debug('Made %s xbmc requests to "%s" using %s connections'
+        % (n,name,connections))
+    client.close()
+
+@botidle(freq=PROBE,thread=True)
+def probe(bot):
+  """check if an unreachable xbmc is back"""
+
+  for (name,ip) in get_hosts(bot,'all'):
+    client = get_client(bot,ip)
+    if not client.tripped():
+      continue
+
+    if client.probe():
+      log.info('XBMC at %s is reachable again' % client.ip)
+    else:
+      log.debug('XBMC at %s is still unreachable' % client.ip)
+
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def remote(bot,mess,args):
   """execute remote buttons in order - remote (lrudebc)[...]"""
 
@@ -73,7 +225,8 @@ def remote(bot,mess,args):
   for s in cmd:
     bot.xbmc(cmds[s])
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def volume(bot,mess,args):
   """set the player volume percentage - volume %"""
 
@@ -95,7 +248,8 @@ def volume(bot,mess,args):
 
   bot.xbmc('Application.SetVolume',{'volume':val})
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def subtitles(bot,mess,args):
   """change the subtitles - subtitles (info|on|off|next|prev|set) [index]"""
 
@@ -171,37 +325,60 @@ def subtitles(bot,mess,args):
     s += ', '
   return s[:-2]
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd(hosts=True)
 def info(bot,mess,args):
-  """display info about currently playing file"""
+  """display info about currently playing file - info [host|group|all]"""
+
+  hosts = (args and get_hosts(bot,args[0]))
+  if hosts:
+    return fan_out(bot,hosts,info_host)
+
+  return info_host(bot)
+
+# @param ip (str) [None] the host to ask instead of xbmc.ip
+# @return (str) what the host is playing
+def info_host(bot,ip=None):
+  """helper function for info()"""
+
+  # get file name, speed, current time, and total time
+  state = bot.xbmc_state(ip)
+  if state is None:
+    (active,results) = active_batch(bot,lambda pid:[
+        ('Player.GetItem',{'playerid':pid}),
+        ('Player.GetProperties',
+            {'playerid':pid,'properties':['speed','time','totaltime']})],ip)
+    if active:
+      state = results[1]['result']
+      state['item'] = results[0]['result']['item']
+  else:
+    active = state['active']
 
   # abort if nothing is playing
-  active = bot.xbmc_active_player()
   if not active:
     return 'Nothing playing'
   (pid,typ) = active
 
-  # get file name
-  result = bot.xbmc('Player.GetItem',{'playerid':pid})
-  name = result['result']['item']['label']
-
-  # get speed, current time, and total time
-  result = bot.xbmc('Player.GetProperties',
-      {'playerid':pid,'properties':['speed','time','totaltime']})
-  current = util.time2str(result['result']['time'])
-  total = util.time2str(result['result']['totaltime'])
+  name = state['item']['label']
+  current = util.time2str(state['time'])
+  total = util.time2str(state['totaltime'])
 
   # translate speed: 0 = 'paused', 1 = 'playing'
-  speed = result['result']['speed']
+  speed = state['speed']
   status = 'playing'
   if speed==0:
     status = 'paused'
 
   return '%s %s at %s/%s - "%s"' % (typ.title(),status,current,total,name)
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd(hosts=True)
 def play(bot,mess,args):
-  """unpause, or play a file - play [/path | http://url | smb://server/share/path]"""
+  """unpause, or play a file - play [host|group|all|/path|http://url|smb://server/share/path]"""
+
+  hosts = (args and get_hosts(bot,args[0]))
+  if hosts:
+    return fan_out(bot,hosts,lambda bot,ip:playpause(bot,0,ip))
 
   # if no args are passed, start playing again
   if not args:
@@ -223,25 +400,81 @@ def play(bot,mess,args):
     return bot.run_cmd('info')
   return 'Invalid file'
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd(hosts=True)
 def pause(bot,mess,args):
-  """if xbmc is playing, pause"""
+  """if xbmc is playing, pause - pause [host|group|all]"""
+
+  hosts = (args and get_hosts(bot,args[0]))
+  if hosts:
+    return fan_out(bot,hosts,lambda bot,ip:playpause(bot,1,ip))
 
   playpause(bot,1)
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd(hosts=True)
 def stop(bot,mess,args):
-  """if xbmc is playing, stop"""
+  """if xbmc is playing, stop - stop [host|group|all]"""
+
+  hosts = (args and get_hosts(bot,args[0]))
+  if hosts:
+    return fan_out(bot,hosts,stop_host)
+
+  return stop_host(bot)
+
+# @param ip (str) [None] the host to stop instead of xbmc.ip
+# @return (str) None or a reason we didn't stop
+def stop_host(bot,ip=None):
+  """helper function for stop()"""
 
   # abort if nothing is playing
-  active = bot.xbmc_active_player()
+  active = bot.xbmc_active_player(ip=ip)
   if active is None:
     return 'Nothing playing'
   (pid,typ) = active
 
-  bot.xbmc('Player.Stop',{"playerid":pid})
+  bot.xbmc('Player.Stop',{"playerid":pid},ip=ip)
+
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
+def sync(bot,mess,args):
+  """play what's playing on other hosts from the same time - sync (host|group|all)"""
+
+  if not args:
+    return 'You must specify a host or group'
+  hosts = get_hosts(bot,args[0])
+  if not hosts:
+    return 'Unknown host or group "%s"' % args[0]
+
+  state = bot.xbmc_state()
+  if state is None:
+    (active,results) = active_batch(bot,lambda pid:[
+        ('Player.GetItem',{'playerid':pid,'properties':['file']}),
+        ('Player.GetProperties',{'playerid':pid,'properties':['time']})])
+    if active:
+      state = results[1]['result']
+      state['item'] = results[0]['result']['item']
+  else:
+    active = state['active']
+
+  if not active:
+    return 'Nothing playing'
+  item = {'file':state['item']['file']}
+  options = {'resume':state['time']}
+
+  def open_host(bot,ip):
+    result = bot.xbmc('Player.Open',{'item':item,'options':options},ip=ip)
+    if 'error' in result:
+      return 'Unable to open (%s)' % result['error']['message']
+
+  # don't restart the host we're syncing to
+  hosts = [(name,ip) for (name,ip) in hosts if ip is not None]
+  if not hosts:
+    return 'Nothing to sync'
+  return fan_out(bot,hosts,open_host)
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def prev(bot,mess,args):
   """go to previous playlist item"""
 
@@ -261,7 +494,8 @@ def prev(bot,mess,args):
   pos = min(siz-1,max(0,pos-1))
   bot.run_cmd('jump',[str(pos+1)])
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def next(bot,mess,args):
   """go to next playlist item"""
 
@@ -273,7 +507,8 @@ def next(bot,mess,args):
 
   bot.xbmc('Player.GoTo',{'playerid':pid,'to':'next'})
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def jump(bot,mess,args):
   """jump to an item# in the playlist - jump #"""
 
@@ -294,7 +529,8 @@ def jump(bot,mess,args):
   except ValueError:
     return 'Playlist position must be an integer greater than 0'
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def seek(bot,mess,args):
   """go to a specific time - seek [hh:]mm:ss"""
 
@@ -314,7 +550,8 @@ def seek(bot,mess,args):
   except ValueError:
     return 'Times must be in the format m:ss or h:mm:ss'
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def restart(bot,mess,args):
   """start playing again from 0:00"""
 
@@ -326,7 +563,8 @@ def restart(bot,mess,args):
 
   bot.xbmc('Player.Seek',{'playerid':pid,'value':{'seconds':0}})
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def hop(bot,mess,args):
   """move forward or back - hop [small|big] [back|forward]"""
 
@@ -353,15 +591,14 @@ def hop(bot,mess,args):
 
   bot.xbmc('Player.Seek',{'playerid':pid,'value':s})
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def stream(bot,mess,args):
   """stream from [YouTube, Twitch (Live)] - stream url"""
 
   if not args:
     return 'You must specify a URL'
 
-  agent = {'User-agent':'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:46.0) '
-      +'Gecko/20100101 Firefox/46.0'}
   msg = args[0]
 
   # remove http:// https:// www. from start
@@ -424,94 +661,171 @@ def stream(bot,mess,args):
       msg = msg[:msg.find('&')]
     vid = msg[msg.find('watch?v=')+8:]
 
-    # retrieve video info from webpage
-    html = requests.get('http://youtube.com/watch?v='+vid,headers=agent).text
-    title = html[html.find('<title>')+7:html.find(' - YouTube</title>')]
-    title = util.cleanhtml(title)
-    channel = html.find('class="yt-user-info"')
-    start = html.find('>',channel+1)
-    start = html.find('>',start+1)+1
-    stop = html.find('<',start+1)
-    channel = html[start:stop]
-
-    # send xbmc request and seek if given custom start time
-    bot.xbmc('Player.Open',{'item':{'file':
+    # start playing and retrieve video info from the webpage meanwhile
+    opened = bot.xbmc_async('Player.Open',{'item':{'file':
         'plugin://plugin.video.youtube/play/?video_id='+vid}})
+    info = stream_info(bot,('youtube',vid),'http://youtube.com/watch?v='+vid,
+        '</title>',youtube_info)
+
+    # seek if given custom start time once xbmc has opened the video
+    opened.get()
     if tim:
       bot.run_cmd('seek',[tim])
 
     # respond to the user with video info
-    s = 'Streaming "'+title+'" by "'+channel+'" from YouTube'
+    s = 'Streaming "%s"' % info.get('title',vid)
+    if info.get('channel'):
+      s += ' by "%s"' % info['channel']
+    s += ' from YouTube'
     if tim:
       s += (' at '+tim)
 
   elif 'twitch' in msg.lower():
 
-    # get the webpage
     if 'channel=' in msg:
       vid = msg.split('channel=')[-1].split('&')[0]
     else:
       vid = msg.split('twitch.tv/')[-1].split('/')[0]
-    html = requests.get('http://twitch.tv/'+vid,headers=agent).text
 
-    # find the stream title
-    stream = html.find("property='og:title'")
-    stop = html.rfind("'",0,stream)
-    start = html.rfind("'",0,stop)+1
-    stream = html[start:stop]
-
-    # find the stream description
-    title = html.find("property='og:description'")
-    stop = html.rfind("'",0,title)
-    start = html.rfind("'",0,stop)+1
-    title = html[start:stop]
-
-    response = bot.xbmc('Player.Open',{'item':{'file':
+    # start playing and get the stream title from the webpage meanwhile
+    opened = bot.xbmc_async('Player.Open',{'item':{'file':
         'plugin://plugin.video.twitch/playLive/'+vid}})
-    s = 'Streaming "'+title+'" by "'+stream+'" from Twitch Live'
+    info = stream_info(bot,('twitch',vid),'http://twitch.tv/'+vid,
+        "property='og:description'",twitch_info)
+    opened.get()
+
+    s = 'Streaming "%s" by "%s" from Twitch Live' % (
+        info.get('title',''),info.get('stream',vid))
 
   bot.last_played = None
   if bot.has_plugin('bookmark'):
     bot.last_resume = None
   return s
 
-@botcmd
+# @param key (tuple) the (site,id) to cache the info under
+# @param url (str) the page to get the info from
+# @param stop (str) stop reading the page once this shows up
+# @param parse (function) takes the page read so far and returns a dict
+# @return (dict) info about the stream, or {} if we couldn't get any
+def stream_info(bot,key,url,stop,parse):
+  """look up stream info, remembering it for a while"""
+
+  with META_LOCK:
+    (expires,info) = bot.xbmc_meta.get(key,(0,None))
+    if time.time()<expires:
+      return info
+
+  try:
+    info = parse(read_until(url,stop))
+  except Exception as e:
+    log.debug('Unable to get stream info from %s (%s)' % (url,e))
+    return {}
+
+  with META_LOCK:
+    bot.xbmc_meta.pop(key,None)
+    bot.xbmc_meta[key] = (time.time()+META_TTL,info)
+    while len(bot.xbmc_meta)>META_SIZE:
+      bot.xbmc_meta.popitem(last=False)
+  return info
+
+# @param url (str) the page to download
+# @param stop (str) the text to look for
+# @return (unicode) the page up to and including stop, or all of it
+def read_until(url,stop):
+  """download only as much of a page as we need"""
+
+  r = requests.get(url,headers=AGENT,stream=True,timeout=10)
+  try:
+    page = ''
+    for chunk in r.iter_content(16384):
+      page += chunk
+      if stop in page[-len(chunk)-len(stop):] or len(page)>=META_LIMIT:
+        break
+  finally:
+    r.close()
+
+  return page.decode(r.encoding or 'utf8','replace')
+
+# @param html (unicode) the start of a YouTube video page
+# @return (dict) the title and, on older pages, the channel
+def youtube_info(html):
+  """helper function for stream()"""
+
+  info = {}
+  if '<title>' in html:
+    title = html[html.find('<title>')+7:html.find(' - YouTube</title>')]
+    info['title'] = util.cleanhtml(title)
+
+  if 'class="yt-user-info"' in html:
+    channel = html.find('class="yt-user-info"')
+    start = html.find('>',channel+1)
+    start = html.find('>',start+1)+1
+    stop = html.find('<',start+1)
+    info['channel'] = html[start:stop]
+
+  return info
+
+# @param html (unicode) the start of a Twitch channel page
+# @return (dict) the stream name and title
+def twitch_info(html):
+  """helper function for stream()"""
+
+  # find the stream title
+  stream = html.find("property='og:title'")
+  stop = html.rfind("'",0,stream)
+  start = html.rfind("'",0,stop)+1
+  stream = html[start:stop]
+
+  # find the stream description
+  title = html.find("property='og:description'")
+  stop = html.rfind("'",0,title)
+  start = html.rfind("'",0,stop)+1
+  title = html[start:stop]
+
+  return {'stream':stream,'title':title}
+
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def videos(bot,mess,args):
   """open folder as a playlist - videos [include -exclude] [#track] [@match]"""
 
   if not bot.has_plugin('library'):
     return 'This command not available because plugin "library" not loaded'
 
-  return _files(bot,args,bot.lib_video_dir,1)
+  return _files(bot,args,'video_dir',1)
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def video(bot,mess,args):
   """search and play a single video - video [include -exclude]"""
 
   if not bot.has_plugin('library'):
     return 'This command not available because plugin "library" not loaded'
 
-  return _file(bot,args,bot.lib_video_file)
+  return _file(bot,args,'video_file')
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def audios(bot,mess,args):
   """open folder as a playlist - audios [include -exclude] [#track] [@match]"""
 
   if not bot.has_plugin('library'):
     return 'This command not available because plugin "library" not loaded'
 
-  return _files(bot,args,bot.lib_audio_dir,0)
+  return _files(bot,args,'audio_dir',0)
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def audio(bot,mess,args):
   """search and play a single audio file - audio [include -exclude]"""
 
   if not bot.has_plugin('library'):
     return 'This command not available because plugin "library" not loaded'
 
-  return _file(bot,args,bot.lib_audio_file)
+  return _file(bot,args,'audio_file')
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def fullscreen(bot,mess,args):
   """control fullscreen - fullscreen [toggle|on|off]"""
 
@@ -523,18 +837,22 @@ def fullscreen(bot,mess,args):
     opt = False
   bot.xbmc('GUI.SetFullscreen',{'fullscreen':opt})
 
-@botcmd(name='random')
+@botcmd(name='random',thread='xbmc')
+@util.xbmc_cmd
 def random_chat(bot,mess,args):
   """play random song - random [include -exclude]"""
 
   if not bot.has_plugin('library'):
     return 'This command not available because plugin "library" not loaded'
+  msg = bot.library_ready()
+  if msg:
+    return msg
 
   # check if a search term was passed
   if not args:
     matches = bot.lib_audio_file
   else:
-    matches = util.matches(bot.lib_audio_file,args)
+    matches = bot.library_matches('audio_file',args)
 
   if len(matches)==0:
     return 'Found 0 matches'
@@ -553,7 +871,8 @@ def random_chat(bot,mess,args):
 
   return 'Playing "'+match+'"'
 
-@botcmd(name='xbmc',ctrl=True)
+@botcmd(name='xbmc',ctrl=True,thread='xbmc')
+@util.xbmc_cmd
 def xbmc_chat(bot,mess,args):
   """send raw JSON request - xbmc method [params]"""
 
@@ -574,14 +893,16 @@ def xbmc_chat(bot,mess,args):
     return str(result['error'])
   return str(result['result'])
 
-@botcmd
+@botcmd(thread='xbmc')
+@util.xbmc_cmd
 def shuffle(bot,mess,args):
   """change shuffle - shuffle (check|on|off)"""
 
   if not args:
     args = ['check']
 
-  active = bot.xbmc_active_player()
+  (active,results) = active_batch(bot,lambda pid:[('Player.GetProperties',
+      {'playerid':pid,'properties':['shuffled']})])
   if active is None:
     return 'Nothing playing'
   (pid,typ) = active
@@ -596,49 +917,200 @@ def shuffle(bot,mess,args):
     return 'Disabled shuffle'
 
   # return the shuffle status of the current player
-  params = {'playerid':pid,'properties':['shuffled']}
-  result = bot.xbmc('Player.GetProperties',params)['result']['shuffled']
+  result = results[0]['result']['shuffled']
   if result:
     return 'Shuffle is enabled'
   return 'Shuffle is disabled'
 
 @botfunc
-def xbmc(bot,method,params=None,timeout=None):
+def xbmc(bot,method,params=None,timeout=None,ip=None):
   """wrapper method to always provide IP to static method"""
 
   timeout = (timeout or bot.opt('xbmc.timeout'))
-  return util.xbmc(bot.opt('xbmc.ip'),method,params,
-      bot.opt('xbmc.username'),bot.opt('xbmc.password'),timeout)
+  try:
+    return util.xbmc(ip or bot.opt('xbmc.ip'),method,params,
+        bot.opt('xbmc.username'),bot.opt('xbmc.password'),timeout)
+  finally:
+    changed(bot,[method],ip)
 
+# @param callback (function) [None] called with the response when it arrives
+# @return (AsyncResult) call get() on it to wait for the response
 @botfunc
-def xbmc_active_player(bot,timeout=None):
+def xbmc_async(bot,method,params=None,timeout=None,ip=None,callback=None):
+  """make a request to xbmc without waiting for the response"""
+
+  return bot.xbmc_pool.apply_async(bot.xbmc,(method,params,timeout,ip),
+      callback=callback)
+
+@botfunc
+def xbmc_batch(bot,calls,timeout=None,ip=None):
   """wrapper method to always provide IP to static method"""
 
   timeout = (timeout or bot.opt('xbmc.timeout'))
-  return util.xbmc_active_player(bot.opt('xbmc.ip'),
+  try:
+    return util.xbmc_batch(ip or bot.opt('xbmc.ip'),calls,
+        bot.opt('xbmc.username'),bot.opt('xbmc.password'),timeout)
+  finally:
+    changed(bot,[method for (method,params) in calls],ip)
+
+@botfunc
+def xbmc_active_player(bot,timeout=None,ip=None):
+  """wrapper method to always provide IP to static method"""
+
+  state = bot.xbmc_state(ip)
+  if state is not None:
+    return state['active']
+
+  timeout = (timeout or bot.opt('xbmc.timeout'))
+  return util.xbmc_active_player(ip or bot.opt('xbmc.ip'),
       bot.opt('xbmc.username'),bot.opt('xbmc.password'),timeout)
 
-def playpause(bot,target):
+# @param ip (str) [None] the host to check instead of xbmc.ip
+# @param hosts (str) [None] a cmd arg; if it names hosts or a group don't
+#   check, since the cmd fans out and fan_out() reports unreachable hosts
+# @return (str) a reply if xbmc is unreachable, otherwise None
+@botfunc
+def xbmc_down(bot,ip=None,hosts=None):
+  """check if requests to xbmc are failing fast"""
+
+  if hosts and get_hosts(bot,hosts):
+    return None
+
+  client = get_client(bot,ip)
+  if not client.tripped():
+    return None
+  return ('XBMC at %s is unreachable; checking again every %s seconds'
+      % (client.ip,PROBE))
+
+# @param ip (str) [None] the host to check instead of xbmc.ip
+# @return (dict) the player state from the notification mirror, or None if
+#   it's disabled, disconnected, or waiting for xbmc to answer
+@botfunc
+def xbmc_state(bot,ip=None):
+  """return the mirrored player state if it's up to date"""
+
+  # we only follow notifications from xbmc.ip
+  if not bot.xbmc_mirror or ip is not None:
+    return None
+  return bot.xbmc_mirror.snapshot()
+
+# @param methods (list of str) the JSON-RPC methods we just called
+# @param ip (str) the host we called them on (None for xbmc.ip)
+def changed(bot,methods,ip):
+  """make the mirror refresh if we changed xbmc's state ourselves"""
+
+  if (bot.xbmc_mirror and ip is None
+      and any(m.startswith(MUTATORS) for m in methods)):
+    bot.xbmc_mirror.invalidate()
+
+# @param ip (str) [None] the host to use instead of xbmc.ip
+# @return (XbmcClient) the client for the host
+def get_client(bot,ip=None):
+  """return the shared client for an xbmc host"""
+
+  return util.xbmc_client(ip or bot.opt('xbmc.ip'),
+      bot.opt('xbmc.username'),bot.opt('xbmc.password'))
+
+# @param name (str) the name of a host or group, or "all"
+# @return (list of tuple) (name,ip) for each host, where ip is None for
+#   xbmc.ip, or None if there's no such host or group
+def get_hosts(bot,name):
+  """return the hosts a command should go to"""
+
+  name = name.lower()
+  default = bot.opt('xbmc.ip')
+  hosts = dict(bot.opt('xbmc.hosts'))
+  if default not in hosts.values():
+    hosts['default'] = default
+
+  if name=='all':
+    names = sorted(hosts.keys())
+  elif name in hosts:
+    names = [name]
+  elif name in bot.opt('xbmc.groups'):
+    names = [x for x in bot.opt('xbmc.groups')[name] if x in hosts]
+  else:
+    return None
+
+  return [(x,None if hosts[x]==default else hosts[x]) for x in names]
+
+# @param hosts (list of tuple) (name,ip) from get_hosts()
+# @param func (function) takes (bot,ip) and returns a reply or None
+# @return (str) the replies from every host
+def fan_out(bot,hosts,func):
+  """run func for several hosts at once and combine the replies"""
+
+  results = [(name,bot.xbmc_pool.apply_async(func,(bot,ip)))
+      for (name,ip) in hosts]
+
+  # every host shares one deadline so we only wait as long as the slowest
+  deadline = time.time()+bot.opt('xbmc.timeout')
+  replies = []
+  for (name,result) in results:
+    try:
+      reply = result.get(max(0,deadline-time.time()))
+    except (multiprocessing.TimeoutError,requests.exceptions.Timeout):
+      reply = 'Timed out'
+    except requests.exceptions.ConnectionError:
+      reply = 'Unreachable'
+    replies.append('%s: %s' % (name,reply or 'OK'))
+
+  return '; '.join(replies)
+
+# @param calls (function) takes a playerid and returns a list of (method,params)
+# @param ip (str) [None] the host to ask instead of xbmc.ip
+# @return (tuple of (tuple,list)) the active (playerid,filetype) or None, and
+#   the responses to calls(playerid) for the active player
+def active_batch(bot,calls,ip=None):
+  """get the active player and make calls for it in one round trip"""
+
+  # we don't know the active player yet so ask about all of them
+  batch = [('Player.GetActivePlayers',None)]
+  for pid in PLAYERS:
+    batch.extend(calls(pid))
+  results = bot.xbmc_batch(batch,ip=ip)
+
+  active = util.xbmc_player(results[0])
+  if active is None:
+    return (None,[])
+
+  pid = active[0]
+  if pid not in PLAYERS:
+    return (active,bot.xbmc_batch(calls(pid),ip=ip))
+  n = (len(batch)-1)/len(PLAYERS)
+  start = 1+PLAYERS.index(pid)*n
+  return (active,results[start:start+n])
+
+def playpause(bot,target,ip=None):
   """helper function for play() and pause()"""
 
+  # check player status before sending PlayPause command
+  state = bot.xbmc_state(ip)
+  if state is None:
+    (active,results) = active_batch(bot,lambda pid:[('Player.GetProperties',
+        {'playerid':pid,'properties':['speed']})],ip)
+    if active:
+      state = results[0]['result']
+  else:
+    active = state['active']
+
   # return None if nothing is playing
-  active = bot.xbmc_active_player()
   if active is None:
     return 'Nothing playing'
   (pid,typ) = active
 
-  # check player status before sending PlayPause command
-  speed = bot.xbmc('Player.GetProperties',
-      {'playerid':pid,'properties':["speed"]})
-  speed = speed['result']['speed']
+  speed = state['speed']
   if speed==target:
-    bot.xbmc('Player.PlayPause',{"playerid":pid})
+    bot.xbmc('Player.PlayPause',{"playerid":pid},ip=ip)
 
-def _files(bot,args,dirs,pid):
+def _files(bot,args,lib,pid):
   """helper function for videos() and audios()"""
 
   if not args:
     return 'You must specify a search term'
+  msg = bot.library_ready()
+  if msg:
+    return msg
   cmd = ' '.join(args)
 
   # check for item# as last arg and @ for item match string
@@ -661,7 +1133,7 @@ def _files(bot,args,dirs,pid):
     num = 0
 
   # find matches and respond if len(matches)!=1
-  matches = util.matches(dirs,args)
+  matches = bot.library_matches(lib,args)
 
   if len(matches)==0:
     return 'Found 0 matches'
@@ -676,37 +1148,51 @@ def _files(bot,args,dirs,pid):
     else:
       return 'Found '+str(len(matches))+' matches'
 
-  # translate library path if necessary
+  # build the playlist ourselves from the library in the order xbmc would use,
+  # skipping the files (e.g. subtitles and artwork) it would skip
+  files = util.xbmc_sorted([f for f in
+      bot.library_files(lib.replace('_dir','_file'),matches[0])
+      if os.path.splitext(f)[1].lower() in MEDIA_EXTS[pid]])
+  if not files:
+    return 'No files in "%s"' % matches[0]
   match = bot.library_translate(matches[0])
-
-  # if there was 1 match, add the whole directory to a playlist
-  # also check for an error opening the directory
-  bot.xbmc('Playlist.Clear',{'playlistid':pid})
-
-  result = bot.xbmc('Playlist.Add',{'playlistid':pid,'item':
-      {'directory':match}},timeout=60)
-  if 'error' in result.keys():
-    s = 'Unable to open: '+match
-    log.error(s)
-    return s
-
   msg = ''
 
   # find first item matching @search
   if search:
-    params = {'playlistid':pid,'properties':['file']}
-    items = bot.xbmc('Playlist.GetItems',params)['result']['items']
-    items = [x['file'] for x in items]
-    item_matches = util.matches(items,search,False)
-
+    item_matches = util.matches(files,search,False)
     if len(item_matches):
-      num = items.index(item_matches[0])
+      num = files.index(item_matches[0])
       msg += 'Found matching item "%s" --- ' % os.path.basename(item_matches[0])
     else:
       num = 0
       msg += 'No item matching "%s" --- ' % ' '.join(search)
+  elif not 0<=num<len(files):
+    return 'Playlist position must be from 1 to %s' % len(files)
+
+  # start playing the requested item right away; xbmc runs batches in order
+  files = [bot.library_translate(f) for f in files]
+  calls = [('Playlist.Clear',{'playlistid':pid}),
+      ('Playlist.Add',{'playlistid':pid,'item':{'file':files[num]}}),
+      ('Player.Open',{'item':{'playlistid':pid,'position':0}})]
+  results = bot.xbmc_batch(calls)
+
+  # xbmc runs the rest of a batch even if a call fails, so check every one
+  for ((method,params),result) in zip(calls,results):
+    if 'error' in result:
+      s = 'Unable to open: '+files[num]
+      log.error('%s (%s failed: %s)'
+          % (s,method,result['error'].get('message')))
+      return s
+
+  # add everything else in the background
+  bot.xbmc_fill.set()
+  bot.xbmc_fill = threading.Event()
+  t = threading.Thread(target=fill_playlist,args=(bot,pid,files,num,
+      bot.xbmc_fill))
+  t.daemon = True
+  t.start()
 
-  bot.xbmc('Player.Open',{'item':{'playlistid':pid,'position':num}})
   bot.run_cmd('fullscreen',['on'])
 
   # set last_played for bookmarking
@@ -714,14 +1200,45 @@ def _files(bot,args,dirs,pid):
 
   return msg+'Playlist from "'+match+'" starting with #'+str(num+1)
 
-def _file(bot,args,dirs):
+# @param bot (SibylBot) the bot
+# @param pid (int) the playlist to fill
+# @param files (list of str) every file in the playlist in order
+# @param num (int) the index of the file that's already in the playlist
+# @param cancel (Event) set if another playlist replaced this one
+def fill_playlist(bot,pid,files,num,cancel):
+  """add the rest of the files around the one that's already playing"""
+
+  # add what plays next first; xbmc moves its current position along when we
+  # insert before it, but only by one per call, so insert one file per call
+  calls = [('Playlist.Add',{'playlistid':pid,'item':{'file':f}})
+      for f in files[num+1:]]
+  calls += [('Playlist.Insert',{'playlistid':pid,'position':i,
+      'item':{'file':f}}) for (i,f) in enumerate(files[:num])]
+
+  for i in range(0,len(calls),PLAYLIST_BATCH):
+    if cancel.is_set():
+      return
+    try:
+      results = bot.xbmc_batch(calls[i:i+PLAYLIST_BATCH])
+    except requests.exceptions.RequestException as e:
+      log.error('Unable to fill playlist %s (%s)' % (pid,e))
+      return
+    for (call,result) in zip(calls[i:i+PLAYLIST_BATCH],results):
+      if 'error' in result:
+        log.warning('Unable to add to playlist: %s (%s)'
+            % (call[1]['item']['file'],result['error']['message']))
+
+def _file(bot,args,lib):
   """helper function for video() and audio()"""
 
   if not args:
     return 'You must specify a search term'
+  msg = bot.library_ready()
+  if msg:
+    return msg
 
   # find matches and respond if len(matches)!=1
-  matches = util.matches(dirs,args)
+  matches = bot.library_matches(lib,args)
 
   if len(matches)==0:
     return 'Found 0 matches'
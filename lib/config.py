@@ -90,6 +90,13 @@ class Config(object):
 ('idle_time',   (0.1,                 False,  self.parse_float,     self.valid_nump,    None)),
 ('idle_count',  (5,                   False,  self.parse_int,       self.valid_nump,    None)),
 ('idle_freq',   (1,                   False,  self.parse_int,       self.valid_nump,    None)),
+('thread_max',  (8,                   False,  self.parse_int,       self.valid_pos,     None)),
+('thread_ns',   (4,                   False,  self.parse_int,       self.valid_pos,     None)),
+('thread_backlog',(32,                False,  self.parse_int,       self.valid_pos,     None)),
+('rate_list',   ([],                  False,  self.parse_rate,      None,               None)),
+('rate_queue',  (5,                   False,  self.parse_int,       self.valid_nump,    None)),
+('send_rate',   ({},                  False,  self.parse_send,      None,               None)),
+('send_batch',  (1,                   False,  self.parse_int,       self.valid_nump,    None)),
 ('defer_total', (100,                 False,  self.parse_int,       None,               None)),
 ('defer_proto', (100,                 False,  self.parse_int,       None,               None)),
 ('defer_room',  (10,                  False,  self.parse_int,       None,               None)),
@@ -509,6 +516,12 @@ class Config(object):
 
     return (num>=0)
 
+  @staticmethod
+  def valid_pos(self,num):
+    """return True if the number is positive"""
+
+    return (num>0)
+
 ################################################################################
 #
 # Parse functions
@@ -685,6 +698,80 @@ class Config(object):
 
     return bw
 
+  # @return (list of tuple) rules as (scope,cmds,rate,burst)
+  @staticmethod
+  def parse_rate(self,opt,val):
+    """parse the rate_list into token bucket rules"""
+
+    val = val.replace('\n','')
+
+    # semi-colons divide separate rules and spaces divide fields
+    rules = []
+    for entry in util.split_strip(val,';'):
+      if entry=='':
+        continue
+
+      fields = [x for x in entry.split(' ') if x]
+      if len(fields) not in (3,4):
+        self.log('warning','ignoring rate entry "%s"; invalid syntax' % entry)
+        continue
+      (scope,cmds,rate) = fields[:3]
+      burst = (fields[3] if len(fields)>3 else '1')
+
+      if scope not in ('user','room','proto'):
+        self.log('warning','ignoring rate entry "%s"; invalid scope "%s"'
+            % (entry,scope))
+        continue
+      try:
+        (rate,burst) = (float(rate),int(burst))
+      except ValueError:
+        self.log('warning','ignoring rate entry "%s"; invalid number' % entry)
+        continue
+      if rate<=0 or burst<1:
+        self.log('warning','ignoring rate entry "%s"; rate and burst must be '
+            'positive' % entry)
+        continue
+
+      # commas allow for multiple cmds/plugins per rule
+      cmds = tuple(x for x in util.split_strip(cmds,',') if x)
+      rules.append((scope,cmds,rate,burst))
+
+    return rules
+
+  # @return (dict of str:tuple) protocol name or "*" mapped to (rate,burst)
+  @staticmethod
+  def parse_send(self,opt,val):
+    """parse send_rate into outgoing rates per protocol"""
+
+    val = val.replace('\n','')
+
+    # semi-colons divide separate protocols and spaces divide fields
+    rates = {}
+    for entry in util.split_strip(val,';'):
+      if entry=='':
+        continue
+
+      fields = [x for x in entry.split(' ') if x]
+      if len(fields) not in (2,3):
+        self.log('warning','ignoring send entry "%s"; invalid syntax' % entry)
+        continue
+      (pname,rate) = fields[:2]
+      burst = (fields[2] if len(fields)>2 else '1')
+
+      try:
+        (rate,burst) = (float(rate),int(burst))
+      except ValueError:
+        self.log('warning','ignoring send entry "%s"; invalid number' % entry)
+        continue
+      if rate<0 or burst<1:
+        self.log('warning','ignoring send entry "%s"; rate can\'t be negative '
+            'and burst must be positive' % entry)
+        continue
+
+      rates[pname] = (rate,burst)
+
+    return rates
+
   # @return (bool)
   @staticmethod
   def parse_bool(self,opt,val):
@@ -57,7 +57,8 @@ def botcmd(*args,**kwargs):
   # @param name (str) [function name] the name to respond to in chat
   # @param ctrl (bool) [False] whether to restrict the command with "chat_ctrl"
   # @param hidden (bool) [False] whether to hide this command from help output
-  # @param thread (bool) [False] whether to thread the command
+  # @param thread (bool,str) [False] whether to thread the command; cmds that
+  #   give the same str share a queue and run one at a time in order per user
   # @param raw (bool) [False] if True don't parse args; pass original text
   def decorate(func,name=None,ctrl=False,hidden=False,thread=False,raw=False):
     setattr(func, '_sibylbot_dec_chat', True)
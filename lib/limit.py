@@ -0,0 +1,298 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import time,collections
+
+class TokenBucket(object):
+  """allow rate events per second on average with bursts of up to burst"""
+
+  # @param rate (float) tokens added per second
+  # @param burst (int) max tokens the bucket can hold
+  # @param now (float) the current time
+  def __init__(self,rate,burst,now):
+
+    self.rate = float(rate)
+    self.burst = burst
+    self.tokens = float(burst)
+    self.stamp = now
+
+  # @param now (float) the current time
+  # @return (float) tokens in the bucket after refilling
+  def level(self,now):
+    """add the tokens earned since we last checked"""
+
+    if now>self.stamp:
+      self.tokens = min(self.burst,self.tokens+(now-self.stamp)*self.rate)
+      self.stamp = now
+    return self.tokens
+
+  # @param now (float) the current time
+  # @return (float) seconds until there's a token
+  def wait(self,now):
+    """how long until take() would succeed"""
+
+    return max(1-self.level(now),0)/self.rate
+
+class RateLimiter(object):
+  """token buckets for users, rooms, and protocols with a fair wait queue"""
+
+  # prune full buckets (equivalent to new ones) once we have this many
+  PRUNE = 1024
+
+  # @param rules (list of tuple) parsed rate_list option
+  def __init__(self,rules):
+
+    self.rules = rules
+    self.buckets = {}
+    self.queues = {}
+    self.order = collections.deque()
+    self.limited = 0
+    self.dropped = 0
+
+  # @param rules (list of tuple) parsed rate_list option
+  def set_rules(self,rules):
+    """start over with new rules, keeping cmds that are waiting"""
+
+    self.rules = rules
+    self.buckets = {}
+    for queue in self.queues.values():
+      for (i,(info,keys,item)) in enumerate(queue):
+        queue[i] = (info,self.keys(*info),item)
+
+  # @param pname (str) the protocol name
+  # @param user (str) the real user's base name
+  # @param room (Room,None) the room the cmd came from
+  # @param cmd (str) the cmd name
+  # @param ns (str) the plugin the cmd belongs to
+  # @return (list of tuple) keys for every bucket that applies to this cmd
+  def keys(self,pname,user,room,cmd,ns):
+    """find the rules that apply to a cmd"""
+
+    idents = {'user':(pname,user),'room':room,'proto':pname}
+    keys = []
+    for (i,(scope,cmds,rate,burst)) in enumerate(self.rules):
+      if '*' in cmds or cmd in cmds or ns+'.py' in cmds:
+        if idents[scope] is not None:
+          keys.append((i,idents[scope]))
+    return keys
+
+  # @param keys (list of tuple) from keys()
+  # @param now (float) the current time
+  # @return (bool) True if every bucket had a token (and we took one from each)
+  def take(self,keys,now):
+    """take a token from every bucket if they all have one"""
+
+    buckets = []
+    for key in keys:
+      if key not in self.buckets:
+        rule = self.rules[key[0]]
+        self.buckets[key] = TokenBucket(rule[2],rule[3],now)
+      buckets.append(self.buckets[key])
+
+    if any(b.level(now)<1 for b in buckets):
+      return False
+    for b in buckets:
+      b.tokens -= 1
+    return True
+
+  # @param user (str) the real user's base name
+  # @param info (tuple) args for keys()
+  # @param item (object) the cmd to hand back from ready()
+  # @param limit (int) max cmds a user may have waiting
+  # @return (bool,None) True if the cmd can run now, False if it must wait,
+  #   or None if it was dropped because the user already has limit waiting
+  def submit(self,user,info,item,limit):
+    """take tokens for a cmd or add it to the user's wait queue"""
+
+    keys = self.keys(*info)
+    if not keys:
+      return True
+
+    # cmds from a user who is already waiting go to the back of their queue
+    if user not in self.queues and self.take(keys,time.time()):
+      return True
+
+    if len(self.queues.get(user,()))>=limit:
+      self.dropped += 1
+      return None
+    if user not in self.queues:
+      self.queues[user] = collections.deque()
+      self.order.append(user)
+
+    self.queues[user].append((info,keys,item))
+    self.limited += 1
+    return False
+
+  # @param now (float) [time.time()] the current time
+  # @return (list) items from submit() that can run now in the order to run them
+  def ready(self,now=None):
+    """take turns letting each waiting user run one cmd"""
+
+    now = (time.time() if now is None else now)
+    items = []
+    progress = True
+    while progress and self.order:
+      progress = False
+
+      # users who get a turn go to the back of the line
+      for user in list(self.order):
+        queue = self.queues[user]
+        (info,keys,item) = queue[0]
+        if self.take(keys,now):
+          queue.popleft()
+          items.append(item)
+          progress = True
+          self.order.remove(user)
+          if queue:
+            self.order.append(user)
+          else:
+            del self.queues[user]
+
+    if len(self.buckets)>self.PRUNE:
+      for (key,bucket) in self.buckets.items():
+        if bucket.level(now)>=bucket.burst:
+          del self.buckets[key]
+
+    return items
+
+  # @param now (float) [time.time()] the current time
+  # @return (float,None) when the next waiting cmd can run or None if none are
+  def next_time(self,now=None):
+    """find the earliest time ready() will have something"""
+
+    if not self.queues:
+      return None
+    now = (time.time() if now is None else now)
+    waits = []
+    for queue in self.queues.values():
+      keys = queue[0][1]
+      waits.append(max([self.buckets[k].wait(now) for k in keys
+          if k in self.buckets]+[0]))
+    return now+min(waits)
+
+  # @return (dict) cmds delayed, cmds dropped, and cmds waiting right now
+  def stats(self):
+    """return counters for the stats cmd"""
+
+    return {'limited':self.limited,'dropped':self.dropped,
+        'waiting':sum(len(q) for q in self.queues.values())}
+
+class Outbox(object):
+  """per-destination queues of outgoing msgs for one protocol"""
+
+  # prune full buckets (equivalent to new ones) once we have this many
+  PRUNE = 1024
+
+  # @param rate (float) msgs per second to each destination (0 for no limit)
+  # @param burst (int) msgs allowed at once before the rate applies
+  # @param batch (int) max chars when joining queued msgs (0 or 1 to never join)
+  def __init__(self,rate,burst,batch):
+
+    self.rate = rate
+    self.burst = burst
+    self.batch = batch
+    self.buckets = {}
+    self.queues = {}
+    self.order = collections.deque()
+
+  # @param msg (Message) the msg to queue
+  def put(self,msg):
+    """add a msg to the back of its destination's queue"""
+
+    to = msg.get_to()
+    if to not in self.queues:
+      self.queues[to] = collections.deque()
+      self.order.append(to)
+    self.queues[to].append(msg)
+
+  # @param now (float) the current time
+  # @param shape (bool) [True] respect the rate (False to flush everything)
+  # @return (tuple of (Message,float)) the next msg to send or None, and if
+  #   there wasn't one the seconds until there will be (None for never)
+  def get(self,now,shape=True):
+    """take turns sending to each destination that has a token"""
+
+    wait = None
+    for to in list(self.order):
+      if shape and self.rate:
+        if to not in self.buckets:
+          self.buckets[to] = TokenBucket(self.rate,self.burst,now)
+        bucket = self.buckets[to]
+        if bucket.level(now)<1:
+          w = bucket.wait(now)
+          wait = (w if wait is None else min(wait,w))
+          continue
+        bucket.tokens -= 1
+
+      # destinations that get a turn go to the back of the line
+      msg = self.pop(self.queues[to])
+      self.order.remove(to)
+      if self.queues[to]:
+        self.order.append(to)
+      else:
+        del self.queues[to]
+
+      if len(self.buckets)>self.PRUNE:
+        for (key,bucket) in self.buckets.items():
+          if bucket.level(now)>=bucket.burst:
+            del self.buckets[key]
+
+      return (msg,None)
+
+    return (None,wait)
+
+  # @param queue (deque of Message) msgs waiting for one destination
+  # @return (Message) the first msg with any that can be joined to it
+  def pop(self,queue):
+    """join consecutive plain msgs into one as long as it stays small"""
+
+    msg = queue.popleft()
+    if not self.joinable(msg):
+      return msg
+
+    lines = [msg.get_text()]
+    size = len(lines[0])
+    while queue and self.joinable(queue[0]):
+      nxt = queue[0]
+      if (nxt.get_emote()!=msg.get_emote() or nxt.get_hook()!=msg.get_hook()
+          or size+1+len(nxt.get_text())>self.batch):
+        break
+      queue.popleft()
+      lines.append(nxt.get_text())
+      size += 1+len(lines[-1])
+
+    if len(lines)>1:
+      msg.set_text('\n'.join(lines))
+    return msg
+
+  # @param msg (Message) a queued msg
+  # @return (bool) whether msg may be joined with its neighbours
+  def joinable(self,msg):
+    """broadcasts and long msgs are always sent alone"""
+
+    return (self.batch>1 and not msg.get_broadcast()
+        and len(msg.get_text())<self.batch)
+
+  # @return (int) msgs waiting to be sent
+  def __len__(self):
+    return sum(len(q) for q in self.queues.values())
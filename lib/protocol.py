@@ -439,7 +439,8 @@ class Protocol(object):
   def shutdown(self):
     pass
 
-  # send a message to a user
+  # send a message to a user (called from this protocol's sender thread, never
+  # at the same time as process() or connect())
   # @param mess (Message) message to be sent
   # @raise (ConnectFailure) if failed to send message
   # Check: get_emote()
@@ -518,6 +519,14 @@ class Protocol(object):
   def new_room(self,name,nick=None,pword=None):
     pass
 
+  # things SibylBot can select() on to know when process() has work to do
+  # if process() handles messages queued by a thread, return [] and call
+  # bot._wake() whenever the thread queues something
+  # @return (list,None) file descriptors or objects with fileno(), or None if
+  #   process() must be polled
+  def get_fds(self):
+    return None
+
   # @param bot (SibylBot) the sibyl instance
   # @param log (Logger) the logger this protocol should use
   def __init__(self,bot,log):
@@ -39,6 +39,7 @@
 ################################################################################
 
 import sys,logging,re,os,imp,inspect,traceback,time,pickle,Queue,collections
+import select,errno
 
 from sibyl.lib.config import Config
 from sibyl.lib.protocol import Message,Room,User
@@ -46,7 +47,8 @@ from sibyl.lib.protocol import (ProtocolError,PingTimeout,ConnectFailure,
     AuthFailure,ServerShutdown)
 from sibyl.lib.decorators import botcmd,botrooms,botcon
 import sibyl.lib.util as util
-from sibyl.lib.thread import SmartThread
+from sibyl.lib.thread import Job,Executor,CmdQueue,Waker,Sender
+from sibyl.lib.limit import RateLimiter,Outbox
 
 __author__ = 'Joshua Haas <haas.josh.a@gmail.com>'
 __version__ = 'v6.0.0'
@@ -75,6 +77,8 @@ class SibylBot(object):
   MSG_ERROR_OCCURRED = 'Sorry for your inconvenience. '\
     'An unexpected error occurred.'
   MSG_UNHANDLED = 'Please consider reporting the above error to the developers.'
+  MSG_BUSY = 'Too busy to run "%(command)s" right now; try again later'
+  MSG_LIMITED = 'Too many cmds waiting; dropped "%(command)s"'
 
   # Bot state
   INIT = 0
@@ -82,10 +86,24 @@ class SibylBot(object):
   RUNNING = 2
   EXITED = 3
 
+  # seconds between process() calls for protocols without get_fds()
+  POLL = 0.1
+
+  # longest the main loop sleeps even if nothing is due (some protocols keep
+  # their own timers, e.g. xmpp pings)
+  WAIT_MAX = 1
+
+  # max (user,room,cmd) results match_bw() remembers before starting over
+  BW_CACHE = 4096
+
+  # max seconds each Sender gets to send what's left when we exit
+  SEND_FLUSH = 5
+
   def __init__(self,conf_file='sibyl.conf'):
     """create a new sibyl instance, load: conf, protocol, plugins"""
 
-    self.__stats = {'born':time.time(),'cmds':0,'ex':0,'forbid':0,'discon':0}
+    self.__stats = {'born':time.time(),'cmds':0,'ex':0,'forbid':0,'discon':0,
+        'busy':0}
     self.__status = SibylBot.INIT
 
     # keep track of errors for use with "errors" command
@@ -138,13 +156,20 @@ class SibylBot(object):
     self.__reboot = False
     self.__recons = {}
     self.__tell_rooms = []
-    self.__pending_send = Queue.Queue()
+    self.__unsent = Queue.Queue()
     self.__deferred = []
     self.__deferred_count = {}
     self.__pending_del = Queue.Queue()
     self.__last_idle = 0
     self.__idle_count = {}
     self.__idle_last = {}
+    self.__executor = Executor(self,self.opt('thread_max'),
+        self.opt('thread_ns'),self.opt('thread_backlog'))
+    self.__cmd_queue = CmdQueue(self,self.__executor)
+    self.__waker = Waker()
+    self.__bw = (None,{})
+    self.__bw_cache = {}
+    self.__limiter = RateLimiter(self.opt('rate_list'))
     self.last_cmd = {}
 
     # load persistent vars
@@ -161,6 +186,14 @@ class SibylBot(object):
     # create protocol objects
     self.protocols = {name:proto(self,logging.getLogger(name))
         for (name,proto) in self.opt('protocols').items()}
+
+    # each protocol sends from its own thread with its own rate
+    rates = self.opt('send_rate')
+    self.__senders = {}
+    for name in self.protocols:
+      (rate,burst) = rates.get(name,rates.get('*',(0,1)))
+      outbox = Outbox(rate,burst,self.opt('send_batch'))
+      self.__senders[name] = Sender(self,name,outbox,self.__deliver)
     self.__fix_state(self.__state,[])
 
     # load plug-in hooks from this file
@@ -451,7 +484,9 @@ class SibylBot(object):
 
       try:
         if getattr(func,'_sibylbot_dec_idle_thread'):
-          SmartThread(self,func,name=name).start()
+          if not self.__executor.submit(name.split('.')[0],
+              Job(self,func,name=name)):
+            self.log.warning('Too busy to run idle hook %s' % name)
         else:
           func(self)
 
@@ -596,17 +631,57 @@ class SibylBot(object):
       self.send('chat_ctrl is disabled',frm)
       return
 
-    # execute the command and catch exceptions
+    # wait for a turn if the user, room, or protocol is over its rate_list
+    if pname not in self.opt('admin_protos'):
+      if self.__limiter.rules is not self.opt('rate_list'):
+        self.__limiter.set_rules(self.opt('rate_list'))
+      info = (pname,real,mess.get_room(),cmd_name,self.ns_cmd[cmd_name])
+      result = self.__limiter.submit((pname,real),info,(mess,cmd,cmd_name,args),
+          self.opt('rate_queue'))
+      if result is None:
+        self.log.info('DROPPED: %s from %s:%s' % (cmd_name,pname,real))
+        self.send(self.MSG_LIMITED % {'command':cmd_name},frm)
+        return
+      elif not result:
+        self.log.debug('Rate limited cmd "%s" from %s:%s'
+            % (cmd_name,pname,real))
+        return
+
+    self.__run_cmd(mess,cmd,cmd_name,args)
+
+  # @param mess (Message) the message with the cmd
+  # @param cmd (str) the text of the cmd
+  # @param cmd_name (str) the name of the cmd to run
+  # @param args (list) the args to the cmd
+  def __run_cmd(self,mess,cmd,cmd_name,args):
+    """execute the command and catch exceptions"""
+
+    frm = mess.get_from()
+    usr = mess.get_user().get_base()
+    text = mess.get_text()
+    func = self.hooks['chat'].get(cmd_name)
+    if not func:
+      return
+
     reply = None
     self.__stats['cmds'] += 1
     if func._sibylbot_dec_chat_raw:
       args = cmd[cmd.find(' ')+1:]
+    thread = func._sibylbot_dec_chat_thread
     try:
-      if func._sibylbot_dec_chat_thread:
-        self.log.debug('Spawning new thread for cmd "%s"' % cmd_name)
-        SmartThread(self,func,mess,args).start()
+      if thread is True:
+        self.log.debug('Submitting cmd "%s" to the executor' % cmd_name)
+        queued = self.__executor.submit(self.ns_cmd[cmd_name],
+            Job(self,func,mess,args))
+      elif thread:
+        self.log.debug('Queueing cmd "%s" in thread "%s"' % (cmd_name,thread))
+        queued = self.__cmd_queue.submit(thread,usr,func,mess,args)
       else:
         reply = func(self,mess,args)
+      if thread and not queued:
+        self.log.warning('Too busy to run cmd "%s"' % cmd_name)
+        self.__stats['busy'] += 1
+        reply = self.MSG_BUSY % {'command':cmd_name}
     except Exception as e:
       self.__stats['ex'] += 1
       self.log_ex(e,
@@ -634,6 +709,11 @@ class SibylBot(object):
     self.log.error('Error joining room "%s" (%s)' % (room,error))
     self.__run_hooks('roomf',room,error)
 
+  def _wake(self):
+    """interrupt the main loop's wait (this function is thread-safe)"""
+
+    self.__waker.wake()
+
 ################################################################################
 # DDD - Helper functions
 ################################################################################
@@ -709,12 +789,6 @@ class SibylBot(object):
 
     to = msg.get_to()
     if msg.get_broadcast():
-      if self.has_plugin('room') and self.opt('room.bridge_broadcast'):
-        users = msg.get_users()
-        for room in self.get_bridged(to):
-          nick = room.get_protocol().get_nick(room)
-          users += [u for u in room.get_occupants() if u.get_name()!=nick]
-        msg.users = users
       frm = msg.get_from()
       if frm==frm.get_protocol().get_user():
         msg.user = None
@@ -725,8 +799,87 @@ class SibylBot(object):
     if msg.get_hook() and msg.get_text():
       self.__run_hooks('send',msg)
 
-  def __match_user(self,mess,rule_str):
-    """check if the black/white text matches protocol, user, room"""
+  # @param msg (Message) the msg to send
+  def __queue(self,msg):
+    """hand a msg to its protocol's Sender"""
+
+    self.__senders[msg.get_protocol().get_name()].put(msg)
+
+  # @param msg (Message) the msg to send
+  def __deliver(self,msg):
+    """send a msg or hand it back to be deferred (called by Sender threads)"""
+
+    proto = msg.get_protocol()
+    to = msg.get_to()
+    try:
+      if msg.get_broadcast():
+        self.__bridge_users(msg)
+
+      with self.__senders[proto.get_name()].lock:
+        if (proto.is_connected() and
+            (isinstance(to,User) or proto.in_room(to))):
+          self.__send(msg)
+        elif isinstance(to,User) or to in proto.get_rooms(Room.FLAG_ACTIVE):
+          self.__unsent.put((msg,None))
+          self._wake()
+        else:
+          self.log.warning('Attempted to send to inactive Room "%s"' % to)
+    except ProtocolError as e:
+      self.__unsent.put((msg,e))
+      self._wake()
+    except Exception as e:
+      self.log_ex(e,'Error sending %s msg' % proto.get_name())
+
+  # @param msg (Message) a broadcast msg
+  def __bridge_users(self,msg):
+    """also highlight the occupants of rooms bridged to the msg's room"""
+
+    if not (self.has_plugin('room') and self.opt('room.bridge_broadcast')):
+      return
+
+    # the bridged rooms may be on other protocols, so take their locks to read
+    # them, but only one at a time so two Senders can't deadlock
+    users = msg.get_users()
+    for room in self.get_bridged(msg.get_to()):
+      proto = room.get_protocol()
+      with self.__senders[proto.get_name()].lock:
+        nick = proto.get_nick(room)
+        users += [u for u in room.get_occupants() if u.get_name()!=nick]
+    msg.users = users
+
+  def __bw_compile(self):
+    """index bw_list by protocol and cmd/plugin so we only check those rules"""
+
+    index = collections.defaultdict(list)
+    for (i,rule) in enumerate(self.opt('bw_list')):
+
+      if rule[1]=='*':
+        (pname,test) = ('*',None)
+      else:
+        match = self.__bw_user(rule[1])
+        if not match:
+          continue
+        (pname,test) = match
+
+      # If it ends in '.py' it's a plugin name, otherwise it's a command name
+      cmd = rule[2].split(os.path.extsep)
+      if rule[2]=='*':
+        key = '*'
+      elif (len(cmd)>1) and (cmd[1]=='py') and (cmd[0] in self.plugins):
+        key = ('ns',cmd[0])
+      else:
+        key = ('cmd',rule[2])
+
+      index[(pname,key)].append((i,rule,test))
+
+    self.__bw = (self.opt('bw_list'),index)
+    self.__bw_cache = {}
+
+  # @param rule_str (str) the user field of a bw_list rule
+  # @return (tuple of (str,function),None) the protocol name and a test taking
+  #   a Message (None if the protocol is enough), or None if it can't match
+  def __bw_user(self,rule_str):
+    """parse the protocol, user, or room from a black/white rule"""
 
     rule = rule_str.split(':')
     rule[0] = rule[0].lower()
@@ -734,32 +887,21 @@ class SibylBot(object):
       rule[2] = ':'.join(rule[2:])
     proto = self.protocols.get(rule[1],None)
     if not proto:
-      return False
+      return None
 
     # Match protocols
     if rule[0]=='p':
-      return proto==mess.get_protocol()
+      return (rule[1],None)
 
     # Match rooms
     elif rule[0]=='r':
-      return proto.new_room(rule[2])==mess.get_room()
+      room = proto.new_room(rule[2])
+      return (rule[1],lambda m: room==m.get_room())
 
     # Match users
     elif rule[0]=='u':
-      return proto.new_user(rule[2]).base_match(mess.get_user().get_real())
-
-  def __match_cmd(self,name,rule_str):
-    """check if the black/white text matches plugin, cmd"""
-
-    rule = rule_str.split(os.path.extsep)
-
-    # If it ends in '.py' it's a plugin name
-    if (len(rule)>1) and (rule[1]=='py') and (rule[0] in self.plugins):
-      return rule[0]==self.ns_cmd[name]
-
-    # Otherwise it's a command name
-    else:
-      return rule_str==name
+      user = proto.new_user(rule[2])
+      return (rule[1],lambda m: user.base_match(m.get_user().get_real()))
 
   def __defer(self,msg):
     """add messages to __deferred_priv"""
@@ -803,7 +945,7 @@ class SibylBot(object):
       to = msg.get_to()
       proto = to.get_protocol()
       if match(msg):
-        self.__pending_send.put(msg)
+        self.__queue(msg)
         c[proto] -= 1
         if c[proto]==0:
           del c[proto]
@@ -930,11 +1072,19 @@ class SibylBot(object):
   def __stats_cmd(self,mess,args):
     """respond with some stats"""
 
+    pool = self.__executor.stats()
+    limit = self.__limiter.stats()
     return (('Born: %s --- Cmds-Run: %s --- Cmds-Forbid: %s --- ' +
-        'Cmds-Error: %s --- Disconnects: %s') %
+        'Cmds-Error: %s --- Cmds-Busy: %s --- Disconnects: %s --- ' +
+        'Threads: %s/%s active --- Queued: %s --- ' +
+        'Rate-Limited: %s --- Rate-Dropped: %s --- Rate-Waiting: %s --- ' +
+        'Sending: %s') %
         (time.asctime(time.localtime(self.__stats['born'])),
         self.__stats['cmds'],self.__stats['forbid'],
-        self.__stats['ex'],self.__stats['discon']))
+        self.__stats['ex'],self.__stats['busy'],self.__stats['discon'],
+        pool['active'],pool['workers'],pool['queued'],
+        limit['limited'],limit['dropped'],limit['waiting'],
+        sum(s.pending() for s in self.__senders.values())))
 
   @staticmethod
   @botcmd(name='uptime')
@@ -1039,17 +1189,20 @@ class SibylBot(object):
   def __serve(self):
     """process loop - connect and process messages"""
 
+    # the Sender for each protocol can't send while we're using it here
     for (name,proto) in self.protocols.items():
       if proto.is_connected():
-        proto.process()
+        with self.__senders[name].lock:
+          proto.process()
       else:
         if (name not in self.__recons) or (self.__recons[name]<time.time()):
-          self.__run_hooks('recon',name)
-          proto.connect()
-          self.__run_hooks('con',name)
-          for room in self.opt('rooms').get(name,[]):
-            pword = room['pass'] and room['pass'].get()
-            proto.join_room(proto.new_room(room['room'],room['nick'],pword))
+          with self.__senders[name].lock:
+            self.__run_hooks('recon',name)
+            proto.connect()
+            self.__run_hooks('con',name)
+            for room in self.opt('rooms').get(name,[]):
+              pword = room['pass'] and room['pass'].get()
+              proto.join_room(proto.new_room(room['room'],room['nick'],pword))
           if name in self.__recons:
             del self.__recons[name]
 
@@ -1067,7 +1220,7 @@ class SibylBot(object):
       try:
         self.__serve()
         self.__idle_proc()
-        time.sleep(0.1)
+        self.__wait()
 
       except (PingTimeout,ConnectFailure,ServerShutdown) as e:
         name = e.protocol
@@ -1102,10 +1255,49 @@ class SibylBot(object):
       except SigTermInterrupt:
         self.quit('stopped by SIGTERM')
 
+  def __wait(self):
+    """block until a protocol has data, another thread wakes us, or a timer"""
+
+    now = time.time()
+    timeout = self.WAIT_MAX
+    fds = [self.__waker]
+
+    for (name,proto) in self.protocols.items():
+      if name in self.__recons:
+        timeout = min(timeout,self.__recons[name]-now)
+      elif not proto.is_connected():
+        timeout = 0
+      else:
+        proto_fds = proto.get_fds()
+        if proto_fds is None:
+          timeout = min(timeout,self.POLL)
+        else:
+          fds.extend(proto_fds)
+
+    if self.opt('idle_count')>0:
+      timeout = min(timeout,self.__last_idle+self.opt('idle_freq')-now)
+
+    limited = self.__limiter.next_time(now)
+    if limited is not None:
+      timeout = min(timeout,limited-now)
+
+    # a protocol may have closed its socket since process(); if so sleep like
+    # we used to and let the next process() notice
+    if timeout>0:
+      try:
+        select.select(fds,[],[],timeout)
+      except (select.error,IOError,ValueError) as e:
+        if not e.args or e.args[0]!=errno.EINTR:
+          time.sleep(min(timeout,self.POLL))
+
+    # anything that wakes us after this point will be handled by the next pass
+    self.__waker.clear()
+
   def __idle_proc(self):
     """This function will be called in the main loop."""
 
     self.__idle_del()
+    self.__idle_limited()
     self.__idle_send()
 
     if (self.opt('idle_count')>0
@@ -1133,28 +1325,29 @@ class SibylBot(object):
             if dec=='chat':
               del self.ns_cmd[name]
 
+  def __idle_limited(self):
+    """run rate limited cmds whose turn has come"""
+
+    for (mess,cmd,cmd_name,args) in self.__limiter.ready():
+      self.__run_cmd(mess,cmd,cmd_name,args)
+
   def __idle_send(self):
-    """send queued messages synchronously"""
+    """defer messages the Senders couldn't send"""
 
-    while not self.__pending_send.empty():
-      try:
-        msg = self.__pending_send.get()
-        proto = msg.get_protocol()
-        to = msg.get_to()
-        if (proto.is_connected() and
-            (isinstance(to,User) or proto.in_room(to))):
-          self.__send(msg)
-        else:
-          if isinstance(to,User) or to in proto.get_rooms(Room.FLAG_ACTIVE):
-            self.__defer(msg)
-          else:
-            self.log.warning('Attempted to send to inactive Room "%s"' % to)
-      except ProtocolError as e:
-        self.__defer(msg)
-        if msg.get_protocol().is_connected():
-          raise e
-      except Exception as e:
-        self.log_ex(e,'Error sending %s msg' % msg.get_protocol().get_name())
+    while not self.__unsent.empty():
+      (msg,e) = self.__unsent.get()
+      proto = msg.get_protocol()
+      to = msg.get_to()
+
+      # we may have connected or joined since the Sender checked
+      if (e is None and proto.is_connected() and
+          (isinstance(to,User) or proto.in_room(to))):
+        self.__queue(msg)
+        continue
+
+      self.__defer(msg)
+      if e and proto.is_connected():
+        raise e
 
   @staticmethod
   @botcon
@@ -1191,7 +1384,8 @@ class SibylBot(object):
       self.__run_forever()
 
       # send any pending messages before disconnecting
-      self.__idle_send()
+      for sender in self.__senders.values():
+        sender.stop(self.SEND_FLUSH)
 
     except Exception as e:
       self.log.critical('UNHANDLED: %s\n\n%s' %
@@ -1202,6 +1396,7 @@ class SibylBot(object):
     for proto in self.protocols.values():
       proto.shutdown()
     self.__run_hooks('down')
+    self.__executor.stop()
 
     if self.opt('persistence'):
       d = {}
@@ -1237,7 +1432,7 @@ class SibylBot(object):
                   users=users,
                   hook=hook,
                   emote=emote)
-    self.__pending_send.put(msg)
+    self.__queue(msg)
 
   # wrapper method for send() allowing to pass Message objects instead of User
   # @param text (str,unicode) the text to send
@@ -1270,6 +1465,7 @@ class SibylBot(object):
       self.log.critical(msg)
     else:
       self.log.critical('SibylBot.quit() called, but no reason given')
+    self._wake()
 
   # @param msg (str) [None] message to log
   def reboot(self,msg=None):
@@ -1374,6 +1570,7 @@ class SibylBot(object):
     """delete a hook (this function is thread-safe)"""
 
     self.__pending_del.put((func,dec))
+    self._wake()
 
   # @param plugin (str) [None] name of plugin to check for, or return all
   # @return (bool,list) True if the plugin was loaded, or list all
@@ -1395,14 +1592,34 @@ class SibylBot(object):
 
     pname = mess.get_protocol().get_name()
     if pname in self.opt('admin_protos'):
-      applied = ('w','proto:'+pname,'*')
-    else:
-      for rule in self.opt('bw_list'):
-        if (rule[1]!='*') and (not self.__match_user(mess,rule[1])):
-          continue
-        if (rule[2]!='*') and (not self.__match_cmd(cmd_name,rule[2])):
-          continue
+      return ('w','proto:'+pname,'*')
+
+    # config set/reload always replace the list, so recompile when it changes
+    if self.__bw[0] is not self.opt('bw_list'):
+      self.__bw_compile()
+
+    real = mess.get_user().get_real()
+    key = (pname,real and real.get_base(),mess.get_room(),cmd_name)
+    applied = self.__bw_cache.get(key)
+    if applied:
+      return applied
+
+    # the last matching rule wins, so check candidates from the end
+    index = self.__bw[1]
+    rules = []
+    for proto in ('*',pname):
+      for cmd in ('*',('cmd',cmd_name),('ns',self.ns_cmd.get(cmd_name))):
+        rules.extend(index.get((proto,cmd),[]))
+    rules.sort(key=lambda r:r[0],reverse=True)
+
+    for (i,rule,test) in rules:
+      if test is None or test(mess):
         applied = rule
+        break
+
+    if len(self.__bw_cache)>=self.BW_CACHE:
+      self.__bw_cache = {}
+    self.__bw_cache[key] = applied
     return applied
 
   # @param name (str) name of the command to check
@@ -1440,6 +1657,7 @@ class SibylBot(object):
 
     self.hooks['chat'][name] = func
     self.ns_cmd[name] = ns
+    self.__bw_cache = {}
     self.log.debug('  Registered chat command: %s.%s = %s'
         % (ns,func.__name__,name))
     return True
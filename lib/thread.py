@@ -21,16 +21,13 @@
 #
 ################################################################################
 
-import threading,traceback
+import os,time,fcntl,errno,threading,traceback,collections
 
-class SmartThread(threading.Thread):
-  """smart threads log exceptions"""
+class Job(object):
+  """threaded cmds and idle hooks log their own exceptions"""
 
   def __init__(self,bot,func,mess=None,args=None,name=None):
 
-    super(SmartThread,self).__init__()
-    self.daemon = True
-
     self.bot = bot
     self.func = func
     self.mess = mess
@@ -68,3 +65,268 @@ class SmartThread(threading.Thread):
       self.bot.log_ex(e,
           'Error while executing threaded idle hook "%s":' % self.name)
       self.bot.del_hook(self.func,'idle')
+
+class Executor(object):
+  """fixed pool of worker threads for threaded cmds and idle hooks"""
+
+  # @param bot (SibylBot) the bot
+  # @param size (int) max number of worker threads
+  # @param per_ns (int) max jobs from one namespace running at once
+  # @param backlog (int) max jobs waiting for a worker
+  def __init__(self,bot,size,per_ns,backlog):
+
+    self.bot = bot
+    self.size = size
+    self.per_ns = per_ns
+    self.backlog = backlog
+
+    # workers are started as needed and then wait on cond for more jobs
+    self.cond = threading.Condition()
+    self.pending = collections.deque()
+    self.running = collections.Counter()
+    self.workers = 0
+    self.idle = 0
+    self.rejected = 0
+    self.finished = False
+
+  # @param ns (str) the namespace (usually plugin) to count the job against
+  # @param job (Job) the job to run
+  # @return (bool) False if the backlog is full and the job was dropped
+  def submit(self,ns,job):
+    """queue a job to run on the next free worker"""
+
+    with self.cond:
+      if len(self.pending)>=self.backlog:
+        self.rejected += 1
+        return False
+      self.pending.append((ns,job))
+
+      # start another worker if the idle ones can't take everything
+      if self.idle<len(self.pending) and self.workers<self.size:
+        self.workers += 1
+        t = threading.Thread(target=self.work,name='worker-%s' % self.workers)
+        t.daemon = True
+        t.start()
+      self.cond.notify_all()
+
+    return True
+
+  # @return (tuple of (str,Job)) the first (ns,job) allowed to run or None
+  def take(self):
+    """pop the oldest job whose namespace is under its cap (hold cond)"""
+
+    for (i,(ns,job)) in enumerate(self.pending):
+      if self.running[ns]<self.per_ns:
+        del self.pending[i]
+        self.running[ns] += 1
+        return (ns,job)
+    return None
+
+  def work(self):
+    """run jobs until stop() (target of worker threads)"""
+
+    while True:
+      with self.cond:
+        item = self.take()
+        while item is None:
+          if self.finished:
+            return
+          self.idle += 1
+          self.cond.wait()
+          self.idle -= 1
+          item = self.take()
+
+      (ns,job) = item
+      try:
+        job.run()
+      except Exception as e:
+        self.bot.log_ex(e,'Unhandled exception in worker for "%s"' % job.name)
+      finally:
+        with self.cond:
+          self.running[ns] -= 1
+          self.cond.notify_all()
+
+  def stop(self):
+    """let workers exit once the backlog is empty"""
+
+    with self.cond:
+      self.finished = True
+      self.cond.notify_all()
+
+  # @return (dict) active workers, total workers, queued jobs, rejected jobs
+  def stats(self):
+    """return a snapshot of the pool"""
+
+    with self.cond:
+      return {'active':sum(self.running.values()),'workers':self.workers,
+          'queued':len(self.pending),'rejected':self.rejected}
+
+class CmdQueue(object):
+  """run threaded cmds that share a queue name in order for each user"""
+
+  # @param bot (SibylBot) the bot
+  # @param executor (Executor) the pool to run each user's queue on
+  def __init__(self,bot,executor):
+
+    self.bot = bot
+    self.executor = executor
+    self.lock = threading.Lock()
+    self.queues = {}
+
+  # @param name (str) the queue name from @botcmd(thread=name)
+  # @param user (str) the user who sent the cmd
+  # @param func (function) the chat cmd
+  # @param mess (Message) the triggering Message
+  # @param args (list) the args to the cmd
+  # @return (bool) False if the queue or the executor is full
+  def submit(self,name,user,func,mess,args):
+    """run the cmd once the user's earlier cmds in this queue are done"""
+
+    key = (name,user)
+    with self.lock:
+      if key in self.queues:
+        if len(self.queues[key])>=self.executor.backlog:
+          return False
+        self.queues[key].append((func,mess,args))
+        return True
+
+      # the whole queue counts as one job in the executor's name namespace
+      if not self.executor.submit(name,QueueJob(self,key)):
+        return False
+      self.queues[key] = collections.deque([(func,mess,args)])
+      return True
+
+  # @param key (tuple of (str,str)) the (name,user) of the queue
+  # @return (tuple) the next (func,mess,args) or None if the queue is done
+  def next(self,key):
+    """pop the next cmd from a queue, removing the queue once it's empty"""
+
+    with self.lock:
+      queue = self.queues[key]
+      if not queue:
+        del self.queues[key]
+        return None
+      return queue.popleft()
+
+class QueueJob(Job):
+  """run cmds from one CmdQueue queue until it's empty"""
+
+  def __init__(self,queue,key):
+
+    super(QueueJob,self).__init__(queue.bot,None,name='%s:%s' % key)
+    self.queue = queue
+    self.key = key
+
+  def run(self):
+
+    job = self.queue.next(self.key)
+    while job:
+      (self.func,self.mess,self.args) = job
+      self.name = self.func._sibylbot_dec_chat_name
+      self.run_cmd()
+      job = self.queue.next(self.key)
+
+class Waker(object):
+  """self-pipe that lets any thread interrupt a select() in the main loop"""
+
+  def __init__(self):
+
+    (self.read,self.write) = os.pipe()
+    for fd in (self.read,self.write):
+      flags = fcntl.fcntl(fd,fcntl.F_GETFL)
+      fcntl.fcntl(fd,fcntl.F_SETFL,flags|os.O_NONBLOCK)
+
+  # @return (int) the file descriptor to select() on
+  def fileno(self):
+    return self.read
+
+  def wake(self):
+    """make the read end readable (this function is thread-safe)"""
+
+    # if the pipe is full we're already awake
+    try:
+      os.write(self.write,'.')
+    except OSError as e:
+      if e.errno not in (errno.EAGAIN,errno.EWOULDBLOCK):
+        raise
+
+  def clear(self):
+    """empty the pipe so the next select() blocks"""
+
+    try:
+      while os.read(self.read,4096):
+        pass
+    except OSError as e:
+      if e.errno not in (errno.EAGAIN,errno.EWOULDBLOCK):
+        raise
+
+  def close(self):
+
+    os.close(self.read)
+    os.close(self.write)
+
+class Sender(object):
+  """send msgs for one protocol from its own thread"""
+
+  # @param bot (SibylBot) the bot
+  # @param name (str) the protocol name
+  # @param outbox (Outbox) queues msgs and decides which to send next
+  # @param send (function) called with each Message in this Sender's thread;
+  #   it must hold self.lock while it uses the protocol
+  def __init__(self,bot,name,outbox,send):
+
+    self.bot = bot
+    self.name = name
+    self.outbox = outbox
+    self.send = send
+
+    # held while sending, and by SibylBot while it processes or reconnects
+    # the protocol, so a protocol is never used from two threads at once
+    self.lock = threading.RLock()
+
+    self.cond = threading.Condition()
+    self.finished = False
+    self.thread = threading.Thread(target=self.work,name='sender-%s' % name)
+    self.thread.daemon = True
+    self.thread.start()
+
+  # @param msg (Message) the msg to send
+  def put(self,msg):
+    """queue a msg (this function is thread-safe)"""
+
+    with self.cond:
+      self.outbox.put(msg)
+      self.cond.notify()
+
+  def work(self):
+    """send msgs until stop() (target of the sender thread)"""
+
+    while True:
+      with self.cond:
+        while True:
+          (msg,wait) = self.outbox.get(time.time(),not self.finished)
+          if msg or self.finished:
+            break
+          self.cond.wait(wait)
+
+      if msg is None:
+        return
+      try:
+        self.send(msg)
+      except Exception as e:
+        self.bot.log_ex(e,'Unhandled exception in sender for "%s"'
+            % self.name)
+
+  # @param timeout (float) max seconds to wait for queued msgs to send
+  def stop(self,timeout):
+    """send everything left ignoring the rate and then exit"""
+
+    with self.cond:
+      self.finished = True
+      self.cond.notify()
+    self.thread.join(timeout)
+
+  # @return (int) msgs waiting to be sent
+  def pending(self):
+    with self.cond:
+      return len(self.outbox)
@@ -21,7 +21,8 @@
 #
 ################################################################################
 
-import os,requests,json,imp,inspect
+import os,re,requests,json,imp,inspect,threading,itertools,socket,time
+import subprocess,Queue,functools
 
 # @param s (str) the string to split
 # @param sep (str) [' '] the string on which to split
@@ -56,20 +57,551 @@ def xbmc(ip,method,params=None,user=None,pword=None,timeout=5):
   """make a JSON-RPC request to xbmc and return the resulti as a dict
   or None if ConnectionError or Timeout"""
 
-  # build a json call with the requests library
-  p = {'jsonrpc':'2.0','id':1,'method':method}
-  if params is not None:
-    p['params'] = params
+  return xbmc_client(ip,user,pword).call(method,params,timeout)
 
-  url = 'http://'+ip+'/jsonrpc'
-  headers = {'content-type':'application/json'}
-  payload = p
-  params = {'request':json.dumps(payload)}
-  auth = (user,pword)
-  r = requests.get(url,params=params,headers=headers,auth=auth,timeout=timeout)
+# @param ip (str) the IP, including port, of XBMC/Kodi/OSMC/etc.
+# @param calls (list of tuple) (method,params) for each call (params can be None)
+# @param user (str) [None] the username to login to XBMC's web server
+# @param pword (str) [None] the password to login to XBMC's web server
+# @return (list of dict) the response from XBMC to each call in order
+def xbmc_batch(ip,calls,user=None,pword=None,timeout=5):
+  """make several JSON-RPC requests to xbmc in one round trip"""
+
+  return xbmc_client(ip,user,pword).batch(calls,timeout)
+
+XBMC_CLIENTS = {}
+XBMC_LOCK = threading.Lock()
+
+# @param ip (str) the IP, including port, of XBMC/Kodi/OSMC/etc.
+# @param user (str) [None] the username to login to XBMC's web server
+# @param pword (str) [None] the password to login to XBMC's web server
+# @return (XbmcClient) the shared client for the given host and login
+def xbmc_client(ip,user=None,pword=None):
+  """return the client for a host, creating it on first use"""
+
+  with XBMC_LOCK:
+    key = (ip,user,pword)
+    if key not in XBMC_CLIENTS:
+      XBMC_CLIENTS[key] = XbmcClient(ip,user,pword)
+    return XBMC_CLIENTS[key]
+
+# decorated function: func(bot,mess,args)
+# @param hosts (bool) [False] let the cmd run if its first arg names xbmc
+#   hosts, since it will fan out and each host answers for itself
+def xbmc_cmd(*args,**kwargs):
+  """Decorator for chat cmds that reply with bot.xbmc_down() instead"""
+
+  def decorate(func,hosts=False):
+    @functools.wraps(func)
+    def check(bot,mess,args):
+      down = bot.xbmc_down(hosts=(hosts and args and args[0]))
+      if down:
+        return down
+      return func(bot,mess,args)
+    return check
+
+  if len(args):
+    return decorate(args[0],**kwargs)
+  else:
+    return lambda func: decorate(func,**kwargs)
+
+class XbmcUnavailable(requests.exceptions.ConnectionError):
+  """raised instead of trying to reach an XBMC host that's been failing"""
+
+  pass
+
+class XbmcClient(object):
+  """JSON-RPC client that keeps connections to one XBMC host alive"""
+
+  # connections to keep open (only threaded cmds need more than one)
+  POOL = 4
+
+  # consecutive failed requests before we stop trying (0 to never stop)
+  FAILURES = 3
+
+  # @param ip (str) the IP, including port, of XBMC/Kodi/OSMC/etc.
+  # @param user (str) [None] the username to login to XBMC's web server
+  # @param pword (str) [None] the password to login to XBMC's web server
+  def __init__(self,ip,user=None,pword=None):
+
+    self.ip = ip
+    self.url = 'http://'+ip+'/jsonrpc'
+    self.session = requests.Session()
+    self.session.headers['content-type'] = 'application/json'
+    if user is not None:
+      self.session.auth = (user,pword)
+
+    # urllib3 gives each thread its own connection from the pool
+    self.adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,pool_maxsize=self.POOL)
+    self.session.mount('http://',self.adapter)
+
+    self.ids = itertools.count(1)
+    self.lock = threading.Lock()
+    self.requests = 0
+
+    # once the circuit trips every request fails until probe() succeeds
+    self.threshold = self.FAILURES
+    self.failures = 0
+
+  # @param method (str) the JSON-RPC method to call
+  # @param params (dict) [None] the parameters to use for the method
+  # @param timeout (int) [5] seconds to wait for a response
+  # @return (dict) the response from XBMC
+  def call(self,method,params=None,timeout=5):
+    """make a JSON-RPC request"""
+
+    return self.post(self.payload(method,params),timeout)
+
+  # @param calls (list of tuple) (method,params) for each call
+  # @param timeout (int) [5] seconds to wait for a response
+  # @return (list of dict) the response from XBMC to each call in order
+  def batch(self,calls,timeout=5):
+    """make several JSON-RPC requests in a single HTTP request"""
+
+    payload = [self.payload(method,params) for (method,params) in calls]
+    result = self.post(payload,timeout)
+
+    # errors about the batch itself come back as a single response
+    if isinstance(result,dict):
+      return [result]*len(calls)
+
+    # responses can be in any order so match them up by id
+    responses = {x.get('id'):x for x in result}
+    missing = {'error':{'code':-32603,'message':'No response'}}
+    return [responses.get(p['id'],missing) for p in payload]
+
+  # @param method (str) the JSON-RPC method to call
+  # @param params (dict) the parameters to use for the method (or None)
+  # @return (dict) the JSON-RPC request object
+  def payload(self,method,params):
+    """build a request with a unique id"""
+
+    with self.lock:
+      p = {'jsonrpc':'2.0','id':next(self.ids),'method':method}
+    if params is not None:
+      p['params'] = params
+    return p
+
+  # @param payload (dict,list) one request or a list of them
+  # @param timeout (int) seconds to wait for a response
+  # @return (dict,list) the decoded response
+  # @raise (XbmcUnavailable) if the circuit is open
+  def post(self,payload,timeout):
+    """send requests to XBMC"""
+
+    if self.tripped():
+      raise XbmcUnavailable('XBMC at %s is unreachable' % self.ip)
+
+    with self.lock:
+      self.requests += 1
+
+    try:
+      r = self.session.post(self.url,data=json.dumps(payload),timeout=timeout)
+    except (requests.exceptions.ConnectionError,requests.exceptions.Timeout):
+      with self.lock:
+        self.failures += 1
+      raise
+
+    with self.lock:
+      self.failures = 0
+
+    # return the response from xbmc as a dict
+    return json.loads(r.text)
+
+  # @return (bool) True if requests are failing fast
+  def tripped(self):
+    """return True if the circuit is open"""
+
+    return bool(self.threshold) and self.failures>=self.threshold
+
+  # @param timeout (int) [5] seconds to wait for a response
+  # @return (bool) True if XBMC responded (which also closes the circuit)
+  def probe(self,timeout=5):
+    """ping XBMC even if the circuit is open"""
+
+    payload = self.payload('JSONRPC.Ping',None)
+    try:
+      self.session.post(self.url,data=json.dumps(payload),timeout=timeout)
+    except requests.exceptions.RequestException:
+      return False
+
+    with self.lock:
+      self.failures = 0
+    return True
 
-  # return the response from xbmc as a dict
-  return json.loads(r.text)
+  # @return (tuple of (int,int)) the number of (requests,connections) made
+  def stats(self):
+    """return how many requests were made and how many connections opened"""
+
+    pool = self.adapter.poolmanager.connection_from_url(self.url)
+    return (self.requests,pool.num_connections)
+
+  def close(self):
+    """close all connections"""
+
+    self.session.close()
+
+class XbmcMirror(threading.Thread):
+  """keep a copy of XBMC's player state using its TCP notification socket"""
+
+  RETRY = 10        # seconds to wait before reconnecting
+  MAX_BUF = 2**20   # give up on a connection sending us garbage
+
+  # @param ip (str) the IP, without port, of XBMC/Kodi/OSMC/etc.
+  # @param port (int) the TCP port of XBMC's JSON-RPC server
+  # @param log (Logger) [None] where to log connects and disconnects
+  def __init__(self,ip,port,log=None):
+
+    super(XbmcMirror,self).__init__()
+    self.daemon = True
+    self.name = 'xbmc-mirror'
+
+    self.addr = (ip,port)
+    self.log = log
+    self.finished = False
+    self.sock = None
+
+    # every player notification starts a new refresh; responses to an older
+    # refresh are ignored so they can't overwrite newer state
+    self.lock = threading.Lock()
+    self.connected = False
+    self.refreshing = False
+    self.gen = 0
+    self.state = None
+    self.next = None
+    self.stamp = 0
+    self.asked = 0
+    self.synced = 0     # when we asked for the state we have now
+
+  def run(self):
+
+    while not self.finished:
+      try:
+        self.connect()
+        self.serve()
+      except (socket.error,ValueError) as e:
+        if self.log and not self.finished:
+          self.log.debug('Lost xbmc notifications at %s:%s (%s)'
+              % (self.addr+(e,)))
+      finally:
+        self.disconnect()
+
+      # sleep in short steps so stop() doesn't have to wait for us
+      for i in range(self.RETRY*10):
+        if self.finished:
+          break
+        time.sleep(0.1)
+
+  def stop(self):
+    """close the connection and exit the thread"""
+
+    self.finished = True
+    self.disconnect()
+
+  def connect(self):
+    """open the socket and start the first refresh"""
+
+    self.sock = socket.create_connection(self.addr,timeout=5)
+    self.sock.settimeout(1)
+    with self.lock:
+      self.connected = True
+      self.refresh()
+    if self.log:
+      self.log.debug('Connected to xbmc notifications at %s:%s' % self.addr)
+
+  def disconnect(self):
+    """close the socket and forget the state"""
+
+    with self.lock:
+      self.connected = False
+      self.state = None
+    if self.sock:
+      try:
+        self.sock.close()
+      except socket.error:
+        pass
+
+  def serve(self):
+    """decode messages as they arrive on the socket"""
+
+    # XBMC doesn't delimit messages so decode objects back-to-back
+    decoder = json.JSONDecoder()
+    buf = ''
+    while not self.finished:
+      try:
+        data = self.sock.recv(65536)
+      except socket.timeout:
+        continue
+      if not data:
+        raise socket.error('connection closed')
+
+      buf += data
+      while True:
+        start = json.decoder.WHITESPACE.match(buf).end()
+        try:
+          (msg,end) = decoder.raw_decode(buf,start)
+        except ValueError:
+          buf = buf[start:]
+          break
+        buf = buf[end:]
+        self.handle(msg)
+
+      if len(buf)>self.MAX_BUF:
+        raise ValueError('message too long')
+
+  # @param msg (dict) a notification or a response to one of our requests
+  def handle(self,msg):
+    """update the mirror from a message"""
+
+    with self.lock:
+      if msg.get('method','').startswith('Player.'):
+        self.refresh()
+      elif isinstance(msg.get('id'),basestring):
+        self.response(msg)
+
+  def refresh(self):
+    """ask XBMC for the player state (must hold self.lock)"""
+
+    self.gen += 1
+    self.refreshing = True
+    self.asked = time.time()
+    self.next = {}
+    self.send('active',None,'Player.GetActivePlayers')
+
+  # @param msg (dict) a response to one of our requests
+  def response(self,msg):
+    """collect responses until we have the whole state (must hold self.lock)"""
+
+    (name,gen) = msg['id'].split('/')[:2]
+    if int(gen)!=self.gen:
+      return
+    if 'error' in msg:
+      self.refreshing = False
+      self.state = None
+      return
+
+    if name=='active':
+      active = xbmc_player(msg)
+      self.next['active'] = active
+      if active is None:
+        return self.commit()
+      pid = active[0]
+      self.send('props',pid,'Player.GetProperties',{'playerid':pid,
+          'properties':['speed','position','time','totaltime']})
+      self.send('item',pid,'Player.GetItem',
+          {'playerid':pid,'properties':['file']})
+    elif name=='props':
+      self.next.update(msg['result'])
+      self.stamp = time.time()
+    elif name=='item':
+      self.next['item'] = msg['result']['item']
+
+    if 'speed' in self.next and 'item' in self.next:
+      self.commit()
+
+  def commit(self):
+    """publish the state we've collected (must hold self.lock)"""
+
+    self.state = self.next
+    self.synced = self.asked
+    self.refreshing = False
+
+  # @param name (str) what the response will contain
+  # @param pid (int) the player the request is about (or None)
+  # @param method (str) the JSON-RPC method to call
+  # @param params (dict) [None] the parameters to use for the method
+  def send(self,name,pid,method,params=None):
+    """send a request tagged with the current refresh"""
+
+    p = {'jsonrpc':'2.0','id':'%s/%s/%s' % (name,self.gen,pid),
+        'method':method}
+    if params is not None:
+      p['params'] = params
+    self.sock.sendall(json.dumps(p))
+
+  def invalidate(self):
+    """refresh now because we just changed something without a notification"""
+
+    # until the refresh finishes snapshot() returns None so callers ask xbmc
+    with self.lock:
+      if not self.connected:
+        return
+      try:
+        self.refresh()
+      except socket.error:
+        self.state = None
+
+  # @return (dict) the player state or None if it might be out of date
+  def snapshot(self):
+    """return the current state if we have it"""
+
+    with self.lock:
+      if not self.connected or self.refreshing or self.state is None:
+        return None
+      state = dict(self.state)
+      elapsed = time.time()-self.stamp
+
+    # the only thing that changes without a notification is the time
+    if state['active'] and state.get('speed'):
+      t = time2sec(state['time'])+int(elapsed*state['speed'])
+      total = time2sec(state['totaltime'])
+      if total:
+        t = min(t,total)
+      state['time'] = str2time(sec2str(max(t,0)))
+    return state
+
+class CecError(Exception):
+  """raised when cec-client won't start or doesn't answer"""
+
+  pass
+
+class CecClient(object):
+  """long-lived cec-client process that we write cmds to one at a time"""
+
+  START = 15    # seconds to wait for cec-client to open the adapter
+  REPLY = 5     # seconds to wait for a response to a cmd
+
+  # lines cec-client prints once it's ready for input
+  READY = ('waiting for input','connection opened')
+
+  # @param cmd (list of str) the cec-client executable and its arguments
+  # @param log (Logger) [None] where to log starts and restarts
+  def __init__(self,cmd,log=None):
+
+    self.cmd = cmd
+    self.log = log
+    self.lock = threading.Lock()
+    self.proc = None
+    self.lines = None
+    self.ready = None
+    self.starts = 0
+
+  def start(self):
+    """start cec-client and wait until it opens the adapter"""
+
+    self.kill()
+    PIPE = subprocess.PIPE
+    self.proc = subprocess.Popen(self.cmd,stdin=PIPE,stdout=PIPE,
+        stderr=subprocess.STDOUT,close_fds=True)
+    self.starts += 1
+
+    # each process gets its own queue so a dying reader can't confuse the next
+    self.lines = Queue.Queue()
+    self.ready = threading.Event()
+    t = threading.Thread(target=self.read,
+        args=(self.proc,self.lines,self.ready),name='cec-reader')
+    t.daemon = True
+    t.start()
+
+    self.ready.wait(self.START)
+    if not self.ready.is_set():
+      self.kill()
+      raise CecError('cec-client did not open the adapter')
+    if self.log:
+      self.log.debug('Started cec-client (pid %s)' % self.proc.pid)
+
+  # @param proc (Popen) the cec-client process
+  # @param lines (Queue) where to put lines of output
+  # @param ready (Event) set once cec-client is ready for input
+  @staticmethod
+  def read(proc,lines,ready):
+    """pass along output until cec-client exits (target of the reader thread)"""
+
+    try:
+      for line in iter(proc.stdout.readline,''):
+        if not ready.is_set() and any(x in line for x in CecClient.READY):
+          ready.set()
+        lines.put(line)
+    except (IOError,ValueError):
+      pass
+
+    # None means the process is gone
+    lines.put(None)
+    ready.set()
+
+  # @param cmd (str) the line to send to cec-client
+  # @param expect (str) [None] text in the line we're waiting for
+  # @return (str,None) the first line containing expect or None
+  # @raise (CecError) if cec-client couldn't answer even after a restart
+  def send(self,cmd,expect=None):
+    """send a cmd, restarting cec-client once if it has died"""
+
+    with self.lock:
+      for attempt in range(2):
+        try:
+          if not self.alive():
+            if self.proc and self.log:
+              self.log.warning('cec-client exited; restarting')
+            self.start()
+          return self.write(cmd,expect)
+        except (IOError,EOFError):
+          self.kill()
+      raise CecError('cec-client exited while handling "%s"' % cmd)
+
+  # @param cmd (str) the line to send to cec-client
+  # @param expect (str) [None] text in the line we're waiting for
+  # @return (str,None) the first line containing expect or None
+  # @raise (EOFError) if cec-client exits before answering
+  def write(self,cmd,expect):
+    """helper function for send()"""
+
+    # throw away anything cec-client logged since the last cmd
+    while True:
+      try:
+        if self.lines.get_nowait() is None:
+          raise EOFError
+      except Queue.Empty:
+        break
+
+    self.proc.stdin.write(cmd+'\n')
+    self.proc.stdin.flush()
+    if expect is None:
+      return None
+
+    deadline = time.time()+self.REPLY
+    while True:
+      try:
+        line = self.lines.get(timeout=max(deadline-time.time(),0))
+      except Queue.Empty:
+        raise CecError('No response from cec-client for "%s"' % cmd)
+      if line is None:
+        raise EOFError
+      if expect in line:
+        return line.strip()
+
+  # @return (bool) if cec-client is running
+  def alive(self):
+    """check if the process is still running"""
+
+    return bool(self.proc and self.proc.poll() is None)
+
+  def kill(self):
+    """end the process without asking nicely"""
+
+    if self.alive():
+      try:
+        self.proc.kill()
+        self.proc.wait()
+      except OSError:
+        pass
+
+  def stop(self):
+    """ask cec-client to quit, then kill it if it doesn't"""
+
+    with self.lock:
+      if not self.alive():
+        return
+      try:
+        self.proc.stdin.write('q\n')
+        self.proc.stdin.flush()
+      except IOError:
+        pass
+      for i in range(20):
+        if not self.alive():
+          break
+        time.sleep(0.1)
+      self.kill()
 
 # @param ip (str) the IP, including port, of XBMC/Kodi/OSMC/etc.
 # @param user (str) [None] the username to login to XBMC's web server
@@ -78,8 +610,15 @@ def xbmc(ip,method,params=None,user=None,pword=None,timeout=5):
 def xbmc_active_player(ip,user=None,pword=None,timeout=5):
   """return the id of the currently active player or None"""
 
-  result = xbmc(ip,'Player.GetActivePlayers',user=user,pword=pword,
-      timeout=timeout)['result']
+  return xbmc_player(xbmc(ip,'Player.GetActivePlayers',user=user,pword=pword,
+      timeout=timeout))
+
+# @param response (dict) the response from XBMC to Player.GetActivePlayers
+# @return (None,tuple of (int,str)) the (playerid,filetype) of the active player
+def xbmc_player(response):
+  """return the active player from a Player.GetActivePlayers response"""
+
+  result = response['result']
   if len(result)==0:
     return None
 
@@ -94,11 +633,15 @@ def xbmc_active_player(ip,user=None,pword=None,timeout=5):
 # @param lib (list) a list of file names to search through
 # @param args (list) a list of search terms to match
 # @param sort (bool) [True] whether to sort the result
+# @param index (object) [None] an index over lib providing search(args,sort)
 # @return (list) a list of matching file names
-def matches(lib,args,sort=True):
+def matches(lib,args,sort=True,index=None):
   """helper function for search(), files(), and file()"""
 
-  # find matches
+  # let the index do the work (including sorting) if we have one
+  if index is not None:
+    return index.search(args,sort)
+
   matches = []
   for entry in lib:
     try:
@@ -287,20 +830,168 @@ def reducetree(paths):
       or (not shortest.startswith('smb://') and shortest!='/')):
     parent = shortest[:shortest.rfind('/',0,-1)+1]
 
-  # check all paths to see if they contain either the shortest or its parent
-  short = True
-  par = (parent is not None)
-  for path in paths:
-    short = (short and path.startswith(shortest))
-    par = (par and path.startswith(parent))
+  # the deepest dir containing every path
+  root = os.path.commonprefix(paths)
+  root = root[:root.rfind('/')+1]
 
   # prioritize the shortest over the parent
-  if short:
+  if root==shortest:
     return [shortest]
-  if par:
+  if parent is not None and root.startswith(parent):
     return [parent]
   return paths
 
+class PathTrie(object):
+  """trie of path components that answers directory queries in O(depth)"""
+
+  # nodes are dicts of {component:child} where a child is another node or LEAF
+  # if nothing is under it; END in a node means a path ends at that node
+  LEAF = 0
+  END = None
+
+  # @param paths (list) [None] paths to add
+  def __init__(self,paths=None):
+
+    self.root = {}
+    self.names = {}   # every component we've seen, so each is stored once
+    self.count = 0
+
+    for path in (paths or []):
+      self.add(path)
+
+  def __len__(self):
+    return self.count
+
+  def __iter__(self):
+    return self.walk(self.root,[])
+
+  def __contains__(self,path):
+
+    (node,name) = self.find(self.split(path))
+    if node is None:
+      return False
+    child = node.get(name)
+    return child is self.LEAF or (isinstance(child,dict) and self.END in child)
+
+  # @param path (str,unicode) the path to add
+  def add(self,path):
+    """add a path"""
+
+    parts = self.split(path)
+    node = self.root
+    for part in parts[:-1]:
+      child = node.get(part)
+      if not isinstance(child,dict):
+        part = self.names.setdefault(part,part)
+        new = {}
+        if child is self.LEAF:
+          new[self.END] = True
+        node[part] = child = new
+      node = child
+
+    last = self.names.setdefault(parts[-1],parts[-1])
+    child = node.get(last)
+    if child is self.LEAF or (isinstance(child,dict) and self.END in child):
+      return
+    if isinstance(child,dict):
+      child[self.END] = True
+    else:
+      node[last] = self.LEAF
+    self.count += 1
+
+  # @param path (str,unicode) the path to remove
+  def remove(self,path):
+    """remove a path, pruning empty nodes"""
+
+    parts = self.split(path)
+    nodes = [self.root]
+    for part in parts[:-1]:
+      child = nodes[-1].get(part)
+      if not isinstance(child,dict):
+        return
+      nodes.append(child)
+
+    node = nodes[-1]
+    child = node.get(parts[-1])
+    if child is self.LEAF:
+      del node[parts[-1]]
+    elif isinstance(child,dict) and self.END in child:
+      del child[self.END]
+      if child:
+        self.count -= 1
+        return
+      del node[parts[-1]]
+    else:
+      return
+    self.count -= 1
+
+    # remove nodes that no longer lead anywhere
+    for (i,part) in reversed(list(enumerate(parts[:-1]))):
+      if nodes[i+1]:
+        break
+      del nodes[i][part]
+
+  # @param path (str,unicode) a directory (ending in a separator)
+  # @return (generator) every path under the given directory
+  def under(self,path):
+    """return all paths under a directory"""
+
+    parts = self.split(path)[:-1]
+    node = self.root
+    for part in parts:
+      node = node.get(part)
+      if not isinstance(node,dict):
+        return iter([])
+    return self.walk(node,parts)
+
+  # @param node (dict) the node to start from
+  # @param parts (list) the components leading to node
+  # @return (generator) every path under node
+  def walk(self,node,parts):
+    """helper function for __iter__() and under()"""
+
+    stack = [(node,parts)]
+    while stack:
+      (node,parts) = stack.pop()
+      for (name,child) in node.items():
+        if name is self.END:
+          yield self.join(parts)
+        elif child is self.LEAF:
+          yield self.join(parts+[name])
+        else:
+          stack.append((child,parts+[name]))
+
+  # @param parts (list) path components
+  # @return (tuple of (dict,str)) the node containing the last component and
+  #   the last component, or (None,None) if the path isn't in the trie
+  def find(self,parts):
+    """helper function for __contains__()"""
+
+    node = self.root
+    for part in parts[:-1]:
+      node = node.get(part)
+      if not isinstance(node,dict):
+        return (None,None)
+    return (node,parts[-1])
+
+  # @param path (str,unicode) a local or samba path
+  # @return (list) the components of the path (dirs end with an empty one)
+  @staticmethod
+  def split(path):
+    """split a path into components"""
+
+    sep = ('/' if path.startswith('smb://') else os.path.sep)
+    return path.split(sep)
+
+  # @param parts (list) path components from split()
+  # @return (str,unicode) the path
+  @staticmethod
+  def join(parts):
+    """join components back into a path"""
+
+    sep = ('/' if parts[0]=='smb:' else os.path.sep)
+    return sep.join(parts)
+
 # @param text (str)
 # @return (str) the input with common html characters decoded
 def cleanhtml(text):
@@ -354,13 +1045,38 @@ def is_int(s):
 def xbmc_sorted(files):
   """sort a list of files as xbmc does (i think) so episodes are correct"""
 
-  return sorted(files,cmp=xbmc_cmp)
+  return sorted(files,key=xbmc_key)
+
+XBMC_CHUNK = re.compile(r'(\d+)|(.)',re.UNICODE|re.DOTALL)
+
+# @param s (str) the string to make a key for
+# @return (tuple) a key that sorts the same as xbmc_cmp()
+def xbmc_key(s):
+  """sort key for xbmc_sorted() so we only parse each string once"""
+
+  # digit runs compare to characters like their first digit would, and
+  # xbmc_cmp() ignores the character after two matching digit runs
+  key = []
+  skip = False
+  for (digits,char) in XBMC_CHUNK.findall(s.lower()):
+    if skip:
+      key.append((0,''))
+      skip = False
+    elif digits:
+      key.append((0,'0',int(digits),digits))
+      skip = True
+    else:
+      key.append((0,char))
+
+  # xbmc_cmp() puts a string after every longer string that starts with it
+  key.append((1,))
+  return tuple(key)
 
 # @param a (str) a string to compare
 # @param b (str) a string to compare
 # @return (int) -1 or 1 depending on which input should come first
 def xbmc_cmp(a,b):
-  """compare function for xbmc_sort"""
+  """compare function that xbmc_key() reproduces"""
 
   a = a.lower()
   b = b.lower()
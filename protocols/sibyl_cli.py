@@ -73,7 +73,7 @@ def conf(bot):
 
 class BufferThread(Thread):
 
-  def __init__(self,q,d,c,p):
+  def __init__(self,q,d,c,p,wake):
     """create a new thread that reads from stdin and appends to a Queue"""
 
     super(BufferThread,self).__init__()
@@ -83,6 +83,7 @@ class BufferThread(Thread):
     self.event_data = d
     self.event_close = c
     self.event_proc = p
+    self.wake = wake
 
   def run(self):
     """read from stdin, add to the queue, set the event_data Event"""
@@ -96,6 +97,7 @@ class BufferThread(Thread):
       self.event_proc.clear()
       self.queue.put(s)
       self.event_data.set()
+      self.wake()
 
 ################################################################################
 # User sub-class
@@ -162,13 +164,17 @@ class CLI(Protocol):
 
     sys.__stdout__.write('\n')
     self.thread = BufferThread(
-        self.queue,self.event_data,self.event_close,self.event_proc)
+        self.queue,self.event_data,self.event_close,self.event_proc,
+        self.bot._wake)
     self.thread.start()
     self.connected = True
 
   def is_connected(self):
     return self.connected
 
+  def get_fds(self):
+    return []
+
   def process(self):
 
     if not self.event_data.is_set():
@@ -209,6 +209,11 @@ class MailProtocol(Protocol):
       # pass the message on to the bot for command execution
       self.bot._cb_message(msg)
 
+  # IMAPThread wakes the bot whenever it adds to its Queue
+  # @return (list) nothing to select() on
+  def get_fds(self):
+    return []
+
   # called when the bot is exiting for whatever reason
   # NOTE: sibylbot will already call part_room() on every room in get_rooms()
   def shutdown(self):
@@ -383,6 +388,7 @@ class IMAPThread(Thread):
         except ProtocolError as e:
           self.imap = None
           self.msgs.put(e)
+          self.proto.bot._wake()
 
       # if the line ends with "EXISTS" then there is a new message waiting
       elif line.endswith('EXISTS'):
@@ -431,3 +437,6 @@ class IMAPThread(Thread):
 
     # this tells the server to actually delete all flagged messages
     self.imap.expunge()
+
+    # let SibylBot know there's something for process()
+    self.proto.bot._wake()
@@ -216,6 +216,11 @@ class MatrixProtocol(Protocol):
     while(not self.msg_queue.empty()):
       self.bot._cb_message(self.msg_queue.get())
 
+  # messageHandler() wakes the bot whenever it adds to msg_queue
+  # @return (list) nothing to select() on
+  def get_fds(self):
+    return []
+
 
   def messageHandler(self, msg):
     if(self.opt('matrix.debug')):
@@ -263,6 +268,9 @@ class MatrixProtocol(Protocol):
 
       else:
         self.log.debug('Not handling message, unknown msgtype')
+
+      # let process() know there's something in msg_queue
+      self.bot._wake()
           
         
         
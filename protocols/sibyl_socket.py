@@ -22,7 +22,7 @@
 ################################################################################
 
 import socket,select,errno,time,traceback
-from threading import Thread,Event
+from threading import Thread,Event,Lock
 from Queue import Queue
 
 from sibyl.lib.protocol import User,Room,Message,Protocol
@@ -33,6 +33,7 @@ from sibyl.lib.protocol import AuthFailure as SuperAuthFailure
 from sibyl.lib.protocol import ServerShutdown as SuperServerShutdown
 
 from sibyl.lib.decorators import botconf
+from sibyl.lib.thread import Waker
 
 ################################################################################
 # Custom exceptions
@@ -76,7 +77,7 @@ def conf(bot):
 
 class ServerThread(Thread):
 
-  def __init__(self,log,q,d,c,pword=None,debug=False,ssl=None):
+  def __init__(self,log,q,d,c,wake,pword=None,debug=False,ssl=None):
     """create a new thread that handles socket connections"""
 
     super(ServerThread,self).__init__()
@@ -86,12 +87,14 @@ class ServerThread(Thread):
     self.queue = q
     self.event_data = d
     self.event_close = c
+    self.wake = wake
     self.password = pword
     self.debug = debug
     self.context = ssl
 
     self.dead = Queue()
     self.clients = {}
+    self.lock = Lock()
     self.socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
     self.socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
 
@@ -117,10 +120,11 @@ class ServerThread(Thread):
           if self.context:
             conn = self.context.wrap_socket(conn,server_side=True)
           self.log.info('Got new connection from %s:%s' % address)
-          q = Queue()
-          self.clients[address] = q
-          ipc = {'rq':self.queue,'sq':q,
-                  'ed':self.event_data,'ec':self.event_close}
+          (q,waker) = (Queue(),Waker())
+          with self.lock:
+            self.clients[address] = (q,waker)
+          ipc = {'rq':self.queue,'sq':q,'sw':waker,
+                  'ed':self.event_data,'ec':self.event_close,'wake':self.wake}
           ClientThread(self,conn,address,ipc).start()
         except Exception as e:
           self.log.warning('New connection %s:%s failed (%s)' %
@@ -133,7 +137,8 @@ class ServerThread(Thread):
 
       while not self.dead.empty():
         client = self.dead.get()
-        del self.clients[client]
+        with self.lock:
+          self.clients.pop(client)[1].close()
         self.log.info('Connection closed %s:%s@socket' % client)
 
       time.sleep(0.1)
@@ -143,10 +148,13 @@ class ServerThread(Thread):
   def send(self,text,address):
     """queue a message to be sent"""
 
-    try:
-      self.clients[address].put(text)
-    except KeyError:
-      self.log.warning('Attempted to send a message to a disconnected client')
+    with self.lock:
+      if address not in self.clients:
+        self.log.warning('Attempted to send a message to a disconnected client')
+        return
+      (q,waker) = self.clients[address]
+      q.put(text)
+      waker.wake()
 
 ################################################################################
 # ClientThread class
@@ -180,25 +188,27 @@ class ClientThread(Thread):
   def run(self):
     """receive and send data on the socket"""
 
+    # the server wakes us when it queues a reply so we don't have to poll
+    waker = self.ipc['sw']
     while not self.ipc['ec'].is_set():
-      (read,write,err) = select.select([self.socket],[self.socket],[],1)
+      (read,write,err) = select.select([self.socket,waker],[],[],1)
+      if waker in read:
+        waker.clear()
 
       if self.socket in read:
         try:
           msgs = self.get_msgs()
         except:
           break
-        if msgs:
-          self.ipc['ed'].set()
         for msg in msgs:
           if msg:
             self.ipc['rq'].put((self.address,msg))
+        if msgs:
+          self.ipc['ed'].set()
+          self.ipc['wake']()
 
-      if self.socket in write:
-        while not self.ipc['sq'].empty():
-          self.send_msg(self.ipc['sq'].get())
-
-      time.sleep(0.1)
+      while not self.ipc['sq'].empty():
+        self.send_msg(self.ipc['sq'].get())
 
     self.server.dead.put(self.address)
     self.socket.close()
@@ -366,7 +376,7 @@ class SocketServer(Protocol):
           context = None
 
     self.thread = ServerThread(self.log,
-        self.queue,self.event_data,self.event_close,
+        self.queue,self.event_data,self.event_close,self.bot._wake,
         self.opt('socket.password'),self.opt('socket.debug'),context)
 
     self.log.info('Attempting to bind to %s:%s' % (hostname,port))
@@ -387,22 +397,27 @@ class SocketServer(Protocol):
   def is_connected(self):
     return self.connected
 
+  def get_fds(self):
+    return []
+
   def process(self):
 
-    if not self.event_data.is_set():
+    # check the queue itself since a client can add to it while we clear
+    if self.queue.empty():
       return
 
     (address,text) = self.queue.get()
     usr = Client(self,address)
 
-    if self.special_cmds(text):
-      return
-
-    msg = Message(usr,text)
-    self.bot._cb_message(msg)
+    if not self.special_cmds(text):
+      msg = Message(usr,text)
+      self.bot._cb_message(msg)
 
+    # handle the rest on the next pass so other protocols get a turn
     if self.queue.empty():
       self.event_data.clear()
+    else:
+      self.bot._wake()
 
   def shutdown(self):
     if hasattr(self,'event_close'):
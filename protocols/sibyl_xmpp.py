@@ -295,6 +295,12 @@ class XMPP(Protocol):
 
     self.__idle_proc()
 
+  def get_fds(self):
+    """return the socket so SibylBot can wait for stanzas"""
+
+    # xmpppy drains its TLS buffer in Process() so the raw socket is enough
+    return [self.conn.Connection._sock]
+
   def shutdown(self):
     """leave all our rooms cleanly"""
 
@@ -143,11 +143,18 @@ class MYPROTOCOL(Protocol):
   def process(self):
     raise NotImplementedError
 
+  # optional; without it SibylBot calls process() every POLL seconds
+  # @return (list,None) file descriptors or objects with fileno() that are
+  #   readable when process() has work, or [] if you call bot._wake() instead
+  def get_fds(self):
+    return None
+
   # called when the bot is exiting for whatever reason
   def shutdown(self):
     raise NotImplementedError
 
-  # send a message to a user
+  # send a message to a user (called from this protocol's sender thread, never
+  # at the same time as process() or connect())
   # @param mess (Message) message to be sent
   # @raise (ConnectFailure) if failed to send message
   # Check: get_emote()
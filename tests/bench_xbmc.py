@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+# time xbmc commands against MockKodi, e.g. "python bench_xbmc.py -l 20 -j 5"
+# and with --check exit non-zero if a command makes more round trips than
+# it's allowed in BUDGET
+
+import sys,os,time,shutil,tempfile,argparse
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(here,'..'))
+
+# plugins import everything from the sibyl package
+sys.path.insert(0,os.path.dirname(os.path.dirname(here)))
+
+from lib.util import load_module
+from lib.config import Config
+from lib.sibylbot import SibylBot
+from mock_bot import Bot
+from mock_kodi import MockKodi
+
+PLUGINS = ['library','xbmc','bookmark']
+
+# the most HTTP round trips each command should need without --notify,
+# including adding the rest of the playlist in the background
+BUDGET = {'videos':3,'info':1,'seek':2,'bookmark':1,'resume':5}
+
+# with --check each command's reply must contain this (seek says nothing)
+EXPECT = {'videos':'starting with #1','info':'playing at 10:00',
+    'seek':None,'bookmark':'at 10:00','resume':'at 10:00'}
+
+def main():
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-n','--iterations',
+      default=50,type=int,
+      help='times to run each command')
+  parser.add_argument('-l','--latency',
+      default=5,type=float,
+      help='milliseconds before the mock answers each request')
+  parser.add_argument('-j','--jitter',
+      default=2,type=float,
+      help='up to this many extra milliseconds per request')
+  parser.add_argument('-s','--shows',
+      default=20,type=int,
+      help='number of shows in the mock library')
+  parser.add_argument('-e','--episodes',
+      default=100,type=int,
+      help='number of episodes per show')
+  parser.add_argument('--notify',
+      action='store_true',
+      help='follow notifications on the mock TCP port')
+  parser.add_argument('--check',
+      action='store_true',
+      help='fail if a command makes more round trips than BUDGET')
+  args = parser.parse_args()
+
+  kodi = MockKodi(args.latency/1000.0,args.jitter/1000.0,seed=0).start()
+  tmp = tempfile.mkdtemp(prefix='sibyl-bench-')
+  try:
+    bot = make_bot(kodi,tmp,args)
+    results = bench(bot,kodi,args)
+  finally:
+    kodi.stop()
+    shutil.rmtree(tmp,True)
+
+  report(results)
+  if args.check:
+    over = [name for (name,r) in results if name in BUDGET
+        and r['rtts']>BUDGET[name]*len(r['times'])]
+    if over:
+      print '\nOver budget: %s' % ', '.join(over)
+    wrong = [name for (name,r) in results if r.get('wrong')]
+    if wrong:
+      print '\nWrong replies: %s' % ', '.join(wrong)
+    if over or wrong:
+      sys.exit(1)
+
+def make_bot(kodi,tmp,args):
+  """load the xbmc plugins into a mock bot pointed at the mock kodi"""
+
+  videos = os.path.join(tmp,'videos')
+  for s in range(1,args.shows+1):
+    show = os.path.join(videos,'Show %02d' % s)
+    for e in range(1,args.episodes+1):
+      season = os.path.join(show,'Season %s' % ((e-1)//25+1))
+      if not os.path.isdir(season):
+        os.makedirs(season)
+      open(os.path.join(season,'Show %02d E%03d.mkv' % (s,e)),'w').close()
+
+  bot = Bot()
+  bot.conf = Config(os.path.join(here,'test.conf'))
+  bot.opts['persistence'] = False
+  (bot.ns_func,bot.ns_cmd,bot.ns_opt) = ({},{},{})
+  bot.errors = []
+  bot._SibylBot__status = SibylBot.INIT
+
+  mods = [(name,load_module(name,os.path.join(here,'..','cmds')))
+      for name in PLUGINS]
+  for (name,mod) in mods:
+    for opt in mod.conf(bot):
+      bot.opts[name+'.'+opt['name']] = opt.get('default')
+
+  bot.opts.update({
+      'library.file' : os.path.join(tmp,'library.dat'),
+      'library.video_dirs' : [videos],
+      'xbmc.ip' : kodi.ip,
+      'xbmc.notify_port' : (kodi.tcp_port if args.notify else 0),
+      'bookmark.file' : os.path.join(tmp,'bookmarks.txt')})
+
+  bot.plugins = PLUGINS
+  for (name,mod) in mods:
+    bot._SibylBot__load_funcs(mod,name,silent=True)
+  for (name,mod) in mods:
+    mod.init(bot)
+
+  bot.lib_ready.wait()
+  if args.notify:
+    sync(bot)
+  return bot
+
+def bench(bot,kodi,args):
+  """run each command and record its latency and round trips"""
+
+  cmds = [('videos',['show %02d' % args.shows]),
+          ('seek',['10:00']),
+          ('info',[]),
+          ('bookmark',['set','bench']),
+          ('resume',['bench'])]
+  results = [(name,{'times':[],'rtts':0,'tcp':0,'wrong':[]})
+      for (name,_) in cmds]
+
+  # how long until the whole playlist is there; its round trips count toward
+  # the command that started it
+  results.append(('videos (fill)',{'times':[],'rtts':0,'tcp':0}))
+  stats = dict(results)
+
+  for i in range(args.iterations):
+
+    # let the mirror catch up so every run starts from the same state, but
+    # run the commands back to back like a user would
+    if args.notify:
+      sync(bot)
+
+    for (name,cmd_args) in cmds:
+      kodi.reset()
+      start = time.time()
+      reply = bot.run_cmd(name,list(cmd_args))
+      elapsed = time.time()-start
+
+      # the rest of the playlist gets added in the background
+      if name in ('videos','resume'):
+        wait(lambda: len(kodi.playlists[1])==args.episodes)
+        if name=='videos':
+          stats['videos (fill)']['times'].append(time.time()-start)
+
+      counts = kodi.reset()
+      stats[name]['times'].append(elapsed)
+      stats[name]['rtts'] += counts['http']
+      stats[name]['tcp'] += counts['tcp']
+
+      expect = EXPECT[name]
+      if (reply is None)!=(expect is None) or (expect and expect not in reply):
+        stats[name]['wrong'].append(reply)
+
+      if i==0:
+        print '%s %s -> %s' % (name,' '.join(cmd_args),reply)
+
+  return results
+
+def sync(bot):
+  """wait until the mirror has state from after everything we've done"""
+
+  # notifications we caused arrived before the answer to this new refresh
+  start = time.time()
+  bot.xbmc_mirror.invalidate()
+  wait(lambda: bot.xbmc_mirror.synced>=start and bot.xbmc_state() is not None)
+
+def wait(func,timeout=30):
+  """block until func() is True"""
+
+  end = time.time()+timeout
+  while not func():
+    if time.time()>end:
+      raise RuntimeError('Timed out waiting for the mock')
+    time.sleep(0.001)
+
+def report(results):
+  """print a table of the results"""
+
+  print '\n%-14s %6s %10s %9s %8s %8s %8s' % (
+      'command','runs','rtts/run','tcp/run','p50 ms','p99 ms','ops/s')
+  for (name,r) in results:
+    times = sorted(r['times'])
+    n = len(times)
+    if not n:
+      continue
+    p50 = 1000*times[int(0.50*(n-1))]
+    p99 = 1000*times[int(round(0.99*(n-1)))]
+    print '%-14s %6s %10.2f %9.2f %8.1f %8.1f %8.1f' % (name,n,
+        float(r['rtts'])/n,float(r['tcp'])/n,p50,p99,n/sum(times))
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import os,sys,time
+
+# a stand-in for "cec-client" so the tv cmd can be tried without an adapter;
+# point general.cec_client at this file and set CEC_DELAY to change how long
+# it takes to "open" the adapter (default 2 seconds)
+
+def main():
+
+  out = sys.stdout
+  def say(line):
+    out.write(line+'\n')
+    out.flush()
+
+  say('opening a connection to the CEC adapter...')
+  time.sleep(float(os.environ.get('CEC_DELAY',2)))
+  say('waiting for input')
+
+  power = 'standby'
+  for line in iter(sys.stdin.readline,''):
+    args = line.split()
+    if not args:
+      continue
+    (cmd,dev) = (args[0],(args[1] if len(args)>1 else '0'))
+
+    if cmd=='q':
+      say('exiting...')
+      break
+    elif cmd=='pow':
+      say('power status: %s' % power)
+    elif cmd=='on':
+      power = 'on'
+      say('TRAFFIC: [ 1234]\t<< 10:04')
+    elif cmd=='standby':
+      power = 'standby'
+      say('TRAFFIC: [ 1234]\t<< 10:36')
+    elif cmd=='as':
+      say('TRAFFIC: [ 1234]\t<< 1f:82:10:00')
+    else:
+      say('unknown command: %s %s' % (cmd,dev))
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,392 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import os,json,time,random,threading,socket,collections
+import BaseHTTPServer,SocketServer
+
+# a stand-in for XBMC/Kodi's JSON-RPC API: an HTTP server for requests and a
+# TCP server that also pushes Player notifications like port 9090 does
+
+TYPES = {0:'audio',1:'video'}
+AUDIO = ('.mp3','.flac','.ogg','.m4a','.wav')
+
+class KodiError(Exception):
+
+  def __init__(self,code=-32100,message='Failed to execute method.'):
+    super(KodiError,self).__init__(message)
+    self.code = code
+    self.message = message
+
+class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+
+  # send each response in one packet so nagle doesn't add 40 ms to every one
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def do_POST(self):
+    kodi = self.server.kodi
+    kodi.count('http')
+    body = self.rfile.read(int(self.headers['content-length']))
+    kodi.delay()
+    reply = json.dumps(kodi.handle(json.loads(body)))
+    self.send_response(200)
+    self.send_header('content-type','application/json')
+    self.send_header('content-length',str(len(reply)))
+    self.end_headers()
+    self.wfile.write(reply)
+
+  def log_message(self,*args):
+    pass
+
+class TCPHandler(SocketServer.BaseRequestHandler):
+
+  def handle(self):
+    kodi = self.server.kodi
+    kodi.add_client(self.request)
+    decoder = json.JSONDecoder()
+    buf = ''
+    try:
+      while True:
+        data = self.request.recv(65536)
+        if not data:
+          break
+        buf += data
+        while buf.strip():
+          try:
+            (req,end) = decoder.raw_decode(buf.lstrip())
+          except ValueError:
+            break
+          buf = buf.lstrip()[end:]
+          kodi.count('tcp')
+          kodi.delay()
+          kodi.send(self.request,kodi.handle(req))
+    except socket.error:
+      pass
+    finally:
+      kodi.del_client(self.request)
+
+class HTTPServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+class TCPServer(SocketServer.ThreadingMixIn,SocketServer.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class MockKodi(object):
+
+  # @param latency (float) [0] seconds to wait before answering each request
+  # @param jitter (float) [0] up to this many extra seconds chosen at random
+  # @param duration (int) [1800] the length in seconds of every file
+  # @param seed (int) [None] seed for the jitter
+  def __init__(self,latency=0,jitter=0,duration=1800,seed=None):
+
+    self.latency = latency
+    self.jitter = jitter
+    self.duration = duration
+    self.random = random.Random(seed)
+
+    self.lock = threading.RLock()
+    self.playlists = {0:[],1:[]}
+    self.player = None
+    self.position = -1
+    self.file = None
+    self.speed = 0
+    self.offset = 0
+    self.started = 0
+    self.shuffled = False
+    self.volume = 100
+
+    self.stats = collections.Counter()
+    self.clients = []
+
+    self.http = HTTPServer(('127.0.0.1',0),HTTPHandler)
+    self.http.kodi = self
+    self.tcp = TCPServer(('127.0.0.1',0),TCPHandler)
+    self.tcp.kodi = self
+
+  @property
+  def ip(self):
+    return '127.0.0.1:%s' % self.http.server_address[1]
+
+  @property
+  def tcp_port(self):
+    return self.tcp.server_address[1]
+
+  def start(self):
+    for server in (self.http,self.tcp):
+      t = threading.Thread(target=server.serve_forever)
+      t.daemon = True
+      t.start()
+    return self
+
+  def stop(self):
+    for server in (self.http,self.tcp):
+      server.shutdown()
+      server.server_close()
+    with self.lock:
+      for sock in self.clients:
+        try:
+          sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+          pass
+
+  def delay(self):
+    t = self.latency+self.random.uniform(0,self.jitter)
+    if t:
+      time.sleep(t)
+
+  def count(self,name,n=1):
+    with self.lock:
+      self.stats[name] += n
+
+  def reset(self):
+    with self.lock:
+      stats = self.stats
+      self.stats = collections.Counter()
+    return stats
+
+################################################################################
+# Requests and notifications
+################################################################################
+
+  def handle(self,payload):
+    if isinstance(payload,list):
+      return [self.dispatch(req) for req in payload]
+    return self.dispatch(payload)
+
+  def dispatch(self,req):
+    self.count('calls')
+    func = getattr(self,'rpc_'+req.get('method','').replace('.','_'),None)
+    reply = {'jsonrpc':'2.0','id':req.get('id')}
+    try:
+      if func is None:
+        raise KodiError(-32601,'Method not found.')
+      with self.lock:
+        reply['result'] = func(**req.get('params',{}))
+    except TypeError:
+      reply['error'] = {'code':-32602,'message':'Invalid params.'}
+    except KodiError as e:
+      reply['error'] = {'code':e.code,'message':e.message}
+    return reply
+
+  def add_client(self,sock):
+    with self.lock:
+      self.clients.append(sock)
+
+  def del_client(self,sock):
+    with self.lock:
+      if sock in self.clients:
+        self.clients.remove(sock)
+
+  def send(self,sock,msg):
+    try:
+      sock.sendall(json.dumps(msg))
+    except socket.error:
+      self.del_client(sock)
+
+  def notify(self,method,data):
+    msg = {'jsonrpc':'2.0','method':method,
+        'params':{'data':data,'sender':'xbmc'}}
+    for sock in list(self.clients):
+      self.send(sock,msg)
+
+################################################################################
+# Player state
+################################################################################
+
+  def now(self):
+    t = self.offset
+    if self.speed:
+      t += (time.time()-self.started)*self.speed
+    return max(0,min(int(t),self.duration))
+
+  def current(self):
+    if self.position>=0:
+      return self.playlists[self.player][self.position]
+    return self.file
+
+  def item(self,properties=()):
+    f = self.current()
+    item = {'label':os.path.basename(f.rstrip('/')),'type':'unknown'}
+    if 'file' in properties:
+      item['file'] = f
+    return item
+
+  def play(self,pid,position,f=None,offset=0):
+    self.player = pid
+    self.position = position
+    self.file = f
+    self.offset = offset
+    self.speed = 1
+    self.started = time.time()
+    self.notify('Player.OnPlay',{'item':{'type':TYPES[pid]},
+        'player':{'playerid':pid,'speed':1}})
+
+  def check(self,playerid):
+    if playerid!=self.player:
+      raise KodiError()
+
+  @staticmethod
+  def to_time(t):
+    return {'hours':t//3600,'minutes':t%3600//60,'seconds':t%60,
+        'milliseconds':0}
+
+  @staticmethod
+  def from_time(t):
+    return 3600*t.get('hours',0)+60*t.get('minutes',0)+t.get('seconds',0)
+
+################################################################################
+# JSON-RPC methods
+################################################################################
+
+  def rpc_JSONRPC_Ping(self):
+    return 'pong'
+
+  def rpc_Application_GetProperties(self,properties):
+    return {'volume':self.volume} if 'volume' in properties else {}
+
+  def rpc_Application_SetVolume(self,volume):
+    self.volume = volume
+    return volume
+
+  def rpc_GUI_SetFullscreen(self,fullscreen):
+    return fullscreen is True
+
+  def rpc_Player_GetActivePlayers(self):
+    if self.player is None:
+      return []
+    return [{'playerid':self.player,'type':TYPES[self.player]}]
+
+  def rpc_Player_GetProperties(self,playerid,properties):
+    self.check(playerid)
+    props = {'speed':self.speed,
+        'time':self.to_time(self.now()),
+        'totaltime':self.to_time(self.duration),
+        'percentage':100.0*self.now()/self.duration,
+        'position':self.position,
+        'shuffled':self.shuffled}
+    return {p:props[p] for p in properties if p in props}
+
+  def rpc_Player_GetItem(self,playerid,properties=()):
+    self.check(playerid)
+    return {'item':self.item(properties)}
+
+  def rpc_Player_Open(self,item,options=None):
+    offset = 0
+    if options and isinstance(options.get('resume'),dict):
+      offset = self.from_time(options['resume'])
+    if 'playlistid' in item:
+      pid = item['playlistid']
+      if not 0<=item.get('position',0)<len(self.playlists[pid]):
+        raise KodiError()
+      self.play(pid,item.get('position',0),offset=offset)
+    elif 'file' in item:
+      pid = 0 if item['file'].lower().endswith(AUDIO) else 1
+      self.play(pid,-1,item['file'],offset)
+    else:
+      raise KodiError(-32602,'Invalid params.')
+    return 'OK'
+
+  def rpc_Player_PlayPause(self,playerid):
+    self.check(playerid)
+    (self.offset,self.started) = (self.now(),time.time())
+    self.speed = 0 if self.speed else 1
+    method = 'Player.OnResume' if self.speed else 'Player.OnPause'
+    self.notify(method,{'item':{'type':TYPES[playerid]},
+        'player':{'playerid':playerid,'speed':self.speed}})
+    return {'speed':self.speed}
+
+  def rpc_Player_Stop(self,playerid):
+    self.check(playerid)
+    self.player = None
+    self.speed = 0
+    self.notify('Player.OnStop',{'end':False,'item':{'type':TYPES[playerid]}})
+    return 'OK'
+
+  def rpc_Player_Seek(self,playerid,value):
+    self.check(playerid)
+    if isinstance(value,dict):
+      t = self.from_time(value)
+    else:
+      t = int(value*self.duration/100.0)
+    (self.offset,self.started) = (min(t,self.duration),time.time())
+    self.notify('Player.OnSeek',{'item':{'type':TYPES[playerid]},
+        'player':{'playerid':playerid,'speed':self.speed,
+        'time':self.to_time(self.offset)}})
+    return {'time':self.to_time(self.offset),'totaltime':
+        self.to_time(self.duration)}
+
+  def rpc_Player_GoTo(self,playerid,to):
+    self.check(playerid)
+    size = len(self.playlists[playerid])
+    if to=='next':
+      to = self.position+1
+    elif to=='previous':
+      to = self.position-1
+    if not 0<=to<size:
+      raise KodiError()
+    self.play(playerid,to)
+    return 'OK'
+
+  def rpc_Player_SetShuffle(self,playerid,shuffle):
+    self.check(playerid)
+    self.shuffled = (not self.shuffled if shuffle=='toggle' else shuffle)
+    return 'OK'
+
+  def rpc_Playlist_Clear(self,playlistid):
+    self.playlists[playlistid] = []
+    if self.player==playlistid and self.position>=0:
+      self.position = -1
+      self.file = None
+    return 'OK'
+
+  def rpc_Playlist_Add(self,playlistid,item):
+    items = item if isinstance(item,list) else [item]
+    if not all('file' in x for x in items):
+      raise KodiError(-32602,'Invalid params.')
+    self.playlists[playlistid].extend(x['file'] for x in items)
+    return 'OK'
+
+  def rpc_Playlist_Insert(self,playlistid,position,item):
+    if not 0<=position<=len(self.playlists[playlistid]) or 'file' not in item:
+      raise KodiError(-32602,'Invalid params.')
+    self.playlists[playlistid].insert(position,item['file'])
+
+    # like xbmc, only move the current position along by one per call
+    if self.player==playlistid and 0<=position<=self.position:
+      self.position += 1
+    return 'OK'
+
+  def rpc_Playlist_GetItems(self,playlistid,properties=()):
+    items = [{'label':os.path.basename(f),'type':'unknown'}
+        for f in self.playlists[playlistid]]
+    if 'file' in properties:
+      for (x,f) in zip(items,self.playlists[playlistid]):
+        x['file'] = f
+    return {'items':items,'limits':{'start':0,'end':len(items),
+        'total':len(items)}}
+
+  def rpc_Playlist_GetProperties(self,playlistid,properties):
+    return {'size':len(self.playlists[playlistid])} if 'size' in properties else {}
@@ -123,3 +123,15 @@ class MockProtocol(Protocol):
   def new_user(self,user,typ):
     self.log.debug('new_user(%s,%s)' % (user,typ))
     return MockUser('MOCK_NEW_USER')
+
+  def _get_rooms(self,flag):
+    self.log.debug('_get_rooms(%s)' % flag)
+    return self.rooms
+
+  def get_user(self):
+    self.log.debug('get_user')
+    return MockUser('MOCK_BOT',Message.PRIVATE)
+
+  def new_room(self,name,nick=None,pword=None):
+    self.log.debug('new_room(%s,%s,%s)' % (name,nick,pword))
+    return name
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import sys,os,unittest,tempfile,shutil
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__),'..'))
+sys.path.append(REPO)
+
+# plugins import the package as "sibyl" so do what run.py does
+sys.path.insert(0,os.path.dirname(REPO))
+
+from lib.config import Config
+from lib.util import load_module
+
+class Bot(object):
+
+  def __init__(self,conf):
+    self.conf = conf
+
+class PluginConfTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def load(self,plugin,text):
+    fname = os.path.join(self.dir,'sibyl.conf')
+    with open(fname,'w') as f:
+      f.write(text)
+
+    conf = Config(fname)
+    mod = load_module(plugin,os.path.join(REPO,'cmds'))
+    opts = mod.conf(Bot(conf))
+    for opt in opts:
+      opt['name'] = plugin+'.'+opt['name']
+    self.assertTrue(conf.add_opts(opts,plugin))
+    conf.reload()
+    return conf
+
+  def test_xbmc_hosts(self):
+
+    conf = self.load('xbmc','xbmc.ip = 127.0.0.1:8080\n'
+        'xbmc.hosts = den,10.0.0.2:8080; attic,not an ip\n')
+    self.assertEqual(conf.opts['xbmc.hosts'],{'den':'10.0.0.2:8080'})
+    self.assertTrue(any('attic' in msg for (lvl,msg) in conf.log_msgs))
+
+if __name__=='__main__':
+  unittest.main()
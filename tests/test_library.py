@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import sys,os,unittest,threading,tempfile,shutil,pickle,random
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__),'..'))
+sys.path.append(REPO)
+
+# plugins import the package as "sibyl" so do what run.py does
+sys.path.insert(0,os.path.dirname(REPO))
+
+from lib.util import load_module,matches
+
+library = load_module('library',os.path.join(REPO,'cmds'))
+
+class Bot(object):
+
+  def __init__(self,**lists):
+    self.lib_lock = threading.Lock()
+    self.lib_index_lock = threading.Lock()
+    self.lib_index = {}
+    self.lib_trie = {}
+    self.lib_cache = library.Cache(8)
+    self.lib_watcher = None
+    for lib in library.LISTS:
+      setattr(self,'lib_'+lib,list(lists.get(lib,[])))
+
+    self.opts = {'library.file':library.FILE,
+        'library.audio_dirs':[],'library.video_dirs':[]}
+
+  def opt(self,name):
+    return self.opts[name]
+
+class IndexTestCase(unittest.TestCase):
+
+  FILES = [
+    u'/tv/Show/Season 1/Show S01E01 - Pilot.mkv',
+    u'/tv/Show/Season 1/Show S01E02 - The Return.mkv',
+    u'/tv/Show/Season 1/Show S01E10.mkv',
+    u'/tv/Show/Season 10/Show S10E01.mkv',
+    u'/tv/Show 2/show.2.s01e01.720p.mkv',
+    u'/tv/Another Show/Part 9.avi',
+    u'/tv/Another Show/Part 100.avi',
+    u'/music/Artist/Album (2004)/01 - Song.flac',
+    u'/music/Artist/Album (2004)/02 - Other Song.flac',
+    u'/music/Ärtist/Ålbum/03 - Sång.mp3',
+    u'/music/AC-DC/Back in Black/01 Hells Bells.mp3',
+    u'/music/a/b/c.mp3',
+  ]
+
+  # search terms made of whole words, parts of words, and spans of words
+  TERMS = [u'show','SHOW','s01','s01e0','e01','how','pilot','return','the r',
+      'show s01','2004)','(2004)','album','lbum',u'sång',u'ärt','ac-dc','ac',
+      'a','b','mp3','.mp3','mkv','/tv/','part 1','100','1','10','','x','-',
+      'song.','01 - ','e s0','720p.mkv','hells bells','zzz']
+
+  def check(self,index,files,args):
+    for sort in (False,True):
+      self.assertEqual(index.search(args,sort),matches(files,args,sort),
+          (args,sort))
+
+  def test_terms(self):
+
+    index = library.Index(self.FILES)
+    for term in self.TERMS:
+      self.check(index,self.FILES,[term])
+      if term:
+        self.check(index,self.FILES,['-'+term])
+
+  def test_random(self):
+
+    # random mixes of include and exclude terms should match the old scan
+    rand = random.Random(0)
+    index = library.Index(self.FILES)
+    for i in range(2000):
+      args = [('-' if rand.random()<0.3 else '')+rand.choice(self.TERMS)
+          for j in range(rand.randint(1,3))]
+      self.check(index,self.FILES,args)
+
+  def test_patched(self):
+
+    # entries added after ranking are ordered correctly before and after a
+    # rerank, and removed entries never come back
+    index = library.Index(self.FILES)
+    index.RERANK = 2
+    files = list(self.FILES)
+    index.search(['mkv'],True)
+    for (i,path) in enumerate([u'/tv/Show/Season 1/Show S01E03.mkv',
+        u'/tv/Show/Season 2/Show S02E01.mkv',u'/music/a/b/a.mp3']):
+      index.add(path)
+      files.append(path)
+      index.remove(files[i])
+      del files[i]
+      for term in self.TERMS:
+        self.check(index,files,[term])
+    self.assertEqual(len(index),len(files))
+
+class CacheTestCase(unittest.TestCase):
+
+  def test_lru(self):
+
+    cache = library.Cache(2)
+    for key in ('a','b','c'):
+      cache.put((key,),[key],cache.generation)
+    self.assertIsNone(cache.get(('a',)))
+    self.assertEqual(cache.get(('b',)),['b'])
+    cache.put(('d',),['d'],cache.generation)
+    self.assertEqual(cache.get(('b',)),['b'])
+    self.assertIsNone(cache.get(('c',)))
+    self.assertEqual((cache.hits,cache.misses),(2,2))
+
+  def test_generation(self):
+
+    # a search that started before the library changed isn't cached
+    cache = library.Cache(2)
+    generation = cache.generation
+    cache.bump()
+    cache.put(('a',),['a'],generation)
+    self.assertIsNone(cache.get(('a',)))
+
+  def test_patch(self):
+
+    bot = Bot(video_file=[u'/tv/a.mkv',u'/tv/b.avi'])
+    search = lambda args:library.library_matches(bot,'video_file',args)
+    self.assertEqual(search(['mkv']),[u'/tv/a.mkv'])
+    self.assertEqual(search(['MKV']),[u'/tv/a.mkv'])
+    self.assertEqual(bot.lib_cache.hits,1)
+
+    library.Library(bot,None,[]).patch('video_file',[u'/tv/c.mkv'],[])
+    self.assertEqual(search(['mkv']),[u'/tv/a.mkv',u'/tv/c.mkv'])
+    library.Library(bot,None,[]).patch('video_file',[],[u'/tv/a.mkv'])
+    self.assertEqual(search(['mkv']),[u'/tv/c.mkv'])
+    self.assertEqual(bot.lib_cache.hits,1)
+
+  def test_disabled(self):
+
+    cache = library.Cache(0)
+    cache.put(('a',),['a'],cache.generation)
+    self.assertIsNone(cache.get(('a',)))
+    self.assertEqual((len(cache),cache.hits,cache.misses),(0,0,0))
+
+class PatchTestCase(unittest.TestCase):
+
+  FILES = [u'/m/a.mkv',u'/m/b.mkv']
+
+  def patch(self,bot,lib,added,removed):
+    library.Library(bot,None,[]).patch(lib,added,removed)
+
+  def test_recreated(self):
+
+    # a file deleted and created again in the same batch has to stay
+    bot = Bot(video_file=self.FILES)
+    index = library.get_index(bot,'video_file')
+    self.patch(bot,'video_file',[u'/m/a.mkv'],[u'/m/a.mkv'])
+    self.assertEqual(bot.lib_video_file,self.FILES)
+    self.assertEqual(index.search(['a.mkv']),[u'/m/a.mkv'])
+
+  def test_recreated_unindexed(self):
+
+    bot = Bot(video_file=self.FILES)
+    self.patch(bot,'video_file',[u'/m/a.mkv',u'/m/c.mkv'],[u'/m/a.mkv'])
+    self.assertEqual(bot.lib_video_file,self.FILES+[u'/m/c.mkv'])
+
+  def test_add_remove(self):
+
+    bot = Bot(video_file=self.FILES)
+    index = library.get_index(bot,'video_file')
+    self.patch(bot,'video_file',[u'/m/c.mkv',u'/m/c.mkv'],[u'/m/b.mkv'])
+    self.assertEqual(bot.lib_video_file,[u'/m/a.mkv',u'/m/c.mkv'])
+    self.assertEqual(index.search(['mkv']),[u'/m/a.mkv',u'/m/c.mkv'])
+
+class FileTestCase(unittest.TestCase):
+
+  # enough entries for several Table restarts, with shared prefixes
+  FILES = ([u'/music/Artist %s/Track %s.flac' % (i,j)
+      for i in range(5) for j in range(8)]+
+      [u'/music/\xdcnicode/Track 1.flac','/music/raw \xff/Track 2.mp3'])
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.cwd = os.getcwd()
+    os.chdir(self.dir)
+    os.mkdir('data')
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.dir)
+
+  def lib(self):
+    return {'lib_last_rebuilt':1.5,'lib_last_elapsed':2,
+        'lib_timings':[(u'/music/',2.0)],
+        'lib_audio_dir':[u'/music/'],'lib_audio_file':self.FILES,
+        'lib_video_dir':[],'lib_video_file':[]}
+
+  def test_round_trip(self):
+
+    d = self.lib()
+    d['lib_times'] = {'audio':{u'/music/':(1.0,2.0),u'/gone/':None}}
+    library.write_library('lib.dat',d)
+    new = library.read_library('lib.dat')
+
+    self.assertEqual(list(new['lib_audio_file']),
+        sorted(self.FILES,key=lambda x:library.Table.encode(x)[0]))
+    self.assertEqual(list(new['lib_video_file']),[])
+    for x in self.FILES:
+      self.assertIn(x,new['lib_audio_file'])
+      self.assertIs(type(x),type(new['lib_audio_file'][
+          new['lib_audio_file'].index(x)]))
+    self.assertNotIn(u'/music/Track 9.flac',new['lib_audio_file'])
+
+    self.assertEqual(dict(new['lib_times']['audio']),
+        {u'/music/':(1.0,2.0),u'/gone/':None})
+    for k in ('lib_last_rebuilt','lib_last_elapsed','lib_timings'):
+      self.assertEqual(new[k],d[k])
+
+  def test_not_ours(self):
+
+    with open('lib.pickle','wb') as f:
+      pickle.dump(self.lib(),f,-1)
+    self.assertIsNone(library.read_library('lib.pickle'))
+
+  def test_migrate(self):
+
+    # the old default file is converted to the new default
+    with open(library.OLD_FILE,'wb') as f:
+      pickle.dump(self.lib(),f,-1)
+    bot = Bot()
+    library.Library(bot,None,[]).load()
+
+    self.assertEqual(list(bot.lib_audio_file),self.FILES)
+    self.assertEqual(bot.lib_times,{'audio':{},'video':{}})
+    new = library.read_library(library.FILE)
+    self.assertEqual(set(new['lib_audio_file']),set(self.FILES))
+
+    # and loaded from there next time
+    bot = Bot()
+    library.Library(bot,None,[]).load()
+    self.assertIsInstance(bot.lib_audio_file,library.Table)
+
+class WatcherTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = os.path.join(unicode(tempfile.mkdtemp()),'')
+    for d in ('a','b'):
+      os.mkdir(os.path.join(self.dir,d))
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_patched_dirs(self):
+
+    (a,b) = [os.path.join(self.dir,d,'') for d in ('a','b')]
+    bot = Bot(video_dir=[self.dir,a])
+    watcher = bot.lib_watcher = library.Watcher(bot)
+    watcher.sync()
+    self.assertEqual(sorted(watcher.dirs),[self.dir,a])
+
+    # "library update" patches the lists without replacing them
+    library.Library(bot,None,[]).patch('video_dir',[b],[a])
+    while not watcher.patched.empty():
+      watcher.repatch(*watcher.patched.get())
+    self.assertEqual(sorted(watcher.dirs),[self.dir,b])
+    self.assertEqual(sorted(watcher.wds.values()),[self.dir,b])
+
+    watcher.inotify.close()
+
+if __name__=='__main__':
+  unittest.main()
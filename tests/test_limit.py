@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import sys,os,unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+
+import lib.limit
+from lib.limit import TokenBucket,RateLimiter,Outbox
+
+class Clock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def time(self):
+    return self.now
+
+class TokenBucketTestCase(unittest.TestCase):
+
+  def test_refill(self):
+
+    b = TokenBucket(2,3,0)
+    self.assertEqual(b.level(0),3)
+    b.tokens = 0
+    self.assertEqual(b.wait(0),0.5)
+    self.assertEqual(b.level(0.25),0.5)
+    self.assertEqual(b.level(10),3)
+
+class RateLimiterTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = Clock()
+    self.orig = lib.limit.time
+    lib.limit.time = self.clock
+
+  def tearDown(self):
+    lib.limit.time = self.orig
+
+  def submit(self,limiter,user,cmd='search',room='room',limit=5):
+    info = ('xmpp',user,room,cmd,'library')
+    return limiter.submit(user,info,(user,cmd),limit)
+
+  def test_keys(self):
+
+    rules = [('user',('*',),1,1),('room',('search',),1,1),
+        ('proto',('library.py',),1,1),('user',('calc',),1,1)]
+    limiter = RateLimiter(rules)
+    self.assertEqual(limiter.keys('xmpp','a','r','search','library'),
+        [(0,('xmpp','a')),(1,'r'),(2,'xmpp')])
+    self.assertEqual(limiter.keys('xmpp','a',None,'search','general'),
+        [(0,('xmpp','a'))])
+
+  def test_fair(self):
+
+    limiter = RateLimiter([('room',('*',),1,2)])
+
+    # the burst runs immediately, then cmds wait their turn
+    self.assertTrue(self.submit(limiter,'a'))
+    self.assertTrue(self.submit(limiter,'a'))
+    for i in range(3):
+      self.assertFalse(self.submit(limiter,'a'))
+    self.assertFalse(self.submit(limiter,'b'))
+    self.assertFalse(self.submit(limiter,'c'))
+    self.assertEqual(limiter.ready(),[])
+    self.assertEqual(limiter.next_time(),self.clock.now+1)
+
+    # one token per second is shared round-robin
+    order = []
+    for i in range(5):
+      self.clock.now += 1
+      order.extend(u for (u,c) in limiter.ready())
+    self.assertEqual(order,['a','b','c','a','a'])
+    self.assertIsNone(limiter.next_time())
+    self.assertEqual(limiter.stats(),{'limited':5,'dropped':0,'waiting':0})
+
+  def test_drop(self):
+
+    limiter = RateLimiter([('user',('*',),1,1)])
+    self.assertTrue(self.submit(limiter,'a',limit=2))
+    self.assertFalse(self.submit(limiter,'a',limit=2))
+    self.assertFalse(self.submit(limiter,'a',limit=2))
+    self.assertIsNone(self.submit(limiter,'a',limit=2))
+    self.assertTrue(self.submit(limiter,'b',limit=2))
+    self.assertEqual(limiter.stats()['dropped'],1)
+
+    # unlimited cmds never wait
+    self.assertTrue(RateLimiter([]).submit('a',('x','a',None,'c','n'),None,0))
+
+class Msg(object):
+
+  def __init__(self,to,text,broadcast=False):
+    (self.to,self.text,self.broadcast) = (to,text,broadcast)
+
+  def get_to(self):
+    return self.to
+
+  def get_text(self):
+    return self.text
+
+  def set_text(self,text):
+    self.text = text
+
+  def get_broadcast(self):
+    return self.broadcast
+
+  def get_emote(self):
+    return False
+
+  def get_hook(self):
+    return True
+
+class OutboxTestCase(unittest.TestCase):
+
+  def drain(self,outbox,now):
+    sent = []
+    (msg,wait) = outbox.get(now)
+    while msg:
+      sent.append((msg.get_to(),msg.get_text()))
+      (msg,wait) = outbox.get(now)
+    return (sent,wait)
+
+  def test_join(self):
+
+    outbox = Outbox(0,1,10)
+    for text in ('a','b','cccc','dddd','e'*20,'f'):
+      outbox.put(Msg('r',text))
+    outbox.put(Msg('r','g',broadcast=True))
+    outbox.put(Msg('r','h'))
+
+    (sent,wait) = self.drain(outbox,0)
+    self.assertEqual([t for (r,t) in sent],
+        ['a\nb\ncccc','dddd','e'*20,'f','g','h'])
+    self.assertIsNone(wait)
+    self.assertEqual(len(outbox),0)
+
+  def test_no_join(self):
+
+    # the default send_batch of 1 never joins, even empty msgs
+    outbox = Outbox(0,1,1)
+    for text in ('','','a'):
+      outbox.put(Msg('r',text))
+    self.assertEqual([t for (r,t) in self.drain(outbox,0)[0]],['','','a'])
+
+  def test_shape(self):
+
+    outbox = Outbox(2,1,0)
+    for i in range(3):
+      outbox.put(Msg('r',str(i)))
+    outbox.put(Msg('u','x'))
+
+    # each destination has its own bucket and they take turns
+    (sent,wait) = self.drain(outbox,0)
+    self.assertEqual(sent,[('r','0'),('u','x')])
+    self.assertEqual(wait,0.5)
+    self.assertEqual(self.drain(outbox,0.5)[0],[('r','1')])
+
+    # flushing ignores the rate
+    self.assertEqual(outbox.get(0.5,False)[0].get_text(),'2')
+
+if __name__=='__main__':
+  unittest.main()
@@ -45,6 +45,9 @@ class Bot(object):
   _cb_join_room_success = _cb_message
   _cb_join_room_failure = _cb_message
 
+  def _wake(self):
+    pass
+
   def opt(self,name):
     return self.conf.opts[name]
 
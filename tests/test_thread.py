@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import sys,os,unittest,threading,time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+
+from lib.thread import Executor,CmdQueue
+
+class Bot(object):
+
+  def __init__(self):
+    self.errors = []
+
+  def log_ex(self,e,*msgs):
+    self.errors.append(e)
+
+class Block(object):
+  """job that runs until released"""
+
+  def __init__(self,name='block'):
+    self.name = name
+    self.started = threading.Event()
+    self.release = threading.Event()
+
+  def run(self):
+    self.started.set()
+    self.release.wait(5)
+
+def workers():
+  """wait for every worker thread to exit"""
+
+  for i in range(100):
+    if not [t for t in threading.enumerate() if t.name.startswith('worker-')]:
+      return
+    time.sleep(0.01)
+
+class ExecutorTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.pool = Executor(Bot(),size=3,per_ns=2,backlog=2)
+
+  def tearDown(self):
+    self.pool.stop()
+    workers()
+
+  def wait(self,cond):
+    for i in range(100):
+      if cond():
+        return
+      time.sleep(0.01)
+    self.fail('timed out')
+
+  def test_namespace_cap(self):
+
+    jobs = [Block() for i in range(3)]
+    for job in jobs:
+      self.assertTrue(self.pool.submit('lib',job))
+
+    # only two may run at once even though there's a free worker
+    jobs[1].started.wait(1)
+    self.wait(lambda: self.pool.stats()['active']==2)
+    self.assertFalse(jobs[2].started.is_set())
+
+    other = Block()
+    self.assertTrue(self.pool.submit('xbmc',other))
+    self.assertTrue(other.started.wait(1))
+
+    jobs[0].release.set()
+    self.assertTrue(jobs[2].started.wait(1))
+    for job in jobs+[other]:
+      job.release.set()
+    self.wait(lambda: self.pool.stats()['active']==0)
+    self.assertEqual(self.pool.stats()['workers'],3)
+
+  def test_backlog(self):
+
+    jobs = [Block() for i in range(2)]
+    for job in jobs:
+      self.pool.submit('lib',job)
+    self.wait(lambda: self.pool.stats()['active']==2)
+
+    self.assertTrue(self.pool.submit('lib',Block()))
+    self.assertTrue(self.pool.submit('lib',Block()))
+    self.assertFalse(self.pool.submit('lib',Block()))
+    self.assertEqual(self.pool.stats()['rejected'],1)
+
+    for job in list(self.pool.pending)+[(None,j) for j in jobs]:
+      job[1].release.set()
+
+  def test_worker_survives(self):
+
+    class Fail(object):
+      name = 'fail'
+      def run(self):
+        raise RuntimeError
+
+    done = Block()
+    self.pool.submit('lib',Fail())
+    self.pool.submit('lib',done)
+    done.release.set()
+    self.assertTrue(done.started.wait(1))
+    self.assertEqual(len(self.pool.bot.errors),1)
+
+class CmdQueueTestCase(unittest.TestCase):
+
+  def test_full_executor(self):
+
+    pool = Executor(Bot(),size=1,per_ns=1,backlog=1)
+    queue = CmdQueue(pool.bot,pool)
+    blocker = Block()
+    pool.submit('xbmc',blocker)
+    blocker.started.wait(1)
+
+    # the first user's queue waits in the backlog and the second is rejected
+    self.assertTrue(queue.submit('xbmc','a',None,None,[]))
+    self.assertFalse(queue.submit('xbmc','b',None,None,[]))
+    self.assertNotIn(('xbmc','b'),queue.queues)
+
+    # a user's own queue is limited to the backlog too
+    self.assertFalse(queue.submit('xbmc','a',None,None,[]))
+
+    pool.pending.clear()
+    blocker.release.set()
+    pool.stop()
+    workers()
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import sys,os,unittest,random
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+
+from lib.util import xbmc_cmp,xbmc_key,xbmc_sorted,reducetree
+from lib.util import CecClient,CecError
+
+# a fake cec-client that takes CEC_DELAY seconds to open the "adapter"
+MOCK_CEC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'mock_cec_client.py')
+
+class XbmcSortTestCase(unittest.TestCase):
+
+  FILES = [
+    '/tv/Show/Season 1/Show S01E10.mkv',
+    '/tv/Show/Season 1/Show S01E02.mkv',
+    '/tv/Show/Season 1/Show S01E01.mkv',
+    '/tv/Show/Season 10/Show S10E01.mkv',
+    '/tv/Show/Season 2/Show S02E01.mkv',
+    '/tv/show/season 2/show s02e03.MKV',
+    '/tv/Show/Season 2/',
+    '/tv/Show/',
+    '/tv/Show 2/',
+    '/tv/Another Show/Part 9.avi',
+    '/tv/Another Show/Part 100.avi',
+    '/tv/Another Show/Part 20.avi',
+    u'/tv/Ünicode/Track 3.flac',
+    u'/tv/Ünicode/Track 12.flac',
+  ]
+
+  def test_known_files(self):
+    expected = sorted(self.FILES,cmp=xbmc_cmp)
+    self.assertEqual(xbmc_sorted(self.FILES),expected)
+
+  def test_random_pairs(self):
+
+    # xbmc_cmp() isn't a consistent ordering for some pairs (e.g. "01" and "1")
+    # so only check pairs where swapping the arguments flips the result
+    rand = random.Random(0)
+    chars = 'aB0129 ._-/'
+    for i in range(20000):
+      a = ''.join([rand.choice(chars) for j in range(rand.randint(0,8))])
+      b = ''.join([rand.choice(chars) for j in range(rand.randint(0,8))])
+      result = xbmc_cmp(a,b)
+      if result!=-xbmc_cmp(b,a):
+        continue
+      self.assertEqual(cmp(xbmc_key(a),xbmc_key(b)),result,(a,b))
+
+  def test_random_lists(self):
+
+    # names without leading zeros are totally ordered by xbmc_cmp()
+    rand = random.Random(1)
+    words = ['Show','show','Season','E','x','-',' ','.','/']
+    for i in range(500):
+      names = []
+      for j in range(rand.randint(1,20)):
+        parts = [rand.choice(words) if rand.random()<0.6
+            else str(rand.randint(1,120)) for k in range(rand.randint(1,6))]
+        names.append(''.join(parts))
+      names = list(set(names))
+      ordered = sorted(names,cmp=xbmc_cmp)
+      if all(xbmc_cmp(x,y)==-xbmc_cmp(y,x)
+          for x in names for y in names if x!=y):
+        self.assertEqual(xbmc_sorted(names),ordered)
+
+class ReduceTreeTestCase(unittest.TestCase):
+
+  def test_shortest(self):
+    paths = ['/tv/Show/','/tv/Show/Season 1/','/tv/Show/Season 2/']
+    self.assertEqual(reducetree(paths),['/tv/Show/'])
+
+  def test_parent(self):
+    paths = ['/tv/Show/Season 1/','/tv/Show/Season 2/']
+    self.assertEqual(reducetree(paths),['/tv/Show/'])
+
+  def test_partial_name(self):
+
+    # "/tv/Show" is a common prefix but not a common dir
+    paths = ['/tv/Show/','/tv/Show 2/']
+    self.assertEqual(reducetree(paths),['/tv/'])
+    paths = ['/tv/a/Show/','/tv/b/Show 2/']
+    self.assertEqual(reducetree(paths),paths)
+
+  def test_samba(self):
+
+    # never go above a share
+    paths = ['smb://server/share/a/','smb://server/share/b/']
+    self.assertEqual(reducetree(paths),['smb://server/share/'])
+    paths = ['smb://server/share/','smb://server/share 2/']
+    self.assertEqual(reducetree(paths),paths)
+
+class CecClientTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.delay = os.environ.get('CEC_DELAY')
+    os.environ['CEC_DELAY'] = '0.05'
+    self.client = CecClient([sys.executable,MOCK_CEC])
+
+  def tearDown(self):
+    self.client.stop()
+    if self.delay is None:
+      del os.environ['CEC_DELAY']
+    else:
+      os.environ['CEC_DELAY'] = self.delay
+
+  def test_pow(self):
+    self.assertEqual(self.client.send('pow','power status'),
+        'power status: standby')
+    self.assertEqual(self.client.starts,1)
+
+  def test_on(self):
+
+    # cmds that don't expect anything return right away
+    self.assertIsNone(self.client.send('on'))
+    self.assertEqual(self.client.send('pow','power status'),
+        'power status: on')
+    self.assertEqual(self.client.starts,1)
+
+  def test_restart(self):
+
+    self.client.send('on')
+    self.client.proc.kill()
+    self.client.proc.wait()
+
+    # a new process doesn't remember the old one's state
+    self.assertEqual(self.client.send('pow','power status'),
+        'power status: standby')
+    self.assertEqual(self.client.starts,2)
+
+  def test_start_timeout(self):
+
+    os.environ['CEC_DELAY'] = '5'
+    self.client.START = 0.2
+    self.assertRaises(CecError,self.client.send,'pow','power status')
+    self.assertFalse(self.client.alive())
+
+  def test_stop(self):
+
+    self.client.send('on')
+    proc = self.client.proc
+    self.client.stop()
+    self.assertFalse(self.client.alive())
+
+    # it quit when asked rather than being killed
+    self.assertEqual(proc.returncode,0)
+
+if __name__=='__main__':
+  unittest.main()